@@ -10,6 +10,7 @@ from .auth import *
 from .admin import admin
 from .models import *
 from .views import *
+from . import querylog
 from .util.prettyprint import pretty_date
 app.jinja_env.globals.update(pretty_date=pretty_date)
 
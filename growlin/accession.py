@@ -0,0 +1,213 @@
+'''
+Accession number allocation.
+
+Each ItemType prefix has an AccessionCounter document holding the last
+number handed out. Allocating a number (or a block of numbers) is a
+single atomic $inc on that document, so it costs one round trip however
+large the register is, and two librarians cataloguing at the same time
+can never get the same number.
+
+Numbers that are reserved but never used are simply skipped; the
+register may have gaps but never duplicates.
+
+This module also resolves accessions as typed or scanned at the kiosk
+into items, using the normalised accession key stored on each Item.
+'''
+import re
+from mongoengine.base import get_document
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from .indexes import hot_query
+from .models import (Item, AccessionCounter, item_types, split_accession,
+    accession_candidates, item_class_name)
+
+def format_accession(number, prefix=''):
+    '''Formats an accession number the way it is stored in the register'''
+    if prefix:
+        return '%s:%d' % (prefix, number)
+    return '%d' % number
+
+def prefix_for_item_class(item_class):
+    '''
+    Returns the accession prefix for an item class (eg. "book"), or an
+    empty string if the ItemType has none.
+    '''
+    itype = item_types.get('name', item_class)
+    return (itype and itype.prefix) or ''
+
+def _highest_accession(prefix=''):
+    '''
+    Returns the highest accession number in the register for the given
+    prefix. This scans the matching accessions, so it is only used once to
+    seed a new counter.
+    '''
+    if prefix:
+        pattern = r'^%s:(\d+)$' % re.escape(prefix)
+    else:
+        pattern = r'^(\d+)$'
+    regex = re.compile(pattern)
+    highest = 0
+    for doc in Item._get_collection().find(
+            {'accession': {'$regex': pattern}},
+            {'accession': True, '_id': False}):
+        highest = max(highest, int(regex.match(doc['accession']).group(1)))
+    return highest
+
+def seed_counter(prefix=''):
+    '''
+    Moves the counter for a prefix past the highest accession already in
+    the register, creating it if required. Safe to run at any time: the
+    counter never goes back.
+    '''
+    update = {'$max': {'value': _highest_accession(prefix)}}
+    collection = AccessionCounter._get_collection()
+    try:
+        collection.update_one({'_id': prefix}, update, upsert=True)
+    except DuplicateKeyError:
+        # Someone else created the counter at the same moment
+        collection.update_one({'_id': prefix}, update)
+
+def advance_counter(number, prefix=''):
+    '''
+    Moves the counter for a prefix to at least "number", for accessions
+    given out by other means (eg. imported), so that it never hands them
+    out again.
+    '''
+    collection = AccessionCounter._get_collection()
+    update = {'$max': {'value': number}}
+    if not collection.update_one({'_id': prefix}, update).matched_count:
+        seed_counter(prefix)
+        collection.update_one({'_id': prefix}, update)
+
+def reserve_accessions(count, prefix=''):
+    '''
+    Reserves a block of "count" consecutive accession numbers for the given
+    prefix and returns them as a list of accession strings.
+    '''
+    if count < 1:
+        raise ValueError('Must reserve at least one accession')
+    collection = AccessionCounter._get_collection()
+    previous = collection.find_one_and_update(
+        {'_id': prefix}, {'$inc': {'value': count}})
+    if previous is None:
+        # First use of this prefix: start the counter after the existing
+        # register, and try again.
+        seed_counter(prefix)
+        previous = collection.find_one_and_update(
+            {'_id': prefix}, {'$inc': {'value': count}})
+    first = previous['value'] + 1
+    return [format_accession(n, prefix) for n in xrange(first, first + count)]
+
+def allocate_accession(prefix=''):
+    '''Allocates a single new accession for the given prefix'''
+    return reserve_accessions(1, prefix)[0]
+
+class AccessionBlock(object):
+    '''
+    Hands out accessions from blocks reserved in advance, for batch
+    cataloguing sessions and bulk imports. A new block is reserved
+    whenever the current one runs out.
+    '''
+    def __init__(self, prefix='', size=50):
+        self.prefix = prefix
+        self.size = size
+        self._reserved = []
+
+    def take(self, count=1):
+        '''Returns a list of "count" accessions'''
+        while len(self._reserved) < count:
+            self._reserved.extend(reserve_accessions(
+                max(self.size, count - len(self._reserved)), self.prefix))
+        taken, self._reserved = self._reserved[:count], self._reserved[count:]
+        return taken
+
+    def next(self):
+        return self.take(1)[0]
+
+def item_class_model(item_class):
+    '''
+    Returns the Item document class for an item class (eg. "book"), or None
+    '''
+    for class_name in Item._subclasses:
+        if item_class_name(class_name) == item_class:
+            return get_document(class_name)
+    return None
+
+def resolve_accession(accession, item_type=None):
+    '''
+    Finds the Item for an accession as typed or scanned, with one indexed
+    query. If item_type (eg. "book") is given, only items of that type
+    match, and an accession typed without its prefix is enough.
+
+    Returns None if there is no such item.
+    '''
+    model = Item if item_type is None else item_class_model(item_type)
+    if model is None:
+        return None
+    candidates = accession_candidates(accession)
+    keys = list(set(k for p, k in candidates))
+    matches = list(model.objects(accession_key__in=keys).limit(10))
+    return _pick_item(candidates, matches, item_type)
+
+def resolve_accessions(accessions, item_type=None):
+    '''
+    Finds the Items for several accessions at once, with one query, the way
+    resolve_accession() does for one.
+
+    Returns a dict of the accessions given and their items (or None).
+    '''
+    model = Item if item_type is None else item_class_model(item_type)
+    if model is None:
+        return dict((a, None) for a in accessions)
+    candidates = dict((a, accession_candidates(a)) for a in set(accessions))
+    keys = set(k for c in candidates.values() for p, k in c)
+    by_key = {}
+    for item in model.objects(accession_key__in=list(keys)):
+        by_key.setdefault(item.accession_key, []).append(item)
+    found = {}
+    for a, c in candidates.items():
+        matches = [i for k in set(k for p, k in c) for i in by_key.get(k, [])]
+        found[a] = _pick_item(c, matches, item_type)
+    return found
+
+@hot_query('accession lookup')
+def _accession_lookup():
+    return Item.objects(accession_key__in=['1', 'b1'])
+
+def _pick_item(candidates, matches, item_type):
+    '''Picks the item meant by an accession from those matching its keys'''
+    # Prefer the most specific reading of what was typed...
+    for prefix, key in candidates:
+        for item in matches:
+            if (item.accession_prefix, item.accession_key) == (prefix, key):
+                return item
+    # ...otherwise allow the prefix to be left out, as long as that is
+    # not ambiguous
+    bare = [item for item in matches if item.accession_key == candidates[-1][1]]
+    if len(bare) == 1 or (bare and item_type is not None):
+        return bare[0]
+    return None
+
+def backfill_accession_keys(batch_size=500, recompute=False):
+    '''
+    Fills in the normalised accession key of items saved before it existed
+    (or of all items, if recompute is set). Returns the number of items
+    updated. Can be interrupted and run again.
+    '''
+    collection = Item._get_collection()
+    query = {} if recompute else {'accession_key': {'$exists': False}}
+    updated = 0
+    ops = []
+    for doc in collection.find(query, {'accession': True}):
+        prefix, key = split_accession(doc['accession'])
+        ops.append(UpdateOne({'_id': doc['_id']}, {'$set': {
+            'accession_prefix': prefix,
+            'accession_key': key}}))
+        if len(ops) >= batch_size:
+            collection.bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+    if ops:
+        collection.bulk_write(ops, ordered=False)
+        updated += len(ops)
+    return updated
@@ -1,9 +1,21 @@
+import os
+from flask import (request, abort, Response, stream_with_context, send_file,
+    redirect, url_for)
 from flask.ext.admin import Admin, BaseView, expose
 from .util.widgets import AddModelSelect2Widget
-from .app import app
+from .app import app, request_metrics
 from .auth import Permission, RoleNeed
 from .models import *
+from .accession import allocate_accession, prefix_for_item_class
+from .importer import ImportJob, READERS
+from .export import export_register, FORMATS
+from . import stats, profiler
+from .autocomplete import create_prefix_loader
+from .indexes import hot_query
+from .util.cache import LRUCache
+from .util.prefetch import prefetch, reference_field
 from flask.ext.admin.contrib.mongoengine import ModelView
+from mongoengine.queryset.visitor import Q
 
 admin = Admin(app, template_mode='bootstrap3')
 
@@ -16,10 +28,176 @@ class AdminRegistry(BaseView):
     def is_accessible(self):
         return admin_permission.can()
 
+class AdminProfiles(BaseView):
+    '''Profiles of requests, kept by profiler.py'''
+    @expose('/')
+    def index(self):
+        return self.render('admin/profiles.htm',
+            profiles=profiler.list_profiles(),
+            enabled=bool(app.config['PROFILE_DIR']))
+
+    @expose('/<name>/')
+    def profile(self, name):
+        stats = profiler.load(name)
+        if stats is None:
+            abort(404)
+        info = ([p for p in profiler.list_profiles() if p['name'] == name]
+            or [{'name': name}])[0]
+        return self.render('admin/profile.htm',
+            info=info,
+            total=stats.total_tt,
+            by_own_time=profiler.hottest(stats, 'tottime'),
+            by_cumulative_time=profiler.hottest(stats, 'cumtime'),
+            tree=profiler.call_tree(stats))
+
+    @expose('/<name>.prof')
+    def download(self, name):
+        path = profiler.profile_path(name)
+        if path is None:
+            abort(404)
+        return send_file(os.path.abspath(path), as_attachment=True,
+            mimetype='application/octet-stream')
+
+    def is_accessible(self):
+        return admin_permission.can()
+
 class BaseModelView(ModelView):
+    # References to load for each list page, all at once (see
+    # util/prefetch.py), as a dict of paths and the fields to load for each
+    # (None for all of them). By default, the listed reference columns that
+    # have no formatter.
+    column_prefetch = None
+
     def is_accessible(self):
         return admin_permission.can()
 
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+            execute=True, page_size=None):
+        count, data = super(BaseModelView, self).get_list(page, sort_column,
+            sort_desc, search, filters, execute, page_size)
+        if execute:
+            data = self.prefetch_list(data)
+        return count, data
+
+    def get_prefetch(self):
+        if self.column_prefetch is not None:
+            return self.column_prefetch
+        return dict((name, None) for name, label in self._list_columns
+            if name not in self.column_formatters
+            and reference_field(self.model._fields.get(name))[0])
+
+    def prefetch_list(self, rows):
+        '''Loads the references shown for a page of the list'''
+        paths = self.get_prefetch()
+        # Parents before the references inside them
+        return prefetch(rows, *sorted(paths, key=lambda p: p.count('.')),
+            only=dict((p, f) for p, f in paths.items() if f))
+
+    def _create_ajax_loader(self, name, options):
+        # Masters picked by name get the indexed prefix lookup
+        return (create_prefix_loader(self.model, name, options) or
+            super(BaseModelView, self)._create_ajax_loader(name, options))
+
+class KeysetModelView(BaseModelView):
+    '''
+    List view for large collections.
+
+    Instead of skipping over the rows of earlier pages, each page starts
+    after the last row of the page before (on the sort column, then id),
+    which is remembered for a while. Paging forwards or backwards from a
+    page already seen, or to the last pages, costs the same however deep
+    it is. Jumping far ahead to a page not seen yet still skips, but only
+    from the nearest page seen.
+
+    Without filters or a search, the count of the whole collection comes
+    from its metadata. Other counts are cached for count_cache_ttl seconds.
+    '''
+    count_cache_ttl = 30
+    boundary_cache_ttl = 300
+
+    def __init__(self, *args, **kwargs):
+        super(KeysetModelView, self).__init__(*args, **kwargs)
+        self._counts = LRUCache(maxsize=100, ttl=self.count_cache_ttl)
+        self._boundaries = LRUCache(maxsize=100, ttl=self.boundary_cache_ttl)
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+            execute=True, page_size=None):
+        if page_size is None:
+            page_size = self.page_size
+        if not execute or not page_size:
+            return super(KeysetModelView, self).get_list(page, sort_column,
+                sort_desc, search, filters, execute, page_size)
+
+        # Views without filters are given None
+        filters = filters or []
+        query = self.get_query()
+        if self._filters:
+            for flt, flt_name, value in filters:
+                f = self._filters[flt]
+                query = f.apply(query, f.clean(value))
+        if self._search_supported and search:
+            query = self._search(query, search)
+
+        key = (search, tuple(tuple(f) for f in filters))
+        count = self._get_count(query, key)
+
+        if not sort_column:
+            sort_column, sort_desc = self._get_default_order() or ('id', False)
+        key += (sort_column, bool(sort_desc), page_size)
+        return count, self.prefetch_list(self._get_page(query, key,
+            page or 0, page_size, sort_column, sort_desc, count))
+
+    def _get_count(self, query, key):
+        # Subclasses share the collection, so only the base class can use
+        # its metadata
+        if key == (None, ()) and '.' not in self.model._class_name:
+            return self.model._get_collection().count()
+        count = self._counts.get(key)
+        if count is None:
+            count = query.count()
+            self._counts.set(key, count)
+        return count
+
+    def _sort_value(self, model, column):
+        value = model._data.get(column) if column != 'id' else model.id
+        # References sort by the id stored
+        return getattr(value, 'id', value)
+
+    def _after(self, column, desc, value, id):
+        '''Returns the filter for the rows after (value, id)'''
+        op = 'lt' if desc else 'gt'
+        if column == 'id':
+            return Q(**{'id__%s' % op: id})
+        same = Q(**{column: value, 'id__%s' % op: id})
+        # Nulls sort first, and cannot be compared with other values
+        if value is None:
+            return same if desc else same | Q(**{'%s__ne' % column: None})
+        after = Q(**{'%s__%s' % (column, op): value}) | same
+        return after | Q(**{column: None}) if desc else after
+
+    def _get_page(self, query, key, page, page_size, column, desc, count):
+        boundaries = dict(self._boundaries.get(key) or {})
+        start = max([p for p in boundaries if p < page] or [-1])
+        skip = (page - start - 1) * page_size
+        order = ['-' if desc else '', '' if desc else '-']
+        # Last rows of the list? Then count from the end instead
+        from_end = count - page * page_size
+        if 0 < from_end <= skip:
+            limit = min(page_size, from_end)
+            rows = list(query.order_by('%s%s' % (order[1], column),
+                '%sid' % order[1]).skip(from_end - limit).limit(limit))
+            rows.reverse()
+        else:
+            if start >= 0:
+                query = query.filter(self._after(column, desc,
+                    *boundaries[start]))
+            rows = list(query.order_by('%s%s' % (order[0], column),
+                '%sid' % order[0]).skip(skip).limit(page_size))
+        if rows:
+            boundaries[page] = (self._sort_value(rows[-1], column), rows[-1].id)
+            self._boundaries.set(key, boundaries)
+        return rows
+
 class AdminMetadataView(BaseModelView):
     create_modal = True
 
@@ -28,11 +206,8 @@ class AdminModelUser(BaseModelView):
     column_list = ('username', 'name', 'group', 'active')
     column_searchable_list = ['username', 'name']
 
-def _check_unique_accession(accession):
-    return Item.objects.filter(accession=accession).count() == 0
-
-class AdminModelPublication(BaseModelView):
-    form_excluded_columns = ['borrow_current']
+class AdminModelPublication(KeysetModelView):
+    form_excluded_columns = ['borrow_current', 'last_return']
     column_searchable_list = ['title']
     form_ajax_refs = {
     'campus_location': {
@@ -52,26 +227,19 @@ class AdminModelPublication(BaseModelView):
         'accession': {'default': '[autoset]'},
     }
     column_list = ('accession', 'title', 'campus_location', 'promo_location')
+    column_prefetch = {
+        'campus_location': ('name',),
+        'promo_location': ('name',),
+    }
     can_view_details = True
     create_template = 'admin/overrides/item_edit.htm'
     edit_template = 'admin/overrides/item_edit.htm'
 
     def on_model_change(self, form, model, is_created):
         if (not hasattr(form, 'accession')) or form.accession.data in ('', 'auto', '[autoset]'):
-            # Auto-set accession
-            # TODO: Come up with a more foolproof way of doing this (what
-            # if many records with smaller accession numbers are deleted?)
-            accession_int = Item.objects.count() + 1
-            ok = False
-            for _ in range(10): # Try only 10 times
-                if _check_unique_accession('%s' % accession_int):
-                    ok = True
-                    break
-                accession_int += 1
-            if ok:
-                model.accession = '%s' % accession_int
-            else:
-                raise ValueError('Could not generate a unique accession')
+            # Auto-set accession from the counter for this item type
+            model.accession = allocate_accession(
+                prefix_for_item_class(model.item_class))
 
 class AdminModelBookItem(AdminModelPublication):
     form_ajax_refs = {
@@ -109,6 +277,12 @@ class AdminModelBookItem(AdminModelPublication):
     },
     }
     column_list = ('accession', 'title', 'authors', 'editors', 'campus_location', 'promo_location')
+    column_prefetch = {
+        'authors': ('name',),
+        'editors': ('name',),
+        'campus_location': ('name',),
+        'promo_location': ('name',),
+    }
     form_args = {
         'accession': {'default': '[autoset]'},
         'price_currency': {
@@ -125,8 +299,29 @@ class AdminModelBookItem(AdminModelPublication):
         },
     }
 
-class AdminModelBorrowing(BaseModelView):
-    form_excluded_columns = ['copydata_type', 'copydata_id']
+def _format_snapshot(view, context, model, name):
+    return model.get_snapshot().title
+
+class AdminModelBorrowing(KeysetModelView):
+    form_excluded_columns = ['copydata_type', 'copydata_id', 'item_snapshot']
+    column_list = ('item', 'user', 'user_group', 'borrow_date', 'return_date')
+    # Show the item from the snapshot, without looking it up
+    column_formatters = {
+        'item': _format_snapshot,
+    }
+    column_prefetch = {
+        'user': ('name', 'group'),
+        'user.group': ('name',),
+    }
+
+    def prefetch_list(self, rows):
+        rows = super(AdminModelBorrowing, self).prefetch_list(rows)
+        # Items are only read for records from before snapshots were kept
+        prefetch([r for r in rows if not r.item_snapshot],
+            'item', 'item.authors', only={
+                'item': ('accession', 'title', 'authors'),
+                'item.authors': ('name',)})
+        return rows
     form_ajax_refs = {
     'user': {
         'fields': ['username', 'name', 'email'],
@@ -134,16 +329,167 @@ class AdminModelBorrowing(BaseModelView):
     },
     }
 
+class AdminJournalConflict(BaseModelView):
+    '''Journal entries that could not be applied. See journal.py'''
+    can_create = False
+    column_list = ('created', 'action', 'item', 'user', 'date', 'error',
+        'resolved')
+    column_filters = ['resolved', 'action']
+    column_default_sort = ('created', True)
+    column_prefetch = {
+        'item': ('title',),
+        'user': ('name', 'group'),
+        'user.group': ('name',),
+    }
+    # Only marked as resolved once the loan has been put right by hand
+    form_columns = ('resolved',)
+
+class AdminAccessionCounter(BaseModelView):
+    '''
+    The accession counters, read only: moving one back (or deleting it)
+    would hand out accessions again. Use the seed-accession-counters
+    command to move them past the register.
+    '''
+    can_create = False
+    can_edit = False
+    can_delete = False
+    column_list = ('prefix', 'value')
+
+class AdminSlowQuery(BaseModelView):
+    '''Slow and repeated queries, by shape. See querylog.py'''
+    can_create = False
+    can_edit = False
+    column_list = ('fingerprint', 'count', 'total_time', 'max_time',
+        'repeated', 'endpoint', 'location', 'last_seen')
+    column_default_sort = ('total_time', True)
+    column_searchable_list = ('fingerprint', 'endpoint')
+
+class AdminImport(BaseView):
+    '''
+    Bulk upload of books, imported in the background. See importer.py.
+    Uploads and their progress are kept in IMPORT_DIR (default "imports"
+    in the instance folder).
+    '''
+    def _directory(self):
+        return app.config.get('IMPORT_DIR') or \
+            os.path.join(app.instance_path, 'imports')
+
+    @expose('/', methods=['GET', 'POST'])
+    def index(self):
+        upload = request.files.get('file')
+        if request.method == 'POST' and upload:
+            format = request.form.get('format', 'csv')
+            if format not in READERS:
+                abort(400)
+            job = ImportJob.create(self._directory(), upload.stream,
+                upload.filename, format,
+                default_location=request.form.get('location') or None)
+            job.start()
+            return redirect(url_for('.job', name=job.name))
+        return self.render('admin/import.htm', formats=sorted(READERS),
+            jobs=ImportJob.all(self._directory()))
+
+    @expose('/<name>/', methods=['GET', 'POST'])
+    def job(self, name):
+        job = self._job(name)
+        if request.method == 'POST':
+            # Resumes an import stopped by a restart or a failure
+            job.start()
+            return redirect(url_for('.job', name=name))
+        return self.render('admin/import_job.htm', job=job,
+            result=job.result())
+
+    def _job(self, name):
+        try:
+            return ImportJob.get(self._directory(), name)
+        except KeyError:
+            abort(404)
+
+    def is_accessible(self):
+        return admin_permission.can()
+
+class AdminExport(BaseView):
+    '''Download of the whole register. See export.py'''
+    @expose('/')
+    def index(self):
+        return self.render('admin/export.htm', formats=sorted(FORMATS))
+
+    @expose('/register.<format>')
+    def register(self, format):
+        if format not in FORMATS:
+            abort(404)
+        gzip = bool(request.args.get('gzip'))
+        filename = 'register.%s%s' % (format, '.gz' if gzip else '')
+        return Response(stream_with_context(export_register(format, gzip)),
+            mimetype='application/gzip' if gzip else FORMATS[format][1],
+            headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
+    def is_accessible(self):
+        return admin_permission.can()
+
+class AdminStats(BaseView):
+    '''Circulation statistics, read from the counts kept by stats.py'''
+    @expose('/')
+    def index(self):
+        months, by_group = stats.borrows_by_group()
+        return self.render('admin/stats.htm',
+            months=months,
+            by_group=by_group,
+            by_item_class=stats.borrows_by('item_class'),
+            by_location=stats.borrows_by('campus_location'),
+            most_borrowed=stats.most_borrowed())
+
+    def is_accessible(self):
+        return admin_permission.can()
+
+class AdminOverdue(BaseView):
+    '''Loans that are past their due date'''
+    @expose('/')
+    def index(self):
+        items = get_overdue_items().prefetch('borrow_current.user',
+            'borrow_current.user.group')
+        return self.render('admin/overdue.htm', items=items)
+
+    def is_accessible(self):
+        return admin_permission.can()
+
+class AdminRequestMetrics(BaseView):
+    '''Time and queries taken by each endpoint, over the last few minutes'''
+    @expose('/')
+    def index(self):
+        return self.render('admin/request_metrics.htm',
+            rows=request_metrics.summary(),
+            window=request_metrics.window // 60)
+
+    def is_accessible(self):
+        return admin_permission.can()
+
+# The register's list views
+@hot_query('books')
+def _books():
+    return BookItem.objects
+
+@hot_query('periodicals')
+def _periodicals():
+    return PeriodicalItem.objects
+
 admin.add_view(AdminModelPublication(Item, name='All Items', category='Registry'))
 admin.add_view(AdminModelBookItem(BookItem, name='Books', category='Registry'))
 admin.add_view(AdminModelPublication(PeriodicalItem, name='Periodicals', category='Registry'))
+admin.add_view(AdminImport(name='Import books', endpoint='import', category='Registry'))
+admin.add_view(AdminExport(name='Export register', endpoint='export', category='Registry'))
 
 admin.add_view(AdminModelUser(User, name='Users', category='Accounts'))
 admin.add_view(BaseModelView(UserGroup, name='Groups', category='Accounts'))
 admin.add_view(BaseModelView(UserRole, name='Roles', category='Accounts'))
 admin.add_view(AdminModelBorrowing(BorrowPast, name='Past borrowings', category='Accounts'))
+admin.add_view(AdminStats(name='Statistics', endpoint='stats', category='Accounts'))
+admin.add_view(AdminOverdue(name='Overdue', endpoint='overdue', category='Accounts'))
+admin.add_view(AdminJournalConflict(JournalConflict, name='Journal conflicts', category='Accounts'))
 
 admin.add_view(BaseModelView(ItemType, name='Item types', category='Metadata'))
+admin.add_view(AdminAccessionCounter(AccessionCounter, name='Accession counters', category='Metadata'))
+admin.add_view(BaseModelView(LoanPolicy, name='Loan policies', category='Metadata'))
 
 admin.add_view(AdminMetadataView(Publisher, name='Publishers', category='Metadata'))
 admin.add_view(AdminMetadataView(PublishPlace, name='Publish locations', category='Metadata'))
@@ -153,3 +499,6 @@ admin.add_view(AdminMetadataView(Currency, name='Currencies', category='Metadata
 admin.add_view(AdminMetadataView(Creator, name='Creators', category='Metadata'))
 
 admin.add_view(BaseModelView(PeriodicalSubscription, name='Periodical subscriptions', category='More'))
+admin.add_view(AdminSlowQuery(SlowQuery, name='Slow queries', category='More'))
+admin.add_view(AdminProfiles(name='Profiles', endpoint='profiles', category='More'))
+admin.add_view(AdminRequestMetrics(name='Request metrics', endpoint='request_metrics', category='More'))
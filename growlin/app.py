@@ -4,6 +4,8 @@ from flask.ext.admin import Admin
 from flask.ext.principal import Principal
 from flask_admin_material import setup_templates
 from flask.ext.mongoengine import MongoEngine
+from .util import monitoring
+from .util.metrics import RequestMetrics
 
 app = Flask(__name__)
 try:
@@ -25,7 +27,12 @@ except:
     else:
         print 'No OpenShift app detected. Attempt to run with default config.'
 
+# Before the database client is created, so that it reports its commands
+monitoring.install()
+
 db = MongoEngine()
 db.init_app(app)
 
 app = setup_templates(app)
+
+request_metrics = RequestMetrics(app)
@@ -1,9 +1,13 @@
-from flask import render_template, redirect, url_for, request, flash, current_app, session
+from flask import render_template, redirect, url_for, request, flash, current_app, session, abort, jsonify
 from flask.ext.login import LoginManager, login_required, current_user, login_user, logout_user
 from flask.ext.principal import Principal, Permission, RoleNeed, UserNeed, Identity, AnonymousIdentity, identity_changed, identity_loaded
 from .app import app
 from .forms import UsernamePasswordForm
 from .models import *
+from .roster import get_roster, get_group_members
+from .util.cache import LRUCache
+from mongoengine import signals
+from copy import deepcopy
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -11,8 +15,70 @@ login_manager.login_view = 'login'
 
 principals = Principal(app)
 
+# Users are kept in memory between requests along with their group and
+# roles, so that most requests authenticate with one small query instead
+# of three. The entries hold plain data, and each request gets a User of
+# its own made from it. Saving or deleting a user bumps that user's
+# IdentityVersion, and saving or deleting any role or group bumps the one
+# shared by all users; the versions are read with every lookup, so an
+# entry cached under older versions is not used, whichever process made
+# the change.
+_identity_cache = LRUCache(
+    maxsize=app.config.get('IDENTITY_CACHE_SIZE', 1000),
+    ttl=app.config.get('IDENTITY_CACHE_TTL', 60))
+ALL_USERS = 'all'
+
+def _identity_version(userid):
+    versions = dict((v['_id'], v['version']) for v in
+        IdentityVersion._get_collection().find(
+            {'_id': {'$in': [userid, ALL_USERS]}}))
+    return (versions.get(userid, 0), versions.get(ALL_USERS, 0))
+
+def _bump_version(key):
+    IdentityVersion._get_collection().update_one({'_id': key},
+        {'$inc': {'version': 1}}, upsert=True)
+
+def invalidate_user(sender, document, **kwargs):
+    '''Drops a cached user. Connected to User signals.'''
+    _bump_version(str(document.id))
+    _identity_cache.delete(str(document.id))
+
+def invalidate_identities(sender, **kwargs):
+    '''Outdates every cached user. Connected to UserRole/UserGroup signals.'''
+    _bump_version(ALL_USERS)
+
+for _signal in (signals.post_save, signals.post_delete):
+    _signal.connect(invalidate_user, sender=User)
+    _signal.connect(invalidate_identities, sender=UserRole)
+    _signal.connect(invalidate_identities, sender=UserGroup)
+
+def _identity_data(user):
+    '''Returns what is cached of a user, or None if it cannot be'''
+    roles = user.roles
+    if not isinstance(user.group, UserGroup) or \
+            not all(isinstance(r, UserRole) for r in roles):
+        # Refers to a deleted group or role
+        return None
+    return (user.to_mongo().to_dict(), user.group.to_mongo().to_dict(),
+        [r.to_mongo().to_dict() for r in roles])
+
+def _identity_user(data):
+    user, group, roles = deepcopy(data)
+    user = User._from_son(user)
+    user._data['group'] = UserGroup._from_son(group)
+    user._data['roles'] = [UserRole._from_son(r) for r in roles]
+    return user
+
 @login_manager.user_loader
 def load_user(userid=None, username=None):
+    if userid is not None:
+        userid = str(userid)
+        # Taken before the query, so that a change made meanwhile is not
+        # cached under the new version
+        version = _identity_version(userid)
+        cached = _identity_cache.get(userid)
+        if cached is not None and cached[0] == version:
+            return _identity_user(cached[1])
     try:
         if userid is not None:
 	    user = User.objects.get(id=userid)
@@ -20,6 +86,10 @@ def load_user(userid=None, username=None):
 	    user = User.objects.get(username=username)
     except db.DoesNotExist:
 	return None
+    if userid is not None:
+        data = _identity_data(user)
+        if data is not None:
+            _identity_cache.set(userid, (version, data))
     return user
 
 # Setup principals
@@ -33,7 +103,7 @@ def on_identity_loaded(sender, identity):
     if hasattr(current_user, 'id'):
 	identity.provides.add(UserNeed(current_user.id))
 
-    # Add roles
+    # Add roles (already loaded with the user, so this needs no queries)
     if hasattr(current_user, 'roles'):
 	for role in current_user.roles:
 	    identity.provides.add(RoleNeed(role.name))
@@ -48,20 +118,6 @@ def login():
     # client-side form data. For example, WTForms is a library that will
     # handle this for us.
     form = UsernamePasswordForm()
-    group_dict = {}
-    # Map users to groups
-    for user in User.objects:
-	if group_dict.has_key(user.group.name):
-	    group_dict[user.group.name].append(user)
-	else:
-	    group_dict[user.group.name] = [user]
-    # Serialize to list
-    group_list = []
-    for g in UserGroup.objects:
-	# Using group.objects so that list is sorted
-	# User list is also sorted while adding
-	u = group_dict.get(g.name, [])
-	group_list.append({'name': g.name, 'users': u})
     if form.validate_on_submit():
         # Login and validate the user.
         user = load_user(username=form.username.data)
@@ -88,7 +144,15 @@ def login():
 
 	        return redirect(next or url_for('home'))
 	# Default to returning login page
-    return render_template('login.htm', form=form, group_list=group_list)
+    return render_template('login.htm', form=form, group_list=get_roster())
+
+@app.route('/login/groups/<group_id>/')
+def login_group_members(group_id):
+    '''Returns the users of one group, for expanding the login roster'''
+    users = get_group_members(group_id)
+    if users is None:
+        abort(404)
+    return jsonify(users=users)
 
 @app.route('/logout/')
 @login_required
@@ -0,0 +1,146 @@
+'''
+Autocomplete for the masters picked by name in the admin forms (creators,
+publishers, places, locations and currencies).
+
+Flask-Admin's own AJAX lookups run a case-insensitive regex over the whole
+collection on every keystroke. Instead, each NamedMaster keeps its
+normalised name_keys (see models.name_keys), which are indexed with the
+use count, and what was typed is looked up as an anchored prefix of them.
+Exact matches come first, most used first, then the other prefix matches
+in name key order. The index serves both orders, so neither is sorted in
+memory however common the prefix is.
+'''
+import re
+from mongoengine import signals, ReferenceField, ListField
+from mongoengine.base import get_document
+from pymongo import UpdateOne
+from flask.ext.admin.contrib.mongoengine.ajax import QueryAjaxModelLoader
+from flask.ext.admin.model.ajax import DEFAULT_PAGE_SIZE
+from .models import Item, NamedMaster, name_keys
+
+def lookup(model, term, offset=0, limit=DEFAULT_PAGE_SIZE):
+    '''Returns the documents of a NamedMaster whose name starts as typed'''
+    keys = name_keys(term)
+    if not keys:
+        return []
+    key = keys[0]
+    # The id breaks ties, so that pages neither overlap nor skip
+    exact = list(model.objects(name_keys=key).order_by('-uses', 'id')
+        .limit(offset + limit))
+    page = exact[offset:offset + limit]
+    if len(page) < limit:
+        # All the exact matches were fetched, so their number is known.
+        # Ranking these by use as well would sort the whole range in memory.
+        page += list(model.objects(__raw__={'name_keys': {
+                '$regex': '^' + re.escape(key), '$nin': [key]}})
+            .order_by('name_keys', '-uses')
+            .skip(max(0, offset - len(exact)))
+            .limit(limit - len(page)))
+    return page
+
+class PrefixAjaxModelLoader(QueryAjaxModelLoader):
+    '''Flask-Admin AJAX loader using lookup() above'''
+
+    def get_list(self, term, offset=0, limit=DEFAULT_PAGE_SIZE):
+        return lookup(self.model, term, offset, limit)
+
+def _master_fields(model):
+    '''
+    Yields (field name, NamedMaster class) for the fields of a document
+    class referring to named masters
+    '''
+    for name, field in model._fields.items():
+        if isinstance(field, ListField):
+            field = field.field
+        if (isinstance(field, ReferenceField)
+                and issubclass(field.document_type, NamedMaster)):
+            yield name, field.document_type
+
+def create_prefix_loader(model, name, options):
+    '''
+    Returns a PrefixAjaxModelLoader for a field of a document class, or None
+    if the field does not refer to a named master
+    '''
+    masters = dict(_master_fields(model))
+    if name not in masters:
+        return None
+    return PrefixAjaxModelLoader(name, masters[name], **options)
+
+def count_uses(sender, document, created=False, **kwargs):
+    '''
+    Counts the masters used by a new item. Connected to Item signals.
+    '''
+    if not created or not isinstance(document, Item):
+        return
+    ids = {}
+    for name, master in _master_fields(type(document)):
+        value = document._data.get(name)
+        for ref in (value if isinstance(value, list) else [value]):
+            if ref is not None:
+                ids.setdefault(master, set()).add(ref.id)
+    for master, master_ids in ids.items():
+        master.objects(id__in=list(master_ids)).update(inc__uses=1)
+
+signals.post_save.connect(count_uses)
+
+def count_bulk_uses(model, documents):
+    '''
+    Counts the masters used by new items written straight to the collection
+    (as raw documents of an Item class), which count_uses never sees. Makes
+    one bulk write of $inc per master collection.
+    '''
+    fields = [(model._fields[name].db_field, master)
+        for name, master in _master_fields(model)]
+    uses = {}
+    for document in documents:
+        ids = {}
+        for db_field, master in fields:
+            value = document.get(db_field)
+            for id in (value if isinstance(value, list) else [value]):
+                if id is not None:
+                    ids.setdefault(master, set()).add(id)
+        for master, master_ids in ids.items():
+            counts = uses.setdefault(master, {})
+            for id in master_ids:
+                counts[id] = counts.get(id, 0) + 1
+    for master, counts in uses.items():
+        master._get_collection().bulk_write([UpdateOne({'_id': id},
+                {'$inc': {'uses': n}}) for id, n in counts.items()],
+            ordered=False)
+
+def rebuild(model, batch_size=500):
+    '''
+    Recomputes the name keys and use counts of a NamedMaster, for records
+    saved before they were kept or imported in bulk. Returns the number of
+    records updated.
+    '''
+    uses = {}
+    items = Item._get_collection()
+    for item_model in [get_document(c) for c in Item._subclasses]:
+        for name, master in _master_fields(item_model):
+            # Fields of Item are only counted once, not for each subclass
+            if master is not model or (item_model is not Item
+                    and name in Item._fields):
+                continue
+            for r in items.aggregate([
+                    {'$match': {name: {'$exists': True}}},
+                    {'$project': {name: True}},
+                    {'$unwind': '$' + name},
+                    {'$group': {'_id': '$' + name, 'n': {'$sum': 1}}}]):
+                uses[r['_id']] = uses.get(r['_id'], 0) + r['n']
+
+    collection = model._get_collection()
+    updated = 0
+    ops = []
+    for doc in collection.find({}, {'name': True}):
+        ops.append(UpdateOne({'_id': doc['_id']}, {'$set': {
+            'name_keys': name_keys(doc.get('name')),
+            'uses': uses.get(doc['_id'], 0)}}))
+        if len(ops) >= batch_size:
+            collection.bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+    if ops:
+        collection.bulk_write(ops, ordered=False)
+        updated += len(ops)
+    return updated
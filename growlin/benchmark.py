@@ -0,0 +1,211 @@
+'''
+Model-level benchmarks.
+
+Each benchmark times one operation the kiosk does all the time (borrowing,
+returning, showing the shelf and history, building the login roster,
+allocating an accession) against data made by seed.seed() at one or more
+sizes. For every benchmark and size it records the latency (median, 99th
+percentile etc.) and the number of database commands per operation,
+which is where most regressions show up first.
+
+Results are written as JSON, and can be compared against a stored
+baseline; compare() lists what got slower or needs more queries.
+
+Benchmarks need a real mongod, and empty their own database: see
+use_database(). Run them with the "benchmark" management command.
+'''
+import json
+import random
+from datetime import datetime
+from timeit import default_timer
+from mongoengine.base import _document_registry
+from mongoengine.connection import (disconnect, register_connection,
+    _connection_settings)
+from . import seed
+from .models import User, Item
+from .accession import allocate_accession, prefix_for_item_class
+from .roster import get_roster, invalidate_roster
+from .util.monitoring import record_commands
+
+# Data sizes, as arguments to seed.seed()
+SIZES = {
+    'small': dict(users=200, groups=8, items=2000, years=1),
+    'medium': dict(users=1000, groups=20, items=20000, years=3),
+    'large': dict(users=5000, groups=50, items=100000, years=5),
+}
+
+_benchmarks = []
+
+def benchmark(name):
+    '''
+    Registers a benchmark. The decorated function is given the Context
+    and returns the operation to time, as a function taking no arguments.
+    Whatever it does before returning is not timed.
+    '''
+    def decorator(f):
+        _benchmarks.append((name, f))
+        return f
+    return decorator
+
+class Context(object):
+    '''The seeded users and items, and which of the items are out'''
+    def __init__(self, random_seed=0):
+        self.random = random.Random(random_seed)
+        self.users = list(User.objects.select_related(1))
+        self.free = [d['_id'] for d in Item._get_collection().find(
+            {'borrow_current': {'$exists': False}}, {'_id': True})]
+        self.loans = []
+
+    def user(self):
+        return self.random.choice(self.users)
+
+    def take_free(self):
+        '''Returns a user and a free item for them to borrow'''
+        index = self.random.randrange(len(self.free))
+        self.free[index], self.free[-1] = self.free[-1], self.free[index]
+        return self.user(), Item.objects.get(id=self.free.pop())
+
+    def take_loan(self):
+        '''Returns a user and an item they have borrowed'''
+        if not self.loans:
+            user, item = self.take_free()
+            user.borrow(item)
+            return user, item
+        return self.loans.pop(self.random.randrange(len(self.loans)))
+
+@benchmark('borrow')
+def _borrow(context):
+    user, item = context.take_free()
+    def run():
+        user.borrow(item)
+        context.loans.append((user, item))
+    return run
+
+@benchmark('return')
+def _return(context):
+    user, item = context.take_loan()
+    def run():
+        user.unborrow(item)
+        context.free.append(item.id)
+    return run
+
+@benchmark('current borrowings')
+def _current_borrowings(context):
+    user = context.user()
+    return lambda: list(user.get_current_borrowings().prefetch('authors'))
+
+@benchmark('past borrowings')
+def _past_borrowings(context):
+    # The first page of the history, as shown
+    user = context.user()
+    return lambda: list(user.get_past_borrowings().limit(20))
+
+@benchmark('login roster')
+def _login_roster(context):
+    invalidate_roster()
+    return get_roster
+
+@benchmark('accession autoset')
+def _accession_autoset(context):
+    return lambda: allocate_accession(prefix_for_item_class('book'))
+
+def use_database(name):
+    '''
+    Points every document class at another database on the same server,
+    so that benchmarks never touch the real one
+    '''
+    settings = dict(_connection_settings['default'])
+    settings['name'] = name
+    disconnect('default')
+    register_connection('default', **settings)
+    for model in _document_registry.values():
+        if hasattr(model, '_collection'):
+            model._collection = None
+
+def percentile(values, p):
+    '''Returns the p-th percentile (0 to 100) of a list of numbers'''
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def run_benchmark(f, context, repeat=100, warmup=5):
+    '''
+    Times a benchmark. Returns its timings in milliseconds, and the number
+    of database commands per operation.
+    '''
+    for i in range(warmup):
+        f(context)()
+    times = []
+    queries = []
+    for i in range(repeat):
+        operation = f(context)
+        with record_commands() as recorder:
+            start = default_timer()
+            operation()
+            times.append((default_timer() - start) * 1000)
+        queries.append(recorder.count)
+    return {
+        'runs': repeat,
+        'mean_ms': sum(times) / len(times),
+        'p50_ms': percentile(times, 50),
+        'p99_ms': percentile(times, 99),
+        'max_ms': max(times),
+        'queries': sum(queries) / float(len(queries)),
+        'max_queries': max(queries),
+    }
+
+def run(sizes=('small',), repeat=100, warmup=5, names=None, random_seed=0,
+        progress=None):
+    '''
+    Seeds the data at each size in turn and runs the benchmarks (or those
+    named) on it. Empties the current database: see use_database().
+    Returns the results, ready to be written as JSON.
+    '''
+    say = progress or (lambda message: None)
+    results = {'created': datetime.now().isoformat(), 'repeat': repeat,
+        'sizes': {}}
+    for size in sizes:
+        say('Seeding %s data' % size)
+        counts = seed.seed(reset=True, random_seed=random_seed, **SIZES[size])
+        context = Context(random_seed)
+        timings = {}
+        for name, f in _benchmarks:
+            if names and name not in names:
+                continue
+            say('Running %s (%s)' % (name, size))
+            timings[name] = run_benchmark(f, context, repeat, warmup)
+        results['sizes'][size] = {'data': counts, 'benchmarks': timings}
+    return results
+
+def compare(results, baseline, tolerance=0.2, min_ms=0.5):
+    '''
+    Compares results with a baseline. Returns (size, benchmark, measure,
+    baseline, current, regressed) for each measure found in both. A
+    benchmark has regressed if its median is more than "tolerance" (and
+    at least min_ms) slower, or if it needs more queries.
+    '''
+    rows = []
+    for size, current in sorted(results['sizes'].items()):
+        base = baseline.get('sizes', {}).get(size)
+        if base is None:
+            continue
+        for name, now in sorted(current['benchmarks'].items()):
+            before = base['benchmarks'].get(name)
+            if before is None:
+                continue
+            slower = now['p50_ms'] - before['p50_ms']
+            rows.append((size, name, 'p50_ms', before['p50_ms'],
+                now['p50_ms'], slower > max(min_ms,
+                    tolerance * before['p50_ms'])))
+            rows.append((size, name, 'p99_ms', before['p99_ms'],
+                now['p99_ms'], False))
+            rows.append((size, name, 'queries', before['queries'],
+                now['queries'], now['queries'] > before['queries']))
+    return rows
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
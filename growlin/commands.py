@@ -0,0 +1,295 @@
+'''
+Management commands for Growlin. Run them from the project directory with:
+
+    python manage.py <command> [options]
+
+Use "python manage.py --help" to see the list of commands.
+'''
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+from .app import app
+from .models import NamedMaster, JournalConflict, get_overdue_items, item_types
+from . import (accession, autocomplete, benchmark, export, importer, indexes,
+    journal, loadtest, migrations, search, seed, stats)
+
+_commands = []
+
+def command(name, help=None):
+    '''Registers a function as a management command'''
+    def decorator(f):
+        _commands.append((name, help, f))
+        return f
+    return decorator
+
+def argument(*args, **kwargs):
+    '''Adds an argparse argument to a management command'''
+    def decorator(f):
+        if not hasattr(f, 'arguments'):
+            f.arguments = []
+        # Decorators are applied bottom-up, so insert at the front to keep
+        # the arguments in the order they are written
+        f.arguments.insert(0, (args, kwargs))
+        return f
+    return decorator
+
+@command('backfill-accession-keys',
+    help='Fill in normalised accession keys for existing items')
+@argument('--recompute', action='store_true',
+    help='Recompute keys for all items, not only those without one')
+@argument('--batch-size', type=int, default=500)
+def backfill_accession_keys(args):
+    updated = accession.backfill_accession_keys(args.batch_size, args.recompute)
+    print 'Updated %d items' % updated
+
+@command('seed-accession-counters',
+    help='Move the accession counters past the existing register')
+def seed_accession_counters(args):
+    for prefix in [''] + sorted(set(t.prefix for t in item_types.all()
+            if t.prefix)):
+        accession.seed_counter(prefix)
+        print 'Seeded counter %r' % prefix
+
+@command('backfill-item-snapshots',
+    help='Add item snapshots to past borrowings recorded without one')
+@argument('--batch-size', type=int, default=500)
+def backfill_item_snapshots(args):
+    def progress(updated, missing):
+        print 'Updated %d records (%d with missing items)' % (updated, missing)
+    migrations.backfill_item_snapshots(args.batch_size, progress)
+
+@command('ensure-indexes',
+    help='Build indexes and check that the hot queries use them')
+def ensure_indexes(args):
+    for model in indexes.ensure_all_indexes():
+        print 'Indexed %s' % model._class_name
+    failed = False
+    for name, stages, ok in indexes.verify_indexes():
+        print '%-4s %s: %s' % ('OK' if ok else 'FAIL', name, ' > '.join(stages))
+        failed = failed or not ok
+    if failed:
+        print 'Some hot queries scan a whole collection!'
+        return 1
+
+@command('import-items', help='Import books from a CSV or MARC file')
+@argument('path')
+@argument('--format', choices=sorted(importer.READERS), default='csv')
+@argument('--location',
+    help='Campus location for items that do not name one')
+@argument('--checkpoint',
+    help='File to save progress in, and resume from if it exists')
+@argument('--batch-size', type=int, default=500)
+def import_items(args):
+    def progress(result):
+        print 'Imported %d items (%d errors) up to row %d' % (
+            result.imported, len(result.errors), result.position)
+    with open(args.path, 'rb') as f:
+        result = importer.import_items(f, args.format,
+            checkpoint=args.checkpoint, progress=progress,
+            default_location=args.location, batch_size=args.batch_size)
+    for position, message in result.errors:
+        print 'Row %d: %s' % (position, message)
+    if result.errors:
+        return 1
+
+@command('export-register', help='Export the whole accession register')
+@argument('--format', choices=sorted(export.FORMATS), default='csv')
+@argument('--gzip', action='store_true', help='Compress the output')
+@argument('--output', '-o', help='File to write to (default: standard output)')
+def export_register(args):
+    out = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        for chunk in export.export_register(args.format, args.gzip):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+@command('rebuild-stats',
+    help='Recompute the circulation statistics from the borrowing history')
+def rebuild_stats(args):
+    print 'Wrote %d counts' % stats.rebuild_stats()
+
+@command('backfill-due-dates',
+    help='Set due dates on loans made before due dates were kept')
+@argument('--batch-size', type=int, default=500)
+def backfill_due_dates(args):
+    def progress(updated):
+        print 'Updated %d loans' % updated
+    migrations.backfill_due_dates(args.batch_size, progress)
+
+@command('overdue-report', help='List the loans that are overdue')
+@argument('--before', metavar='YYYY-MM-DD',
+    help='List loans due before this date instead of now')
+def overdue_report(args):
+    before = datetime.strptime(args.before, '%Y-%m-%d') if args.before else None
+    items = get_overdue_items(before).prefetch('borrow_current.user',
+        'borrow_current.user.group')
+    for item in items:
+        b = item.borrow_current
+        print '%s\t%s\t%s\t%s\tdue %s' % (item.accession,
+            item.title.encode('utf-8'), b.user.name.encode('utf-8'),
+            b.user.group.name.encode('utf-8'), b.due_date.strftime('%Y-%m-%d'))
+    print '%d overdue' % len(items)
+
+@command('reindex-search',
+    help='Recompute the search terms of every item')
+@argument('--batch-size', type=int, default=500)
+def reindex_search(args):
+    def progress(updated):
+        print 'Reindexed %d items' % updated
+    search.reindex(args.batch_size, progress)
+
+@command('rebuild-autocomplete',
+    help='Recompute the name keys and use counts of the masters')
+def rebuild_autocomplete(args):
+    for model in NamedMaster.__subclasses__():
+        print 'Updated %d %s records' % (autocomplete.rebuild(model),
+            model._class_name)
+
+@command('replay-journal',
+    help='Apply the circulation journals left by stopped servers')
+@argument('path', nargs='?',
+    help='Journal file (default: those of CIRCULATION_JOURNAL from the config)')
+def replay_journal(args):
+    if args.path:
+        paths = [args.path]
+    elif app.config.get('CIRCULATION_JOURNAL'):
+        paths = journal.journal_paths(app.config['CIRCULATION_JOURNAL'],
+            app.config.get('CIRCULATION_JOURNAL_SLOTS', 8))
+    else:
+        print 'No journal given, and CIRCULATION_JOURNAL is not set'
+        return 1
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        try:
+            j = journal.Journal(path)
+        except journal.JournalInUse:
+            print 'Skipping %s, which a running server is using' % path
+            continue
+        print 'Applied %d entries from %s' % (j.flush(), path)
+    print '%d conflicts to review' % JournalConflict.objects(
+        resolved=False).count()
+
+@command('seed-test-data', help='Fill the database with made-up test data')
+@argument('--users', type=int, default=14)
+@argument('--groups', type=int, default=4)
+@argument('--items', type=int, default=30)
+@argument('--years', type=int, default=1, help='Years of borrowing history')
+@argument('--seed', type=int, default=0, help='Random seed')
+@argument('--reset', action='store_true',
+    help='Delete the existing users, items, history etc. first')
+def seed_test_data(args):
+    def progress(message):
+        print 'Adding %s...' % message
+    counts = seed.seed(users=args.users, groups=args.groups, items=args.items,
+        years=args.years, random_seed=args.seed, reset=args.reset,
+        progress=progress)
+    print ', '.join('%d %s' % (n, name) for name, n in sorted(counts.items()))
+
+@command('benchmark', help='Time the common operations at several data sizes')
+@argument('--db', default='growlin_benchmark',
+    help='Database to seed and run in, which is emptied (default: %(default)s)')
+@argument('--sizes', default='small',
+    help='Comma-separated data sizes, of: %s' % ', '.join(sorted(benchmark.SIZES)))
+@argument('--only', help='Comma-separated benchmarks to run')
+@argument('--repeat', type=int, default=100)
+@argument('-o', '--output', help='Write the results to this JSON file')
+@argument('--baseline', help='Compare with the results in this JSON file')
+@argument('--tolerance', type=float, default=0.2,
+    help='Slowdown of the median allowed before failing (default: %(default)s)')
+def run_benchmark(args):
+    if args.db == app.config.get('MONGODB_DB'):
+        print 'Refusing to empty the configured database %s' % args.db
+        return 1
+    sizes = args.sizes.split(',')
+    for size in sizes:
+        if size not in benchmark.SIZES:
+            print 'Unknown size: %s' % size
+            return 1
+    benchmark.use_database(args.db)
+    def progress(message):
+        print message + '...'
+    results = benchmark.run(sizes, args.repeat,
+        names=args.only and args.only.split(','), progress=progress)
+    for size in sizes:
+        print
+        print '%s: %s' % (size, ', '.join('%d %s' % (n, name) for name, n
+            in sorted(results['sizes'][size]['data'].items())))
+        for name, r in sorted(results['sizes'][size]['benchmarks'].items()):
+            print '  %-20s p50 %8.2fms  p99 %8.2fms  %5.1f queries' % (
+                name, r['p50_ms'], r['p99_ms'], r['queries'])
+    if args.output:
+        benchmark.save(results, args.output)
+    if args.baseline:
+        rows = benchmark.compare(results, benchmark.load(args.baseline),
+            args.tolerance)
+        regressed = [r for r in rows if r[5]]
+        print
+        for size, name, measure, before, now, bad in rows:
+            print '%s%s %s %s: %.2f -> %.2f' % ('REGRESSED ' if bad else '',
+                size, name, measure, before, now)
+        if regressed:
+            return 1
+
+@command('load-test',
+    help='Replay kiosk sessions against the app, many at a time')
+@argument('--url', help='Server to test, eg. http://localhost:5000 '
+    '(default: the app in this process)')
+@argument('--concurrency', '-c', type=int, default=10,
+    help='Sessions running at once (default: %(default)s)')
+@argument('--sessions', type=int, default=100)
+@argument('--loans', type=int, default=2, help='Items borrowed per session')
+@argument('--from-history', action='store_true',
+    help='Take the sessions from the recent borrowing history')
+@argument('--trace', help='Replay the sessions saved in this JSON file')
+@argument('--save-trace', help='Save the sessions to this JSON file')
+@argument('--think', type=float, default=0.0,
+    help='Longest pause between actions, in seconds')
+@argument('-o', '--output', help='Write the report to this JSON file')
+def load_test(args):
+    # Borrows and returns for real: meant for test data (see seed-test-data)
+    if args.trace:
+        trace = loadtest.load_trace(args.trace)
+    elif args.from_history:
+        trace = loadtest.history_trace(args.sessions, args.loans)
+    else:
+        trace = loadtest.synthetic_trace(args.sessions, args.loans)
+    if args.save_trace:
+        loadtest.save_trace(trace, args.save_trace)
+    if args.url:
+        make_session = lambda: loadtest.HTTPSession(args.url)
+    else:
+        make_session = loadtest.WSGISession
+    print 'Replaying %d sessions, %d at a time...' % (len(trace),
+        args.concurrency)
+    summary = loadtest.run(trace, make_session, args.concurrency,
+        args.think).summary()
+    print '%d requests in %.1fs: %.1f/s, %d errors' % (summary['requests'],
+        summary['elapsed'], summary['per_second'], summary['errors'])
+    for name, counts in sorted(summary['actions'].items()):
+        print '  %-8s %d ok, %d failed' % (name, counts['ok'], counts['failed'])
+    for route, r in sorted(summary['routes'].items()):
+        print '  %-36s %6d  p50 %8.2fms  p90 %8.2fms  p99 %8.2fms  %d errors' % (
+            route, r['requests'], r['p50_ms'], r['p90_ms'], r['p99_ms'],
+            r['errors'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    if summary['errors']:
+        return 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Growlin management commands')
+    subparsers = parser.add_subparsers(title='commands')
+    for name, help, f in _commands:
+        subparser = subparsers.add_parser(name, help=help)
+        for args, kwargs in getattr(f, 'arguments', []):
+            subparser.add_argument(*args, **kwargs)
+        subparser.set_defaults(func=f)
+    args = parser.parse_args(argv)
+    with app.app_context():
+        return args.func(args)
@@ -0,0 +1,129 @@
+'''
+Export of the whole accession register (every Item subclass), as CSV or
+JSON Lines, optionally gzipped.
+
+Items are read with a raw cursor that fetches them from the server in
+batches and only the exported fields. References are resolved a batch at
+a time: locations and currencies come from the in-memory registries, and
+authors with one $in query per batch. Rows are yielded from generators,
+so memory use does not grow with the size of the register, and the web
+export streams its response instead of building it first.
+'''
+import csv
+import json
+import zlib
+from datetime import datetime
+from StringIO import StringIO
+from .models import (Item, Creator, campus_locations, currencies,
+    item_class_name)
+
+FIELDS = ('accession', 'item_class', 'title', 'subtitle', 'status',
+    'authors', 'isbn', 'publication_year', 'campus_location', 'price',
+    'price_currency', 'receipt_date', 'source')
+
+# Fields to fetch from the database for the above
+_PROJECTION = dict((f, True) for f in ('accession', '_cls', 'title',
+    'subtitle', 'status', 'authors', 'isbn', 'publication_year',
+    'campus_location', 'price', 'price_currency', 'receipt_date', 'source'))
+
+def _batches(cursor, size):
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _name(registry, id):
+    document = registry.get('pk', id) if id else None
+    return document.name if document else None
+
+def iter_register(batch_size=500):
+    '''Yields the register one item (a dict of FIELDS) at a time'''
+    cursor = (Item._get_collection().find({}, _PROJECTION)
+        .sort('_id', 1).batch_size(batch_size))
+    for batch in _batches(cursor, batch_size):
+        author_ids = set(a for doc in batch for a in doc.get('authors', []))
+        authors = dict((c['_id'], c['name']) for c in
+            Creator._get_collection().find(
+                {'_id': {'$in': list(author_ids)}}, {'name': True}))
+        for doc in batch:
+            receipt_date = doc.get('receipt_date')
+            yield {
+                'accession': doc.get('accession'),
+                'item_class': item_class_name(doc.get('_cls', 'Item')),
+                'title': doc.get('title'),
+                'subtitle': doc.get('subtitle'),
+                'status': doc.get('status'),
+                'authors': [authors[a] for a in doc.get('authors', [])
+                    if a in authors],
+                'isbn': doc.get('isbn'),
+                'publication_year': doc.get('publication_year'),
+                'campus_location': _name(campus_locations,
+                    doc.get('campus_location')),
+                'price': doc.get('price'),
+                'price_currency': _name(currencies, doc.get('price_currency')),
+                'receipt_date': receipt_date.isoformat()
+                    if isinstance(receipt_date, datetime) else None,
+                'source': doc.get('source'),
+            }
+
+def csv_chunks(rows, chunk_rows=500):
+    '''Yields the rows as CSV text, a chunk of rows at a time'''
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(FIELDS)
+    for i, row in enumerate(rows, 1):
+        values = []
+        for f in FIELDS:
+            value = row[f]
+            if isinstance(value, list):
+                value = '; '.join(value)
+            values.append(unicode(value if value is not None else '')
+                .encode('utf-8'))
+        writer.writerow(values)
+        if i % chunk_rows == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def jsonl_chunks(rows, chunk_rows=500):
+    '''Yields the rows as JSON Lines, a chunk of rows at a time'''
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row))
+        if len(lines) >= chunk_rows:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+FORMATS = {
+    'csv': (csv_chunks, 'text/csv'),
+    'jsonl': (jsonl_chunks, 'application/x-ndjson'),
+}
+
+def gzip_chunks(chunks, level=6):
+    '''Compresses a stream of chunks into a stream of gzip data'''
+    # 16 + MAX_WBITS gives gzip headers instead of plain zlib ones
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_register(format='csv', gzip=False, batch_size=500):
+    '''
+    Yields the whole register in the given format ("csv" or "jsonl"), as
+    chunks of bytes
+    '''
+    if format not in FORMATS:
+        raise ValueError('Unknown format: %s' % format)
+    chunks = FORMATS[format][0](iter_register(batch_size))
+    if gzip:
+        chunks = gzip_chunks(chunks)
+    return chunks
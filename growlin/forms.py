@@ -12,8 +12,13 @@ class AccessionForm(Form):
 class AccessionTypeForm(Form):
     accession = TextField('Accession',
         validators=[validators.DataRequired()])
-    item_type=SelectField('Item type',
-        choices=[(i,i) for i in get_item_types()])
+    item_type=SelectField('Item type')
+
+    def __init__(self, *args, **kwargs):
+        super(AccessionTypeForm, self).__init__(*args, **kwargs)
+        # Set for each form, so that new item types show up without a restart
+        self.item_type.choices = [(i,i) for i in get_item_types()]
+
 class AccessionItemForm(Form):
     accession = HiddenField('Accession',
         validators=[validators.DataRequired()])
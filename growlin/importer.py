@@ -0,0 +1,478 @@
+'''
+Bulk import of books into the catalogue, eg. from the old Merlin system.
+
+Records are read as a stream (CSV, or MARC if pymarc is installed) and
+written in batches. For each batch:
+
+ * the names of creators, publishers, places and campus locations are
+   resolved to ids with one $in query per master, and missing ones are
+   created with one insert_many. Ids are remembered for the whole import.
+ * the accession counter is moved past the accessions given in the rows,
+   and the rows without one get numbers reserved in one go.
+ * the BookItems are validated one by one, then written with a single
+   unordered insert_many, so one bad row does not hold up the others.
+ * the use counts of the masters the new items refer to (see
+   autocomplete.py) are bumped with one bulk $inc per master, since
+   insert_many skips the signal that keeps them otherwise.
+
+Rows that cannot be imported are reported with their line (or record)
+number and the reason. Progress is saved to an optional checkpoint file,
+and an interrupted import given the same checkpoint carries on from there.
+Before each batch is written, the checkpoint records the ids and reserved
+accessions given to its rows. If the import is interrupted during the
+write, those rows that made it are skipped on resuming, and the others are
+written with the same id and accession, so no row is imported twice.
+
+ImportJob runs an import in the background from an uploaded file, for the
+admin, and can resume one cut short by a restart.
+
+Since an accession in a row may already have been given to an earlier row
+without one (and is then rejected as a duplicate), import files with
+accessions before those without.
+'''
+import csv
+import json
+import os
+import re
+import threading
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from mongoengine import ValidationError
+from .models import (BookItem, Creator, Publisher, PublishPlace,
+    CampusLocation, campus_locations, name_keys)
+from .accession import reserve_accessions, advance_counter, prefix_for_item_class
+from .autocomplete import count_bulk_uses
+
+try:
+    import pymarc
+except ImportError:
+    pymarc = None
+
+# Columns understood in CSV files. Columns holding lists take several
+# values separated by semicolons.
+COLUMNS = ('accession', 'title', 'subtitle', 'authors', 'editors',
+    'illustrators', 'publisher', 'publish_place', 'publication_year',
+    'isbn', 'call_nos', 'keywords', 'campus_location', 'price', 'source',
+    'receipt_date', 'comments')
+LIST_COLUMNS = ('authors', 'editors', 'illustrators', 'call_nos', 'keywords')
+
+# Master collection for each column naming one
+MASTERS = {
+    'authors': Creator,
+    'editors': Creator,
+    'illustrators': Creator,
+    'publisher': Publisher,
+    'publish_place': PublishPlace,
+    'campus_location': CampusLocation,
+}
+
+class RowError(Exception):
+    '''Raised for a row that cannot be imported'''
+    pass
+
+def read_csv(stream):
+    '''
+    Yields (line number, row) pairs from a CSV file with a header row. Rows
+    are dicts of unicode values, with list columns split into lists.
+    '''
+    reader = csv.DictReader(stream)
+    for row in reader:
+        record = {}
+        for column, value in row.items():
+            if column is None:
+                continue
+            column = column.strip().lower()
+            value = (value or '').decode('utf-8').strip()
+            if column in LIST_COLUMNS:
+                value = [v.strip() for v in value.split(';') if v.strip()]
+            record[column] = value
+        yield reader.line_num, record
+
+def _subfields(record, tag, code):
+    return [v.strip(' /:;,.') for f in record.get_fields(tag)
+        for v in f.get_subfields(code)]
+
+def read_marc(stream):
+    '''
+    Yields (record number, row) pairs from a file of MARC21 records, with
+    the same keys as CSV rows. Needs pymarc.
+    '''
+    if pymarc is None:
+        raise ValueError('Reading MARC records needs pymarc to be installed')
+    for number, record in enumerate(pymarc.MARCReader(stream,
+            to_unicode=True, force_utf8=True), 1):
+        if record is None:
+            continue
+        first = lambda tag, code: (_subfields(record, tag, code) or [u''])[0]
+        yield number, {
+            # Merlin keeps the accession as the item barcode
+            'accession': first('852', 'p'),
+            'title': first('245', 'a'),
+            'subtitle': first('245', 'b'),
+            'authors': _subfields(record, '100', 'a') + _subfields(record, '700', 'a'),
+            'publisher': first('260', 'b'),
+            'publish_place': first('260', 'a'),
+            'publication_year': ''.join(c for c in first('260', 'c') if c.isdigit())[:4],
+            'isbn': first('020', 'a').split(' ')[0],
+            'call_nos': _subfields(record, '082', 'a'),
+            'keywords': _subfields(record, '650', 'a'),
+        }
+
+READERS = {
+    'csv': read_csv,
+    'marc': read_marc,
+}
+
+class MasterCache(object):
+    '''
+    Maps names to ids for one master collection (Creator, Publisher...),
+    looking up and creating names in bulk.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.ids = {}
+
+    def resolve(self, names):
+        '''
+        Makes sure all the names have an id, with at most three queries.
+        Returns the names that had to be created.
+        '''
+        missing = list(set(n for n in names if n and n not in self.ids))
+        if not missing:
+            return []
+        collection = self.model._get_collection()
+        self._find(collection, missing)
+        new = [n for n in missing if n not in self.ids]
+        if new:
+            try:
+                result = collection.insert_many([
+                    {'name': n, 'name_keys': name_keys(n)} for n in new],
+                    ordered=False)
+                self.ids.update(zip(new, result.inserted_ids))
+            except BulkWriteError:
+                # Some were created by someone else meanwhile
+                self._find(collection, new)
+        return new
+
+    def _find(self, collection, names):
+        for doc in collection.find({'name': {'$in': names}}, {'name': True}):
+            self.ids[doc['name']] = doc['_id']
+
+    def get(self, name):
+        return self.ids.get(name)
+
+class ImportResult(object):
+    '''
+    Progress of an import: rows imported, errors and the last row done, and
+    the id and reserved accession (or None) given to each row of the batch
+    being written, by position
+    '''
+    def __init__(self, imported=0, errors=None, position=0, pending=None):
+        self.imported = imported
+        self.errors = errors or []
+        self.position = position
+        self.pending = pending or {}
+
+    def error(self, position, message):
+        self.errors.append((position, message))
+
+def load_checkpoint(path):
+    '''Returns the ImportResult saved in a checkpoint file, if any'''
+    if not path or not os.path.exists(path):
+        return ImportResult()
+    with open(path) as f:
+        data = json.load(f)
+    return ImportResult(data['imported'], [tuple(e) for e in data['errors']],
+        data['position'], dict((int(position), (ObjectId(id), accession))
+            for position, (id, accession) in data.get('pending', {}).items()))
+
+def save_checkpoint(path, result):
+    # Write to a temporary file first, so that a crash never leaves a
+    # half-written checkpoint
+    with open(path + '.tmp', 'w') as f:
+        json.dump({
+            'imported': result.imported,
+            'errors': result.errors,
+            'position': result.position,
+            'pending': dict((position, (str(id), accession))
+                for position, (id, accession) in result.pending.items()),
+        }, f)
+    os.rename(path + '.tmp', path)
+
+class Importer(object):
+    '''
+    Imports rows (as given by read_csv or read_marc) as BookItems. Items
+    without a campus location get the default one, if given.
+    '''
+    def __init__(self, default_location=None, batch_size=500):
+        self.default_location = default_location
+        self.batch_size = batch_size
+        self.masters = dict((model, MasterCache(model))
+            for model in set(MASTERS.values()))
+        self.prefix = prefix_for_item_class('book')
+
+    def run(self, rows, checkpoint=None, progress=None):
+        '''
+        Imports the rows in batches, skipping those already done according
+        to the checkpoint file. Calls progress(result) after each batch and
+        returns the ImportResult.
+        '''
+        result = load_checkpoint(checkpoint)
+        batch = []
+        for position, row in rows:
+            if position <= result.position:
+                continue
+            batch.append((position, row))
+            if len(batch) >= self.batch_size:
+                self._import_batch(batch, result, checkpoint, progress)
+                batch = []
+        if batch:
+            self._import_batch(batch, result, checkpoint, progress)
+        return result
+
+    def _import_batch(self, batch, result, checkpoint, progress):
+        collection = BookItem._get_collection()
+        last = batch[-1][0]
+        pending = result.pending
+        if pending:
+            # Written before the import was interrupted, and not counted
+            # yet unless it stopped right between counting and checkpointing
+            written = list(collection.find({'_id': {'$in':
+                [id for id, accession in pending.values()]}}))
+            count_bulk_uses(BookItem, written)
+            written = set(d['_id'] for d in written)
+            done = [p for p, (id, accession) in pending.items()
+                if id in written]
+            result.imported += len(done)
+            batch = [(p, row) for p, row in batch if p not in done]
+            for p, row in batch:
+                if p in pending and pending[p][1]:
+                    row['accession'] = pending[p][1]
+
+        rows = [row for position, row in batch]
+        self._resolve_masters(rows)
+        accessions = iter(self._reserve_accessions(rows))
+
+        documents = []
+        positions = []
+        result.pending = {}
+        for position, row in batch:
+            reserved = not row.get('accession')
+            try:
+                item = self._make_item(row, accessions)
+                item.validate()
+            except (RowError, ValidationError), e:
+                result.error(position, unicode(e))
+                continue
+            document = item.to_mongo()
+            document['_id'] = pending[position][0] if position in pending \
+                else ObjectId()
+            documents.append(document)
+            positions.append(position)
+            # Reserved accessions must be given again if the write is redone
+            keep = reserved or (position in pending and pending[position][1])
+            result.pending[position] = (document['_id'],
+                item.accession if keep else None)
+
+        if documents:
+            if checkpoint:
+                save_checkpoint(checkpoint, result)
+            failed = set()
+            try:
+                collection.insert_many(documents, ordered=False)
+            except BulkWriteError, e:
+                for error in e.details['writeErrors']:
+                    result.error(positions[error['index']], error['errmsg'])
+                    failed.add(error['index'])
+            inserted = [d for i, d in enumerate(documents) if i not in failed]
+            count_bulk_uses(BookItem, inserted)
+            result.imported += len(inserted)
+
+        result.pending = {}
+        result.position = last
+        if checkpoint:
+            save_checkpoint(checkpoint, result)
+        if progress is not None:
+            progress(result)
+
+    def _reserve_accessions(self, rows):
+        '''Returns new accessions for the rows without one'''
+        numbers = []
+        for row in rows:
+            prefix, _, number = row.get('accession', '').rpartition(':')
+            if prefix == self.prefix and number.isdigit():
+                numbers.append(int(number))
+        if numbers:
+            advance_counter(max(numbers), self.prefix)
+        unnumbered = len([1 for row in rows if not row.get('accession')])
+        if not unnumbered:
+            return []
+        return reserve_accessions(unnumbered, self.prefix)
+
+    def _resolve_masters(self, rows):
+        names = {}
+        for row in rows:
+            if not row.get('campus_location') and self.default_location:
+                row['campus_location'] = self.default_location
+            for column, model in MASTERS.items():
+                value = row.get(column)
+                if value:
+                    names.setdefault(model, []).extend(
+                        value if column in LIST_COLUMNS else [value])
+        for model, model_names in names.items():
+            created = self.masters[model].resolve(model_names)
+            if created and model is CampusLocation:
+                # Created without going through mongoengine, so no signal
+                campus_locations.invalidate()
+
+    def _ref(self, column, name):
+        id = self.masters[MASTERS[column]].get(name)
+        return MASTERS[column](id=id, name=name) if id else None
+
+    def _make_item(self, row, accessions):
+        if not row.get('title'):
+            raise RowError('No title')
+        item = BookItem(
+            accession=row.get('accession') or next(accessions),
+            title=row['title'],
+            subtitle=row.get('subtitle') or None,
+            keywords=row.get('keywords', []),
+            comments=row.get('comments') or None,
+            source=row.get('source') or None,
+            call_nos=row.get('call_nos', []),
+            isbn=row.get('isbn') or None,
+            campus_location=self._ref('campus_location',
+                row.get('campus_location')),
+            publication_publisher=self._ref('publisher', row.get('publisher')),
+            publication_place=self._ref('publish_place',
+                row.get('publish_place')),
+        )
+        for column in ('authors', 'editors', 'illustrators'):
+            setattr(item, column,
+                [self._ref(column, n) for n in row.get(column, [])])
+        if item.campus_location is None:
+            raise RowError('No campus location')
+        try:
+            if row.get('publication_year'):
+                item.publication_year = int(row['publication_year'])
+            if row.get('price'):
+                item.price = Decimal(row['price'])
+            if row.get('receipt_date'):
+                item.receipt_date = datetime.strptime(row['receipt_date'],
+                    '%Y-%m-%d')
+        except (ValueError, InvalidOperation), e:
+            raise RowError('Invalid value: %s' % e)
+        return item
+
+def import_items(stream, format='csv', checkpoint=None, progress=None, **kwargs):
+    '''
+    Imports the books in a CSV or MARC file. Other keyword arguments are
+    passed on to Importer. Returns the ImportResult.
+    '''
+    if format not in READERS:
+        raise ValueError('Unknown format: %s' % format)
+    importer = Importer(**kwargs)
+    return importer.run(READERS[format](stream), checkpoint, progress)
+
+_running = set()
+_running_lock = threading.Lock()
+_JOB_NAME = re.compile(r'^[\w-]+$')
+
+class ImportJob(object):
+    '''
+    An import run in the background from an uploaded file, which is kept in
+    "directory" along with a description of the job, its checkpoint and,
+    once it has finished, a marker. A job stopped before finishing (eg. by
+    a restart) carries on from its checkpoint when started again.
+    '''
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self._base = os.path.join(directory, name)
+        with open(self._base + '.json') as f:
+            self.info = json.load(f)
+
+    @classmethod
+    def create(cls, directory, stream, filename, format='csv',
+            default_location=None):
+        '''Saves an uploaded file as a new job, which is not started yet'''
+        if format not in READERS:
+            raise ValueError('Unknown format: %s' % format)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        now = datetime.now()
+        name = '%s-%s' % (now.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+        base = os.path.join(directory, name)
+        with open(base + '.data', 'wb') as f:
+            for chunk in iter(lambda: stream.read(64 * 1024), b''):
+                f.write(chunk)
+        with open(base + '.json', 'w') as f:
+            json.dump({'filename': filename, 'format': format,
+                'default_location': default_location,
+                'created': now.isoformat()}, f)
+        return cls(directory, name)
+
+    @classmethod
+    def get(cls, directory, name):
+        '''Returns a job by name, raising KeyError if there is none'''
+        if not _JOB_NAME.match(name) or \
+                not os.path.exists(os.path.join(directory, name + '.json')):
+            raise KeyError(name)
+        return cls(directory, name)
+
+    @classmethod
+    def all(cls, directory):
+        '''Returns the jobs in a directory, newest first'''
+        if not os.path.isdir(directory):
+            return []
+        return [cls(directory, f[:-len('.json')]) for f in
+            sorted(os.listdir(directory), reverse=True) if f.endswith('.json')]
+
+    @property
+    def running(self):
+        return self._base in _running
+
+    @property
+    def finished(self):
+        return os.path.exists(self._base + '.done')
+
+    @property
+    def failure(self):
+        '''Why the job stopped with an exception, if it did'''
+        if os.path.exists(self._base + '.failed'):
+            with open(self._base + '.failed') as f:
+                return f.read()
+
+    def result(self):
+        return load_checkpoint(self._base + '.checkpoint')
+
+    def start(self):
+        '''Starts (or resumes) the job in a thread, unless it is done or running'''
+        with _running_lock:
+            if self.finished or self._base in _running:
+                return False
+            _running.add(self._base)
+        thread = threading.Thread(target=self.run,
+            name='import-%s' % self.name)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def run(self):
+        try:
+            if os.path.exists(self._base + '.failed'):
+                os.remove(self._base + '.failed')
+            with open(self._base + '.data', 'rb') as f:
+                import_items(f, self.info['format'],
+                    checkpoint=self._base + '.checkpoint',
+                    default_location=self.info['default_location'])
+            open(self._base + '.done', 'w').close()
+        except Exception, e:
+            with open(self._base + '.failed', 'w') as f:
+                f.write('%s: %s' % (type(e).__name__, e))
+        finally:
+            with _running_lock:
+                _running.discard(self._base)
@@ -0,0 +1,154 @@
+'''
+Index checks for the hottest queries.
+
+Modules register the queries that run on (nearly) every page with the
+hot_query decorator, next to the code running them; HOT_QUERY_MODULES
+lists the modules doing so. The ensure-indexes command builds the indexes
+declared in the models, then explains each hot query and fails if any of
+them falls back to scanning a whole collection (COLLSCAN), so that a
+missing index shows up before it reaches production.
+
+declared_index() makes a rougher check without a server: whether an index
+declared in the model can serve a query's filter or sort at all.
+'''
+from importlib import import_module
+from mongoengine import Document
+from mongoengine.base import _document_registry
+
+# Modules registering hot queries
+HOT_QUERY_MODULES = ('models', 'accession', 'search', 'roster', 'views',
+    'admin')
+
+_hot_queries = []
+
+def hot_query(name):
+    '''
+    Registers a hot query. The decorated function takes no arguments and
+    returns either a QuerySet or a (Document class, pipeline) pair for an
+    aggregation.
+    '''
+    def decorator(f):
+        _hot_queries.append((name, f))
+        return f
+    return decorator
+
+def hot_queries():
+    '''Returns the (name, function) pairs of every hot query'''
+    for module in HOT_QUERY_MODULES:
+        import_module('.' + module, __package__)
+    return list(_hot_queries)
+
+def ensure_all_indexes():
+    '''
+    Creates the declared indexes of every collection. Returns the list of
+    Document classes that were processed.
+    '''
+    models = []
+    for model in _document_registry.values():
+        # Subclasses share their collection (and indexes) with the base class
+        if (issubclass(model, Document) and not model._meta.get('abstract')
+                and '.' not in model._class_name):
+            model.ensure_indexes()
+            models.append(model)
+    return models
+
+def explain(query):
+    '''Returns the explain() output for a hot query'''
+    if isinstance(query, tuple):
+        model, pipeline = query
+        collection = model._get_collection()
+        return collection.database.command('aggregate', collection.name,
+            pipeline=pipeline, explain=True)
+    return query.explain()
+
+def _winning_plans(explained):
+    '''Finds every winning plan in explain() output, however nested'''
+    if isinstance(explained, dict):
+        for key, value in explained.items():
+            if key == 'winningPlan':
+                yield value
+            else:
+                for plan in _winning_plans(value):
+                    yield plan
+    elif isinstance(explained, list):
+        for value in explained:
+            for plan in _winning_plans(value):
+                yield plan
+
+def _stages(plan):
+    '''Lists the stages of a query plan, eg. ['FETCH', 'IXSCAN']'''
+    stages = [plan.get('stage')]
+    children = plan.get('inputStages', [])
+    if 'inputStage' in plan:
+        children = [plan['inputStage']] + children
+    for child in children:
+        stages.extend(_stages(child))
+    return stages
+
+def scan_stages(explained):
+    '''Lists the stages of every winning plan in explain() output'''
+    stages = []
+    for plan in _winning_plans(explained):
+        stages.extend(_stages(plan))
+    return stages
+
+def verify_indexes():
+    '''
+    Explains every hot query. Returns a list of (name, stages, ok) tuples,
+    where ok is False if the query scans a whole collection.
+    '''
+    results = []
+    for name, f in hot_queries():
+        stages = scan_stages(explain(f()))
+        results.append((name, stages, 'COLLSCAN' not in stages))
+    return results
+
+def _filter_fields(query):
+    '''The fields a filter always constrains, through $and and $or'''
+    fields = set(k for k in query if not k.startswith('$'))
+    if '$text' in query:
+        fields.add('$text')
+    for part in query.get('$and', []):
+        fields |= _filter_fields(part)
+    if query.get('$or'):
+        fields |= reduce(set.intersection,
+            [_filter_fields(part) for part in query['$or']])
+    return fields
+
+def declared_index(query):
+    '''
+    Returns the fields of the first index declared for a hot query's model
+    that can serve its filter or its sort, or None. The query is as a hot
+    query function returns it; only a leading $match and $sort count for a
+    pipeline.
+    '''
+    if isinstance(query, tuple):
+        model, pipeline = query
+        stages = list(pipeline[:2])
+        match = stages.pop(0)['$match'] if stages and '$match' in stages[0] \
+            else {}
+        sort = stages[0]['$sort'].keys() if stages and '$sort' in stages[0] \
+            else []
+    else:
+        model = query._document
+        match = query._query
+        sort = [key for key, direction in query._ordering or []]
+    fields = _filter_fields(match)
+    for spec in model._meta['index_specs'] + [{'fields': [('_id', 1)]}]:
+        keys = spec['fields']
+        if keys[0][1] == 'text':
+            if '$text' in fields:
+                return keys
+            continue
+        names = [key for key, direction in keys]
+        if names[0] == '_cls' and '_cls' in fields:
+            # Every query on a subclass filters on _cls, so the index only
+            # helps a query on nothing else, or through its next field
+            if len(fields) == 1:
+                return keys
+            names = names[1:]
+            if not names:
+                continue
+        if names[0] in fields or (sort and names[0] == sort[0]):
+            return keys
+    return None
@@ -0,0 +1,418 @@
+'''
+Circulation journal.
+
+Normally every borrow and return is written to MongoDB while the kiosk
+waits. With CIRCULATION_JOURNAL set to a file path in the config, they
+are instead appended to that file as JSON lines and the kiosk carries on
+as soon as the line is on disk. A background thread then applies the
+entries to the database, in order, a batch at a time. If the database is
+slow or down, entries simply wait in the journal (and are checked against
+by new borrows and returns) until it is back.
+
+ * Writes use group commit: whoever needs an fsync does one for every
+   line written so far, and the others waiting meanwhile share it, so a
+   busy desk does not cost one fsync per scan.
+ * The sequence number of the last entry applied is kept next to the
+   journal (in "<path>.applied"). On restart the entries after it are
+   applied again, in the same order, with the dates recorded at the kiosk.
+   Applying an entry twice does nothing the second time, so a crash
+   between applying and saving the position is harmless.
+ * Entries that cannot be applied (eg. the item was borrowed at another
+   desk meanwhile) become JournalConflicts for an admin to review.
+ * Once everything is applied the journal is emptied, so it does not grow.
+
+Item lookups still read the database; only the writes are journalled. A
+journal file belongs to a single process, which locks it. With several
+server processes, each takes the first free one of CIRCULATION_JOURNAL,
+"<path>.1", "<path>.2" and so on (CIRCULATION_JOURNAL_SLOTS of them, default
+8), and so picks up whatever a stopped process left there. A process
+finding none free writes to the database directly.
+'''
+import fcntl
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+from pymongo.errors import PyMongoError
+from .app import app
+from .models import (Item, User, BorrowPast, JournalConflict, BorrowError,
+    AlreadyBorrowed, AccessionMismatch)
+
+_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+class JournalInUse(ValueError):
+    '''Raised when opening a journal file that another process has locked'''
+
+def _now():
+    # MongoDB keeps dates to the millisecond, so entries do as well, which
+    # lets applied entries be recognised by their date
+    now = datetime.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+class Journal(object):
+    '''
+    An append-only file of borrow and return entries, and the thread
+    applying them to the database.
+    '''
+    def __init__(self, path, batch_size=100, interval=1.0, retry_interval=5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._apply_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+        self._file = open(path, 'a+b')
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._file.close()
+            raise JournalInUse('Journal %s is in use by another process' % path)
+        self._applied = self._load_applied()
+        self._pending = [e for e in self._read() if e['seq'] > self._applied]
+        self._next_seq = max([self._applied] +
+            [e['seq'] for e in self._pending]) + 1
+        self._durable = self._next_seq - 1
+        self._syncing = False
+
+    def _load_applied(self):
+        try:
+            with open(self.path + '.applied') as f:
+                return int(f.read().strip() or 0)
+        except IOError:
+            return 0
+
+    def _save_applied(self, seq):
+        # Write to a temporary file first, so that a crash never leaves a
+        # half-written position
+        with open(self.path + '.applied.tmp', 'w') as f:
+            f.write('%d\n' % seq)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.path + '.applied.tmp', self.path + '.applied')
+
+    def _read(self):
+        '''Reads the entries in the file, dropping a half-written last line'''
+        self._file.seek(0)
+        entries = []
+        good = 0
+        for line in self._file:
+            if not line.endswith('\n'):
+                break
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break
+            good += len(line)
+        self._file.truncate(good)
+        self._file.seek(0, os.SEEK_END)
+        return entries
+
+    def append(self, entries, checks=None):
+        '''
+        Adds entries to the journal, returning once they are safely on disk.
+        Each entry gets a sequence number and an id.
+
+        Each entry may come with a check (in a list of the same length),
+        called with what the journal says about the entry's item (see
+        pending_loan) just before it is added. An entry whose check raises
+        a BorrowError is left out. Returns a list of those errors (None for
+        the entries added).
+        '''
+        errors = [None] * len(entries)
+        with self._lock:
+            for i, entry in enumerate(entries):
+                if checks and checks[i]:
+                    try:
+                        checks[i](self._pending_loan(entry['item']))
+                    except BorrowError, e:
+                        errors[i] = e
+                        continue
+                entry['seq'] = self._next_seq
+                entry['id'] = uuid.uuid4().hex
+                self._next_seq += 1
+                self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+                self._pending.append(entry)
+            self._file.flush()
+            last = self._next_seq - 1
+            while self._durable < last:
+                if self._syncing:
+                    # Someone else's fsync may cover ours as well
+                    self._synced.wait()
+                    continue
+                self._syncing = True
+                written = self._next_seq - 1
+                self._lock.release()
+                try:
+                    os.fsync(self._file.fileno())
+                finally:
+                    self._lock.acquire()
+                    self._syncing = False
+                    self._synced.notify_all()
+                self._durable = max(self._durable, written)
+        self._wake.set()
+        return errors
+
+    def pending(self):
+        '''Returns the entries not applied yet, oldest first'''
+        with self._lock:
+            return list(self._pending)
+
+    def pending_loan(self, item_id):
+        '''
+        Returns what the journal says about an item that is not in the
+        database yet: None if nothing, otherwise the id of the user who has
+        it out, or False if it was returned.
+        '''
+        with self._lock:
+            return self._pending_loan(str(item_id))
+
+    def _pending_loan(self, item_id):
+        loan = None
+        for entry in self._pending:
+            if entry['item'] == item_id:
+                loan = entry['user'] if entry['action'] == 'borrow' else False
+        return loan
+
+    def flush(self):
+        '''
+        Applies the pending entries to the database, a batch at a time.
+        Stops at the first entry the database cannot be reached for, which
+        is tried again next time. Returns the number of entries applied.
+        '''
+        applied = 0
+        with self._apply_lock:
+            while True:
+                batch = self.pending()[:self.batch_size]
+                if not batch:
+                    break
+                done = 0
+                try:
+                    for entry in batch:
+                        apply_entry(entry)
+                        done += 1
+                finally:
+                    if done:
+                        self._save_applied(batch[done - 1]['seq'])
+                        with self._lock:
+                            del self._pending[:done]
+                            self._applied = batch[done - 1]['seq']
+                        applied += done
+            self._compact()
+        return applied
+
+    def _compact(self):
+        # Empty the file once everything in it is applied
+        with self._lock:
+            if not self._pending and self._file.tell():
+                self._file.truncate(0)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def start(self):
+        '''Starts the thread applying entries in the background'''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                name='circulation-journal')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except PyMongoError, e:
+                app.logger.warning('Circulation journal: database '
+                    'unavailable (%s), trying again in %ss', e,
+                    self.retry_interval)
+                self._wake.wait(self.retry_interval)
+            except Exception:
+                app.logger.exception('Circulation journal: flush failed')
+                self._wake.wait(self.retry_interval)
+
+def _entry_date(entry):
+    return datetime.strptime(entry['date'], _DATE_FORMAT)
+
+def apply_entry(entry):
+    '''
+    Applies a journal entry to the database, unless it has been already.
+    Entries that cannot be applied are recorded as JournalConflicts. Only
+    database errors are raised, so that the entry is tried again later.
+    '''
+    try:
+        _apply_entry(entry)
+    except PyMongoError:
+        raise
+    except Exception, e:
+        # Trying again would fail the same way, and hold up the entries
+        # after it
+        app.logger.exception('Circulation journal: could not apply %s',
+            entry.get('id'))
+        _conflict(entry, None, None, 'Could not be applied: %s' % e)
+
+def _apply_entry(entry):
+    date = _entry_date(entry)
+    user = User.objects(id=entry['user']).first()
+    item = Item.objects(id=entry['item']).first()
+    if user is None or item is None:
+        return _conflict(entry, user, item, 'The user or item no longer exists')
+    try:
+        if entry['action'] == 'borrow':
+            b = item.borrow_current
+            if (b is not None and b._data.get('user') is not None
+                    and b._data['user'].id == user.id and b.borrow_date == date):
+                return
+            # Or applied and since returned, eg. by a later entry
+            if BorrowPast.objects(item=item, user=user,
+                    borrow_date=date).only('id').first():
+                return
+            user.borrow(item, longterm=entry.get('longterm', False), date=date)
+        else:
+            if BorrowPast.objects(item=item, user=user,
+                    return_date=date).only('id').first():
+                return
+            user.unborrow(item, date=date)
+    except BorrowError, e:
+        _conflict(entry, user, item, e.message)
+
+def _conflict(entry, user, item, error):
+    try:
+        date = _entry_date(entry)
+    except (KeyError, TypeError, ValueError):
+        date = None
+    # Keyed by the entry, so that applying it again adds nothing
+    JournalConflict.objects(entry_id=entry['id']).update_one(upsert=True,
+        set__action=entry.get('action'),
+        set__user=user,
+        set__item=item,
+        set__date=date,
+        set__error=error,
+        set_on_insert__created=datetime.now(),
+        set_on_insert__resolved=False)
+
+def journal_paths(path, slots=8):
+    '''Returns the journal files for up to "slots" processes'''
+    return [path] + ['%s.%d' % (path, n) for n in range(1, slots)]
+
+def open_journal(path, slots=8, **kwargs):
+    '''
+    Opens the first of the journal files (see journal_paths) not in use by
+    another process. Returns None if they all are.
+    '''
+    for p in journal_paths(path, slots):
+        try:
+            return Journal(p, **kwargs)
+        except JournalInUse:
+            continue
+    return None
+
+_journal = None
+_journal_opened = False
+_journal_lock = threading.Lock()
+
+def get_journal():
+    '''
+    Returns this process's journal (see open_journal), with its thread
+    running, or None if CIRCULATION_JOURNAL is not set or every journal
+    file is in use
+    '''
+    global _journal, _journal_opened
+    path = app.config.get('CIRCULATION_JOURNAL')
+    if not path:
+        return None
+    with _journal_lock:
+        if not _journal_opened:
+            _journal_opened = True
+            _journal = open_journal(path,
+                app.config.get('CIRCULATION_JOURNAL_SLOTS', 8),
+                batch_size=app.config.get('CIRCULATION_JOURNAL_BATCH', 100))
+            if _journal is None:
+                app.logger.warning('Circulation journal: every journal file '
+                    'is in use, writing to the database directly')
+            else:
+                _journal.start()
+    return _journal
+
+@app.before_first_request
+def _start_journal():
+    # Entries left from before a restart are applied straight away
+    get_journal()
+
+# The functions below are used by the views instead of User.borrow() and
+# the like. Without a journal, they just call those.
+
+def _entry(action, user, item, date, **kwargs):
+    return dict(kwargs, action=action, user=str(user.id), item=str(item.id),
+        date=date.strftime(_DATE_FORMAT))
+
+def _borrow_check(user, item):
+    def check(loan):
+        if loan or (loan is None and item.borrow_current is not None):
+            raise AlreadyBorrowed('"%(title)s" is already borrowed!' %
+                {'title': item.get_display_title()})
+    return check
+
+def _return_check(user, item):
+    def check(loan):
+        if loan is None:
+            b = item.borrow_current
+            loan = b and b._data.get('user') and str(b._data['user'].id)
+        if loan != str(user.id):
+            raise BorrowError('You have not borrowed that item')
+    return check
+
+def _append(journal, action, make_check, user, items, **kwargs):
+    # All the entries are written with a single fsync
+    date = _now()
+    return journal.append(
+        [_entry(action, user, item, date, **kwargs) for item in items],
+        [make_check(user, item) for item in items])
+
+def borrow(user, item, accession=None, longterm=False):
+    '''Borrows an item, through the journal if there is one'''
+    journal = get_journal()
+    if journal is None:
+        return user.borrow(item, accession, longterm)
+    if accession is not None and not item.matches_accession(accession):
+        raise AccessionMismatch('Accession numbers do not match')
+    error = _append(journal, 'borrow', _borrow_check, user, [item],
+        longterm=longterm)[0]
+    if error is not None:
+        raise error
+    return item
+
+def unborrow(user, item, accession=None):
+    '''Returns an item, through the journal if there is one'''
+    journal = get_journal()
+    if journal is None:
+        return user.unborrow(item, accession)
+    if accession is not None and not item.matches_accession(accession):
+        raise AccessionMismatch('Accession numbers do not match')
+    error = _append(journal, 'return', _return_check, user, [item])[0]
+    if error is not None:
+        raise error
+
+def borrow_many(user, items, longterm=False):
+    '''Like User.borrow_many(), through the journal if there is one'''
+    journal = get_journal()
+    if journal is None:
+        return user.borrow_many(items, longterm)
+    return _append(journal, 'borrow', _borrow_check, user, items,
+        longterm=longterm)
+
+def unborrow_many(user, items):
+    '''
+    Like User.unborrow_many(), through the journal if there is one. Items
+    returned through the journal have no BorrowPast record yet, so they
+    give None instead.
+    '''
+    journal = get_journal()
+    if journal is None:
+        return user.unborrow_many(items)
+    return _append(journal, 'return', _return_check, user, items)
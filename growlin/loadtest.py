@@ -0,0 +1,319 @@
+'''
+HTTP load testing.
+
+Many simulated users work through a trace of kiosk sessions at once: each
+session logs in, looks at the shelf, borrows and returns items through the
+same forms (and CSRF tokens) as a person would, looks at the history and,
+for admins, the registry. Requests go either to a running server (to size
+its workers) or straight to the WSGI app in this process.
+
+Traces are lists of sessions, made up (synthetic_trace) or taken from the
+borrowing history (history_trace), and can be saved as JSON to replay the
+same load later. Borrowing and returning changes the data, so run this
+against a test database (see seed.py).
+
+The report gives throughput, and latency percentiles and errors for each
+route, eg. "POST /shelf/borrow/".
+'''
+import cookielib
+import json
+import random
+import re
+import threading
+import urllib
+import urllib2
+from Queue import Queue, Empty
+from timeit import default_timer
+from werkzeug.exceptions import HTTPException
+from .app import app
+from .models import User, UserRole, Item, BorrowPast
+from .benchmark import percentile
+
+# Admin list views visited in admin sessions
+ADMIN_PATHS = ('/admin/', '/admin/item/', '/admin/bookitem/',
+    '/admin/borrowpast/')
+
+_CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]*)"')
+_CONFIRM_ITEM = re.compile(r'name="item" type="hidden" value="([^"]*)"')
+_CONFIRM_ACCESSION = re.compile(
+    r'name="accession" type="hidden" value="([^"]*)"')
+
+class WSGISession(object):
+    '''A user's session with the WSGI app in this process'''
+    def __init__(self, application=app):
+        self.client = application.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.get_data()
+
+class _NoRedirect(urllib2.HTTPRedirectHandler):
+    # Redirects are requests of their own, timed separately
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class HTTPSession(object):
+    '''A user's session with a server, eg. "http://localhost:5000"'''
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.urlencode(data) if data is not None else None
+        request = urllib2.Request(self.base_url + path, body)
+        request.get_method = lambda: method
+        try:
+            response = self.opener.open(request, timeout=self.timeout)
+            return response.getcode(), response.read()
+        except urllib2.HTTPError, e:
+            return e.code, e.read()
+
+def route_name(method, path):
+    '''Returns the route a request goes to, eg. "GET /shelf/<borrowid>/return/"'''
+    adapter = app.url_map.bind('localhost')
+    try:
+        rule, args = adapter.match(path.split('?')[0], method, return_rule=True)
+        return '%s %s' % (method, rule.rule)
+    except HTTPException:
+        return '%s %s' % (method, path)
+
+class Report(object):
+    '''Timings of requests by route, and outcomes of actions'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+        self.actions = {}
+        self.started = default_timer()
+        self.finished = None
+
+    def request(self, route, seconds, ok):
+        with self._lock:
+            times, errors = self.routes.setdefault(route, ([], [0]))
+            times.append(seconds * 1000)
+            if not ok:
+                errors[0] += 1
+
+    def action(self, name, ok):
+        with self._lock:
+            counts = self.actions.setdefault(name, {'ok': 0, 'failed': 0})
+            counts['ok' if ok else 'failed'] += 1
+
+    def finish(self):
+        self.finished = default_timer()
+
+    def summary(self):
+        '''Returns the report as a dict, ready to be written as JSON'''
+        elapsed = (self.finished or default_timer()) - self.started
+        routes = {}
+        for route, (times, errors) in self.routes.items():
+            routes[route] = {
+                'requests': len(times),
+                'errors': errors[0],
+                'per_second': len(times) / elapsed,
+                'p50_ms': percentile(times, 50),
+                'p90_ms': percentile(times, 90),
+                'p99_ms': percentile(times, 99),
+                'max_ms': max(times),
+            }
+        requests = sum(r['requests'] for r in routes.values())
+        return {
+            'elapsed': elapsed,
+            'requests': requests,
+            'per_second': requests / elapsed if elapsed else 0,
+            'errors': sum(r['errors'] for r in routes.values()),
+            'routes': routes,
+            'actions': self.actions,
+        }
+
+class VirtualUser(object):
+    '''Works through sessions of a trace, one request at a time'''
+    def __init__(self, make_session, report, think=0.0, random_seed=None):
+        self.make_session = make_session
+        self.report = report
+        self.think = think
+        self.random = random.Random(random_seed)
+
+    def fetch(self, method, path, data=None, expect=(200, 302)):
+        start = default_timer()
+        try:
+            status, body = self.session.request(method, path, data)
+        except Exception:
+            status, body = None, ''
+        self.report.request(route_name(method, path),
+            default_timer() - start, status in expect)
+        return status, body
+
+    def _token(self, body):
+        match = _CSRF_TOKEN.search(body)
+        return match.group(1) if match else ''
+
+    def run(self, session):
+        self.session = self.make_session()
+        status, body = self.fetch('GET', '/login/')
+        status, body = self.fetch('POST', '/login/', {
+            'csrf_token': self._token(body),
+            'username': session['user'],
+            'password': session.get('password', '')})
+        self.report.action('login', status == 302)
+        if status != 302:
+            return
+        for action in session['actions']:
+            if self.think:
+                threading.Event().wait(self.random.uniform(0, self.think))
+            getattr(self, '_' + action[0])(*action[1:])
+        self.fetch('GET', '/logout/')
+
+    def _shelf(self):
+        self.fetch('GET', '/shelf/')
+
+    def _history(self):
+        self.fetch('GET', '/shelf/history/')
+
+    def _admin(self, path):
+        self.fetch('GET', path)
+
+    def _borrow(self, item_type, accession):
+        status, body = self.fetch('GET', '/shelf/borrow/')
+        status, body = self.fetch('POST', '/shelf/borrow/', {
+            'csrf_token': self._token(body),
+            'item_type': item_type,
+            'accession': accession})
+        confirm = _CONFIRM_ITEM.search(body)
+        if confirm is None:
+            # Not found, or already borrowed by someone else
+            self.report.action('borrow', False)
+            return
+        confirm_accession = _CONFIRM_ACCESSION.search(body)
+        status, body = self.fetch('POST', '/shelf/borrow/', {
+            'csrf_token': self._token(body),
+            'item': confirm.group(1),
+            'accession': confirm_accession.group(1) if confirm_accession
+                else accession})
+        self.report.action('borrow', status == 302)
+
+    def _return(self, item_id, accession):
+        path = '/shelf/%s/return/' % item_id
+        status, body = self.fetch('GET', path)
+        if status != 200:
+            # Not borrowed by this user after all
+            self.report.action('return', False)
+            return
+        status, body = self.fetch('POST', path, {
+            'csrf_token': self._token(body),
+            'accession': accession})
+        self.report.action('return', status == 302)
+
+def _admins():
+    role = UserRole.objects(name='admin').first()
+    if role is None:
+        return []
+    return [u.username for u in User.objects(roles=role, active=True)
+        .only('username')]
+
+def _session(user, password, loans, admin=False):
+    '''A session borrowing and then returning the given items'''
+    actions = [('shelf',)]
+    for item in loans:
+        actions.append(('borrow', item.item_class, item.accession))
+        actions.append(('shelf',))
+    actions.append(('history',))
+    if admin:
+        actions.extend(('admin', path) for path in ADMIN_PATHS)
+    for item in loans:
+        actions.append(('return', str(item.id), item.accession))
+    return {'user': user, 'password': password, 'actions': actions}
+
+def synthetic_trace(sessions=100, loans=2, admin_share=0.05, password='pass',
+        random_seed=0):
+    '''
+    Makes up a trace of sessions by random active users, each borrowing
+    and returning a few of the items that are on the shelf
+    '''
+    rng = random.Random(random_seed)
+    users = [u.username for u in User.objects(active=True).only('username')]
+    admins = _admins()
+    free = list(Item.objects(borrow_current__exists=False)
+        .only('id', 'accession').limit(sessions * loans * 2))
+    trace = []
+    for i in range(sessions):
+        admin = bool(admins) and rng.random() < admin_share
+        user = rng.choice(admins if admin else users)
+        picked = [free.pop(rng.randrange(len(free)))
+            for n in range(min(loans, len(free)))]
+        trace.append(_session(user, password, picked, admin))
+    return trace
+
+def history_trace(sessions=100, loans=2, password='pass'):
+    '''
+    Takes a trace from the most recent borrowing history: each session is
+    a user borrowing and returning (up to "loans" of) the items they did,
+    as long as those are on the shelf now
+    '''
+    records = (BorrowPast.objects.order_by('-borrow_date')
+        .only('user', 'item').limit(sessions * loans * 4))
+    by_user = {}
+    order = []
+    for r in records:
+        user_id = r._data['user'].id if r._data.get('user') else None
+        item_id = r._data['item'].id if r._data.get('item') else None
+        if user_id and item_id:
+            if user_id not in by_user:
+                order.append(user_id)
+            by_user.setdefault(user_id, []).append(item_id)
+    usernames = dict((u.id, u.username) for u in
+        User.objects(id__in=order, active=True).only('username'))
+    items = dict((i.id, i) for i in Item.objects(borrow_current__exists=False,
+        id__in=list(set(i for ids in by_user.values() for i in ids)))
+        .only('id', 'accession'))
+    trace = []
+    for user_id in order:
+        loans_now = [items[i] for i in by_user[user_id] if i in items][:loans]
+        if user_id in usernames and loans_now:
+            trace.append(_session(usernames[user_id], password, loans_now))
+        if len(trace) >= sessions:
+            break
+    # Busiest last is not how a day goes
+    trace.reverse()
+    return trace
+
+def run(trace, make_session=WSGISession, concurrency=10, think=0.0,
+        progress=None):
+    '''
+    Replays a trace with "concurrency" users at a time, each taking the
+    next session when done with one. Returns the Report.
+    '''
+    report = Report()
+    queue = Queue()
+    for session in trace:
+        queue.put(session)
+
+    def work(n):
+        user = VirtualUser(make_session, report, think, random_seed=n)
+        while True:
+            try:
+                session = queue.get_nowait()
+            except Empty:
+                return
+            user.run(session)
+            if progress is not None:
+                progress(len(trace) - queue.qsize())
+
+    threads = [threading.Thread(target=work, args=(n,))
+        for n in range(concurrency)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    report.finish()
+    return report
+
+def load_trace(path):
+    with open(path) as f:
+        return json.load(f)
+
+def save_trace(trace, path):
+    with open(path, 'w') as f:
+        json.dump(trace, f, indent=1)
@@ -0,0 +1,106 @@
+'''
+Data migrations for existing databases. Each one works in batches, can be
+interrupted at any point, and picks up where it left off when run again.
+'''
+from pymongo import UpdateOne
+from .models import (Item, User, Creator, BorrowPast, ItemSnapshot,
+    item_class_name, get_due_date)
+
+def backfill_item_snapshots(batch_size=500, progress=None):
+    '''
+    Adds the item snapshot to BorrowPast records made before snapshots were
+    kept. Each batch costs three queries (records, items and authors) and
+    one bulk write.
+
+    Records whose item no longer exists get a placeholder snapshot (see
+    ItemSnapshot.from_item). Returns a (updated, missing) pair: the number
+    of records updated, and how many of those had lost their item.
+    '''
+    records = BorrowPast._get_collection()
+    items = Item._get_collection()
+    creators = Creator._get_collection()
+    updated = missing = 0
+    last_id = None
+    while True:
+        query = {'item_snapshot': {'$exists': False}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = list(records.find(query, {'item': True})
+            .sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]['_id']
+
+        item_ids = list(set(r['item'] for r in batch if r.get('item')))
+        found = dict((i['_id'], i) for i in items.find(
+            {'_id': {'$in': item_ids}},
+            {'accession': True, 'title': True, '_cls': True, 'authors': True}))
+        author_ids = list(set(i['authors'][0] for i in found.values()
+            if i.get('authors')))
+        authors = dict((c['_id'], c['name']) for c in creators.find(
+            {'_id': {'$in': author_ids}}, {'name': True}))
+
+        ops = []
+        for r in batch:
+            item = found.get(r.get('item'))
+            if item is None:
+                missing += 1
+                snapshot = ItemSnapshot.from_item(None).to_mongo()
+            else:
+                snapshot = {
+                    'accession': item.get('accession'),
+                    'title': item.get('title'),
+                    'item_class': item_class_name(item.get('_cls', 'Item')),
+                    'author': authors.get((item.get('authors') or [None])[0]),
+                }
+            ops.append(UpdateOne({'_id': r['_id']},
+                {'$set': {'item_snapshot': snapshot}}))
+        if ops:
+            records.bulk_write(ops, ordered=False)
+            updated += len(ops)
+        if progress is not None:
+            progress(updated, missing)
+    return updated, missing
+
+def backfill_due_dates(batch_size=500, progress=None):
+    '''
+    Sets the due date of loans made before due dates were kept, from the
+    loan policies. Each batch costs two queries (items and borrowers) and
+    one bulk write. Returns the number of loans updated.
+    '''
+    items = Item._get_collection()
+    updated = 0
+    last_id = None
+    while True:
+        query = {
+            'borrow_current.user': {'$exists': True},
+            'borrow_current.due_date': {'$exists': False},
+        }
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = list(items.find(query, {'_cls': True, 'borrow_current': True})
+            .sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]['_id']
+
+        users = dict((u.id, u) for u in User.objects(
+            id__in=list(set(i['borrow_current']['user'] for i in batch)))
+            .only('group'))
+        ops = []
+        for i in batch:
+            b = i['borrow_current']
+            user = users.get(b['user'])
+            if user is None or not b.get('borrow_date'):
+                continue
+            due_date = get_due_date(user, item_class_name(i.get('_cls', 'Item')),
+                b['borrow_date'], b.get('is_longterm', False))
+            if due_date is not None:
+                ops.append(UpdateOne({'_id': i['_id']},
+                    {'$set': {'borrow_current.due_date': due_date}}))
+        if ops:
+            items.bulk_write(ops, ordered=False)
+            updated += len(ops)
+        if progress is not None:
+            progress(updated)
+    return updated
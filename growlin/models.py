@@ -1,7 +1,15 @@
-from .app import db
+from .app import app, db
+from .util.prefetch import PrefetchQuerySet
+from .util.registry import Registry
+from .indexes import hot_query
 
 from flask.ext.login import UserMixin
-from datetime import datetime
+from flask.signals import Namespace
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import UpdateOne
+import re
+import unicodedata
 
 # Some custom errors.
 # TODO: Move to separate file if there are many of them?
@@ -10,9 +18,53 @@ class BorrowError(GrowlinException): pass
 class AlreadyBorrowed(BorrowError): pass
 class AccessionMismatch(BorrowError): pass
 
+# Sent by User.borrow() and User.unborrow() once the change is saved, with
+# the user as sender. See stats.py
+_signals = Namespace()
+item_borrowed = _signals.signal('item_borrowed')
+item_returned = _signals.signal('item_returned')
+
+def _to_millisecond(date):
+    return date.replace(microsecond=date.microsecond // 1000 * 1000)
+
 # Admin masters
 
-class CampusLocation(db.Document):
+_NAME_KEY_SEPARATORS = re.compile(r'[\W_]+', re.UNICODE)
+
+def name_keys(name):
+    '''
+    Returns the keys a name is looked up by while typing: the normalised
+    name (lower case, without accents or punctuation) and each of its
+    endings from a word on, so that "Frank Herbert" is found by "fra" and
+    by "her".
+    '''
+    if not name:
+        return []
+    text = unicodedata.normalize('NFKD', unicode(name))
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    words = _NAME_KEY_SEPARATORS.sub(u' ', text.lower()).split()
+    return [u' '.join(words[i:]) for i in range(len(words))]
+
+class NamedMaster(db.Document):
+    '''
+    Base for masters that are picked by name in the admin forms, which
+    autocomplete on name_keys (see autocomplete.py). "uses" counts the
+    items made with each one, to offer the common ones first.
+    '''
+    name_keys = db.ListField(db.StringField())
+    uses = db.IntField(default=0)
+
+    meta = {
+        'abstract': True,
+        # Prefix lookups, most used first
+        'indexes': [('name_keys', '-uses')],
+        'index_background': True,
+    }
+
+    def clean(self):
+        self.name_keys = name_keys(self.name)
+
+class CampusLocation(NamedMaster):
     name = db.StringField(max_length=128, unique=True)
     # Following field can be enabled later, if required/implemented
     prevent_borrowing = db.BooleanField(default=False)
@@ -41,7 +93,7 @@ class UserRole(db.Document):
     def __unicode__(self):
         return '%(name)s' % {'name': self.name}
 
-class Currency(db.Document):
+class Currency(NamedMaster):
     name = db.StringField(max_length=32, unique=True)
     symbol = db.StringField(max_length=4)  
     def __unicode__(self):
@@ -62,7 +114,12 @@ class User(db.Document, UserMixin):
     roles = db.ListField(db.ReferenceField(UserRole))
 
     meta = {
-        'ordering': ['name']
+        'ordering': ['name'],
+        'indexes': [
+            # Login roster: active users, sorted by name
+            ('active', 'name'),
+        ],
+        'index_background': True,
     }
 
     def __unicode__(self):
@@ -70,39 +127,58 @@ class User(db.Document, UserMixin):
             'name': self.name,
             'group': self.group.name}
 
-    def borrow(self, item, accession=None, longterm=False):
+    def borrow(self, item, accession=None, longterm=False, date=None):
         '''
         Marks an Item as "borrowed" by filling the borrow_current field, after
-        checking for valid accession number.
+        checking for valid accession number. The borrow date is now, unless
+        given (eg. for a loan recorded earlier in the circulation journal).
+
+        The check for the item being free and the update are done together
+        in one atomic operation, so if two people try to borrow the same
+        item at once only one of them will succeed.
 
         This function returns an instance of the borrowed item.
         '''
         # Check arguments
         if not isinstance(item, Item):
             raise TypeError('"item" must be an instance of Item')
-        
-        # Make sure item is not already borrowed
-        if (item.borrow_current is not None) and (item.borrow_current.user is not None):
-            raise AlreadyBorrowed('"%(title)s" is already borrowed!' %
-                {'title': item.get_display_title()})
 
         # Check for accession number mismatch
-        if (accession is not None) and (accession != item.accession):
+        if (accession is not None) and not item.matches_accession(accession):
             raise AccessionMismatch('Accession numbers do not match')
+        now = date or datetime.now()
         b = BorrowCurrent(
             user=self,
-            borrow_date=datetime.now(),
+            user_group=self.group.name,
+            borrow_date=now,
+            due_date=get_due_date(self, item.item_class, now, longterm),
             is_longterm=longterm)
+
+        # Only matches if the item is not already borrowed
+        updated = Item.objects(id=item.id, borrow_current__user=None).only(
+            'id').modify(set__borrow_current=b, inc__borrow_count=1)
+        if updated is None:
+            raise AlreadyBorrowed('"%(title)s" is already borrowed!' %
+                {'title': item.get_display_title()})
+
+        # Bring our copy up to date without marking it as changed
         item.borrow_current = b
-        item.save()
+        item.borrow_count = (item.borrow_count or 0) + 1
+        item._clear_changed_fields()
+        item_borrowed.send(self, item=item, borrow=b)
         return item
 
     # "return" is a reserved word!
-    def unborrow(self, item, accession=None):
+    def unborrow(self, item, accession=None, date=None):
         '''
         Marks an Item as "returned" using the database models, after checking
         for valid accession number. A BorrowError is raised if either the item
         is not borrowed by that user or the accession numbers do not match.
+        The return date is now, unless given.
+
+        The borrow_current field is cleared with one atomic operation that only
+        matches if the item is borrowed by this user, so an item cannot be
+        returned twice.
 
         This function clears the borrow_current field and returns a newly created
         PastBorrowing model instance used to hold historic records.
@@ -111,52 +187,196 @@ class User(db.Document, UserMixin):
         # Check arguments
         if not isinstance(item, Item):
             raise TypeError('"item" must be an instance of Item')
-        # Refresh to get most recent record
-        
-        # Do user check
-        if (item.borrow_current is None) or (item.borrow_current.user is None) or (item.borrow_current.user != self):
-            raise BorrowError('You have not borrowed that item')
 
-        if (accession is not None) and (accession != item.accession):
+        if (accession is not None) and not item.matches_accession(accession):
             raise AccessionMismatch('Accession numbers do not match')
-                
+
+        # Clear the record, getting back the one that was there before
+        record_id = ObjectId()
+        previous = Item.objects(id=item.id, borrow_current__user=self).only(
+            'borrow_current').modify(unset__borrow_current=True,
+                set__last_return=record_id)
+        if previous is None:
+            raise BorrowError('You have not borrowed that item')
+
         p = BorrowPast(
+            id=record_id,
             item=item,
             user=self,
-            user_group=self.group.name,
-            borrow_date = item.borrow_current.borrow_date,
-            return_date = datetime.now()
+            user_group=(previous.borrow_current.user_group or
+                self.group.name),
+            borrow_date = previous.borrow_current.borrow_date,
+            return_date = date or datetime.now(),
+            item_snapshot = ItemSnapshot.from_item(item)
             )
-        item.borrow_current = None
         p.save()
-        item.save()
+        item.borrow_current = None
+        item.last_return = p.id
+        item._clear_changed_fields()
+        item_returned.send(self, item=item, record=p)
         return p
 
+    def borrow_many(self, items, longterm=False):
+        '''
+        Borrows several items at once, with the same rules as borrow() but
+        a single bulk write (and one more read if any of them was taken
+        meanwhile).
+
+        Returns a list with, for each item in turn, None if it was borrowed
+        or the BorrowError that borrow() would have raised.
+        '''
+        # Stored to the millisecond, so compared that way afterwards
+        now = _to_millisecond(datetime.now())
+        errors = [None] * len(items)
+        loans = {}
+        ops = []
+        for i, item in enumerate(items):
+            if item.borrow_current is not None:
+                errors[i] = AlreadyBorrowed('"%(title)s" is already borrowed!' %
+                    {'title': item.get_display_title()})
+                continue
+            b = BorrowCurrent(
+                user=self,
+                user_group=self.group.name,
+                borrow_date=now,
+                due_date=get_due_date(self, item.item_class, now, longterm),
+                is_longterm=longterm)
+            loans[i] = b
+            ops.append(UpdateOne({'_id': item.id, 'borrow_current.user': None},
+                {'$set': {'borrow_current': b.to_mongo()},
+                    '$inc': {'borrow_count': 1}}))
+        if not ops:
+            return errors
+
+        collection = Item._get_collection()
+        result = collection.bulk_write(ops, ordered=False)
+        if result.matched_count < len(ops):
+            # Some were borrowed by someone else in the meantime. Ours are
+            # the ones that now carry this user and borrow date.
+            ids = [items[i].id for i in loans]
+            current = dict((d['_id'], d.get('borrow_current') or {})
+                for d in collection.find({'_id': {'$in': ids}},
+                    {'borrow_current': True}))
+            for i in list(loans):
+                b = current.get(items[i].id, {})
+                if (b.get('user'), b.get('borrow_date')) != (self.id, now):
+                    errors[i] = AlreadyBorrowed(
+                        '"%(title)s" is already borrowed!' %
+                        {'title': items[i].get_display_title()})
+                    del loans[i]
+
+        for i, b in loans.items():
+            item = items[i]
+            item.borrow_current = b
+            item.borrow_count = (item.borrow_count or 0) + 1
+            item._clear_changed_fields()
+            item_borrowed.send(self, item=item, borrow=b)
+        return errors
+
+    def unborrow_many(self, items):
+        '''
+        Returns several items at once, with the same rules as unborrow().
+        The loans are ended with one bulk write of conditional updates (and
+        one more read if any of them was ended meanwhile), and the BorrowPast
+        records are written in one go. The items should have their authors
+        loaded (see prefetch), for the snapshots.
+
+        Returns a list with, for each item in turn, the new BorrowPast
+        record or the BorrowError that unborrow() would have raised.
+        '''
+        results = [None] * len(items)
+        loans = {}
+        for i, item in enumerate(items):
+            b = item.borrow_current
+            user = b and b._data.get('user')
+            if user is None or user.id != self.id:
+                results[i] = BorrowError('You have not borrowed that item')
+                continue
+            loans[i] = b
+        if not loans:
+            return results
+
+        # Each update only matches the loan as it was read, and leaves the
+        # id of the record to write, so whoever ends a loan first (here or
+        # in unborrow()) is the only one to record it
+        record_ids = dict((i, ObjectId()) for i in loans)
+        collection = Item._get_collection()
+        result = collection.bulk_write([UpdateOne({'_id': items[i].id,
+                    'borrow_current.user': self.id,
+                    'borrow_current.borrow_date': b.borrow_date},
+                {'$unset': {'borrow_current': True},
+                    '$set': {'last_return': record_ids[i]}})
+            for i, b in loans.items()], ordered=False)
+        if result.matched_count < len(loans):
+            ended = set(d['_id'] for d in collection.find({
+                    '_id': {'$in': [items[i].id for i in loans]},
+                    'last_return': {'$in': record_ids.values()}},
+                {'_id': True}))
+            for i in list(loans):
+                if items[i].id not in ended:
+                    results[i] = BorrowError('You have not borrowed that item')
+                    del loans[i]
+
+        now = datetime.now()
+        records = dict((i, BorrowPast(
+                id=record_ids[i],
+                item=items[i],
+                user=self,
+                user_group=b.user_group or self.group.name,
+                borrow_date=b.borrow_date,
+                return_date=now,
+                item_snapshot=ItemSnapshot.from_item(items[i])))
+            for i, b in loans.items())
+        records = records.items()
+        if records:
+            BorrowPast._get_collection().insert_many(
+                [p.to_mongo() for i, p in records])
+        for i, p in records:
+            item = items[i]
+            item.borrow_current = None
+            item.last_return = p.id
+            item._clear_changed_fields()
+            results[i] = p
+            item_returned.send(self, item=item, record=p)
+        return results
+
     def get_current_borrowings(self):
         '''
-        Gets the list of books currently borrowed by the user.
+        Gets the list of books currently borrowed by the user. Use
+        prefetch() on the result to load their authors etc. in one go.
         '''
         
         return Item.objects(borrow_current__user=self)
         
     def get_past_borrowings(self):
         '''
-        Gets the list of records for books previously borrowed by the user.
+        Gets the list of records for books previously borrowed by the user,
+        most recently returned first. Use prefetch() on the result to load
+        the items in one go.
         '''
         
-        return BorrowPast.objects(user=self)
+        return BorrowPast.objects(user=self).order_by('-return_date')
 
-class Publisher(db.Document):
+class IdentityVersion(db.Document):
+    '''
+    Counts the changes to a user (by id) or, as "all", to every user's
+    group and roles, so that identities cached by each process (see
+    auth.py) can be checked against the database
+    '''
+    id = db.StringField(primary_key=True)
+    version = db.IntField(default=0)
+
+class Publisher(NamedMaster):
     name = db.StringField(max_length=128, unique=True)
     def __unicode__(self):
         return '%(name)s' % {'name': self.name}
 
-class PublishPlace(db.Document):
+class PublishPlace(NamedMaster):
     name = db.StringField(max_length=128, unique=True)
     def __unicode__(self):
         return '%(name)s' % {'name': self.name}
 
-class Creator(db.Document):
+class Creator(NamedMaster):
     '''Author, illustrator, etc.'''
     name = db.StringField(max_length=128, unique=True)
     def __unicode__(self):
@@ -174,6 +394,9 @@ class BorrowCurrent(db.EmbeddedDocument):
     Tracks one instance of an accessed item getting borrowed.
     '''
     user = db.ReferenceField(User)
+    # The user's group when borrowing: the loan is counted under it, even
+    # if the user changes groups before returning it
+    user_group = db.StringField()
     borrow_date = db.DateTimeField()
     due_date = db.DateTimeField()
 
@@ -191,6 +414,93 @@ class ItemType(db.Document):
     icon_name = db.StringField()
     icon_color = db.StringField()
 
+class LoanPolicy(db.Document):
+    '''
+    How long items may be borrowed for. The most specific policy for the
+    user's group and the item class applies: one for both, then one for
+    the group, then one for the item class, then one for neither. Without
+    any, loans are due after DEFAULT_LOAN_DAYS.
+    '''
+    user_group = db.ReferenceField(UserGroup,
+        help_text='Leave blank for all groups')
+    item_class = db.StringField(max_length=32,
+        help_text='Item type name (eg. "book"). Leave blank for all types')
+    loan_days = db.IntField(required=True, min_value=1)
+    longterm_days = db.IntField(min_value=1,
+        help_text='For long-term loans. Leave blank for no due date')
+
+    def due_date(self, borrow_date, longterm=False):
+        days = self.longterm_days if longterm else self.loan_days
+        return borrow_date + timedelta(days) if days else None
+
+    def __unicode__(self):
+        return '%(group)s, %(item_class)s: %(days)d days' % {
+            'group': self.user_group or 'All groups',
+            'item_class': self.item_class or 'all types',
+            'days': self.loan_days}
+
+# Accession numbers
+#
+# Accessions are stored as "prefix:number" (or just "number"), but are
+# typed or scanned in all sorts of ways: "B:0042", "b-42", "B42". Lookups
+# go through a normalised (prefix, key) pair instead.
+
+_ACCESSION_SEPARATORS = re.compile(r'[^0-9a-z]+')
+
+def _accession_part(text):
+    text = _ACCESSION_SEPARATORS.sub('', text.lower())
+    if text.isdigit():
+        text = text.lstrip('0') or '0'
+    return text
+
+def split_accession(accession):
+    '''
+    Splits a stored accession into a normalised (prefix, key) pair: lower
+    case, without separators or leading zeros. "B:0042" gives ("b", "42").
+    '''
+    if ':' in accession:
+        prefix, key = accession.split(':', 1)
+    else:
+        prefix, key = '', accession
+    return _accession_part(prefix), _accession_part(key)
+
+def accession_candidates(accession):
+    '''
+    Returns the possible (prefix, key) readings of an accession as typed or
+    scanned, longest prefix first. Without a ":" there is no telling where
+    the prefix ends, so "B-42" may be ("b", "42") or ("", "b42").
+    '''
+    if ':' in accession:
+        return [split_accession(accession)]
+    text = _ACCESSION_SEPARATORS.sub('', accession.lower())
+    letters = len(text) - len(text.lstrip('abcdefghijklmnopqrstuvwxyz'))
+    candidates = [(text[:i], _accession_part(text[i:]))
+        for i in range(min(letters, len(text) - 1), 0, -1)]
+    candidates.append(('', _accession_part(text)))
+    return candidates
+
+def item_class_name(class_name):
+    '''
+    Returns the item class (eg. "book") for a document class name (eg.
+    "Item.BookItem")
+    '''
+    c = class_name.split('.')[-1].lower()
+    if c != 'iuem': c = c.replace('item', '')
+    return c
+
+class AccessionCounter(db.Document):
+    '''
+    Holds the last accession number handed out for an ItemType prefix
+    (the empty prefix is used for plain numbers). See accession.py
+    '''
+    prefix = db.StringField(primary_key=True)
+    value = db.IntField(default=0)
+
+    def __unicode__(self):
+        return '%(prefix)s: %(value)s' % {
+            'prefix': self.prefix or '(none)',
+            'value': self.value}
+
 class Item(db.Document):
     '''
     Holds data for items in the Accession Register. Each of these items can 
@@ -223,6 +533,18 @@ class Item(db.Document):
     source = db.StringField(max_length=128) # Where it came from
 
     borrow_current = db.EmbeddedDocumentField(BorrowCurrent)
+    borrow_count = db.IntField(default=0) # Times borrowed, for statistics
+    # Id of the BorrowPast record of the latest return, set along with it so
+    # that whoever ended a loan can tell
+    last_return = db.ObjectIdField()
+
+    # Normalised accession, kept up to date on save (see split_accession)
+    accession_prefix = db.StringField()
+    accession_key = db.StringField()
+
+    # Names, numbers etc. from other fields and documents to search on,
+    # kept up to date on save (see get_search_terms and search.py)
+    search_terms = db.ListField(db.StringField())
     
     # TODO: May be implemented later
     #display_title = db.StringField(max_length=256,
@@ -235,17 +557,59 @@ class Item(db.Document):
         '''
         Return the item class of the current object
         '''
-        c = self._cls.split('.')[-1].lower()
-        if c != 'iuem': c = c.replace('item', '')
-        return c
+        return item_class_name(self._cls)
     def __unicode__(self):
         return '%(title)s' % {
             'title': self.title}
 
+    def clean(self):
+        if self.accession:
+            self.accession_prefix, self.accession_key = split_accession(
+                self.accession)
+        self.search_terms = self.get_search_terms()
+
+    def get_search_terms(self):
+        '''
+        Returns the terms this item should also be found by, apart from its
+        title, subtitle and keywords. Overridden by the item classes.
+        '''
+        return []
+
+    def matches_accession(self, accession):
+        '''
+        Checks an accession as typed or scanned against this item's. The
+        prefix may be left out.
+        '''
+        prefix, key = split_accession(self.accession)
+        return any(k == key and p in (prefix, '')
+            for p, k in accession_candidates(accession))
+
     def get_display_title(self):
         return self.title
 
-    meta = {'allow_inheritance': True}
+    # Since Item allows inheritance, mongoengine puts _cls in front of each
+    # of these, so they also serve queries on BookItem, PeriodicalItem, etc.
+    meta = {
+        'allow_inheritance': True,
+        'queryset_class': PrefetchQuerySet,
+        'indexes': [
+            ('accession_key', 'accession_prefix'),
+            # User.get_current_borrowings()
+            'borrow_current.user',
+            # Most borrowed items, of all classes
+            {'fields': ['-borrow_count'], 'cls': False},
+            # Overdue loans. Sparse, since only borrowed items have one
+            {'fields': ['borrow_current.due_date'], 'cls': False,
+                'sparse': True},
+            # Catalogue search. There can only be one text index.
+            {'fields': ['$title', '$subtitle', '$keywords', '$search_terms'],
+                'cls': False,
+                'weights': {'title': 10, 'search_terms': 5,
+                    'subtitle': 3, 'keywords': 3},
+                'default_language': 'english'},
+        ],
+        'index_background': True,
+    }
 
 class BookItem(Item):
     call_nos = db.ListField(db.StringField(max_length=8))
@@ -260,6 +624,14 @@ class BookItem(Item):
     editors = db.ListField(db.ReferenceField(Creator))
     illustrators = db.ListField(db.ReferenceField(Creator))
 
+    def get_search_terms(self):
+        terms = [c.name for c in self.authors + self.editors + self.illustrators
+            if isinstance(c, Creator) and c.name]
+        if self.isbn:
+            # Also without the dashes, which split it into words
+            terms.extend([self.isbn, re.sub(r'[^0-9Xx]', '', self.isbn)])
+        return terms
+
 PERIODICAL_FREQUENCY_CHOICES = (
     ('unknown', 'Unknown'),
     ('monthly', 'Monthly'),
@@ -297,6 +669,12 @@ class PeriodicalItem(Item):
 
     # TODO: inserts can be added as ListField!
 
+    def get_search_terms(self):
+        p = self.periodical_name
+        if isinstance(p, PeriodicalSubscription) and p.periodical_name:
+            return [p.periodical_name]
+        return []
+
     def get_display_title(self, title=None, call_no=None):
         return '%(title)s,%(date)s%(month)s%(year)s: %(cover)s' % {
             'title': title,
@@ -308,6 +686,37 @@ class PeriodicalItem(Item):
 
 # For historic records
 
+class ItemSnapshot(db.EmbeddedDocument):
+    '''
+    Details of an item as it was when returned. Kept on BorrowPast so that
+    the history can be shown without looking up each item (which may even
+    have been discarded since).
+    '''
+    accession = db.StringField()
+    title = db.StringField()
+    item_class = db.StringField()
+    author = db.StringField() # Primary author, if any
+
+    # Title shown for records whose item was deleted before it was
+    # snapshotted
+    DELETED_TITLE = 'Deleted item'
+
+    @classmethod
+    def from_item(cls, item):
+        if not isinstance(item, Item):
+            # The reference could not be followed (a DBRef, or None)
+            return cls(title=cls.DELETED_TITLE)
+        # Only some item classes have authors
+        authors = getattr(item, 'authors', None)
+        return cls(
+            accession=item.accession,
+            title=item.title,
+            item_class=item.item_class,
+            author=authors[0].name if authors else None)
+
+    def __unicode__(self):
+        return '%(title)s' % {'title': self.title}
+
 class BorrowPast(db.Document):
     '''
     Tracks past instances of borrowing. This model is separate from
@@ -321,95 +730,173 @@ class BorrowPast(db.Document):
     
     borrow_date = db.DateTimeField()
     return_date = db.DateTimeField()
+
+    item_snapshot = db.EmbeddedDocumentField(ItemSnapshot)
+
+    meta = {
+        'queryset_class': PrefetchQuerySet,
+        'indexes': [
+            # User.get_past_borrowings(), newest first, and keyset
+            # pagination of the history
+            ('user', '-return_date', '-id'),
+        ],
+        'index_background': True,
+    }
+
+    def get_snapshot(self):
+        '''
+        Returns the item snapshot. Records from before snapshots were kept
+        get one made from the item itself, or a placeholder if the item has
+        been deleted.
+        '''
+        return self.item_snapshot or ItemSnapshot.from_item(self.item)
+
     def __unicode__(self):
         return '%(item)s by %(user)s (%(group)s) on %(date)s' % {
-            'item': self.item.title,
+            'item': self.get_snapshot().title,
             'user': self.user,
             'group': self.user_group,
             'date': self.borrow_date}
 
+class CirculationStat(db.Document):
+    '''
+    Counts borrowings and returns for one day or month, user group, item
+    class and campus location. Kept up to date by stats.py
+    '''
+    period = db.StringField(choices=(('day', 'Day'), ('month', 'Month')),
+        required=True)
+    date = db.DateTimeField(required=True) # Start of the day or month
+    user_group = db.StringField()
+    item_class = db.StringField()
+    campus_location = db.ReferenceField(CampusLocation)
+
+    borrows = db.IntField(default=0)
+    returns = db.IntField(default=0)
+
+    meta = {
+        'indexes': [
+            {'fields': ('period', 'date', 'user_group', 'item_class',
+                'campus_location'), 'unique': True},
+        ],
+        'index_background': True,
+    }
+
+class SlowQuery(db.Document):
+    '''
+    Slow or repeated queries, added up by their shape (see
+    util/queryshape.py). Kept by querylog.py
+    '''
+    fingerprint = db.StringField(required=True, unique=True)
+    collection_name = db.StringField()
+    count = db.IntField(default=0) # Slow runs
+    total_time = db.FloatField(default=0.0) # Of the slow runs, in seconds
+    max_time = db.FloatField(default=0.0)
+    repeated = db.IntField(default=0) # Requests running it too many times
+    endpoint = db.StringField() # Where it was last seen
+    location = db.StringField()
+    first_seen = db.DateTimeField()
+    last_seen = db.DateTimeField()
+
+    meta = {
+        'ordering': ['-total_time'],
+        'indexes': ['-total_time', '-repeated'],
+        'index_background': True,
+    }
+
+class JournalConflict(db.Document):
+    '''
+    A borrow or return from the circulation journal that could not be
+    applied (eg. the item had been borrowed by someone else meanwhile), for
+    an admin to look into. See journal.py
+    '''
+    entry_id = db.StringField(required=True, unique=True)
+    action = db.StringField(choices=(('borrow', 'Borrow'), ('return', 'Return')))
+    user = db.ReferenceField(User)
+    item = db.ReferenceField(Item)
+    date = db.DateTimeField() # When it was recorded at the kiosk
+    error = db.StringField()
+    created = db.DateTimeField(default=datetime.now)
+    resolved = db.BooleanField(default=False)
+
+    meta = {
+        'ordering': ['-created'],
+        'indexes': [
+            ('resolved', '-created'),
+        ],
+        'index_background': True,
+    }
+
+    def __unicode__(self):
+        return '%(action)s of %(item)s by %(user)s: %(error)s' % {
+            'action': self.action,
+            'item': self.item,
+            'user': self.user,
+            'error': self.error}
+
+# In-memory copies of the masters that hardly ever change. See
+# util/registry.py.
+item_types = Registry(ItemType, indexes=('name', 'prefix'))
+campus_locations = Registry(CampusLocation)
+currencies = Registry(Currency)
+genres = Registry(Genre)
+
+loan_policies = Registry(LoanPolicy, indexes=())
+
+def get_loan_policy(user_group_id, item_class):
+    '''
+    Returns the LoanPolicy for a user group (id) and item class, or None
+    '''
+    best, best_score = None, -1
+    for policy in loan_policies:
+        group = getattr(policy._data.get('user_group'), 'id', None)
+        if group not in (None, user_group_id):
+            continue
+        if policy.item_class not in (None, '', item_class):
+            continue
+        score = (group is not None) * 2 + bool(policy.item_class)
+        if score > best_score:
+            best, best_score = policy, score
+    return best
+
+def get_due_date(user, item_class, borrow_date, longterm=False):
+    '''Returns when a loan made by the user at borrow_date is due'''
+    policy = get_loan_policy(getattr(user._data.get('group'), 'id', None),
+        item_class)
+    if policy is not None:
+        return policy.due_date(borrow_date, longterm)
+    if longterm:
+        return None
+    return borrow_date + timedelta(app.config.get('DEFAULT_LOAN_DAYS', 14))
+
+def get_overdue_items(before=None):
+    '''
+    Gets the items that were due back before the given time (default: now),
+    earliest first. Only the borrowed items are looked at, through the
+    due date index. Use prefetch() on the result to load the borrowers.
+    '''
+    return (Item.objects(borrow_current__due_date__lt=before or datetime.now())
+        .order_by('borrow_current.due_date'))
+
+@hot_query('current borrowings')
+def _current_borrowings():
+    return User(id=ObjectId()).get_current_borrowings()
+
+@hot_query('past borrowings')
+def _past_borrowings():
+    return User(id=ObjectId()).get_past_borrowings()
+
+@hot_query('overdue loans')
+def _overdue():
+    return get_overdue_items()
+
 def get_item_types():
     '''
     Returns a list of currenty available item types
     '''
-    return [i.name for i in ItemType.objects]
+    return [i.name for i in item_types]
 
 def create_tables():
     '''WARNING: Deprecated function. Do not use!'''
     print 'Mongo does not use tables!'
 
 # TODO: HIPPO: Continue from here!
-def create_test_data():
-    print 'Generating test data...'
-    models = (Group, Role, User, UserRoles, PublishPlace, Publisher, Currency, Author, Location, Publication, Copy, Borrowing, PastBorrowing) + tuple(all_pubtypes.union(all_pubcopies))
-    for Model in models:
-        print 'Resetting table: ', Model
-        Model.drop_table(fail_silently=True)
-        Model.create_table(fail_silently=True)
-
-    print 'Inserting test data: ',
-
-    print '[users]',
-    g = Group.create(name='Earth')
-    User.create(name='Moon', password='pass', group=g)
-
-    g = Group.create(name='Mars')
-    User.create(name='Phobos', group=g)
-    User.create(name='Deimos', group=g)
-
-    g = Group.create(name='Jupiter')
-    User.create(name='Io', group=g)
-    User.create(name='Europa', group=g)
-    User.create(name='Ganymede', group=g)
-    User.create(name='Callisto', group=g)
-
-    g = Group.create(name='Saturn')
-    User.create(name='Titan', group=g)
-    User.create(name='Enceladus', group=g)
-    User.create(name='Tethys', group=g)
-    User.create(name='Mimas', group=g)
-    User.create(name='Dione', group=g)
-
-    print '[roles]',
-
-    r = Role.create(name='admin', description='access the admin interface')
-    u = UserRoles.create(role=r, user=User.get(username='europa'))
-    u = UserRoles.create(role=r, user=User.get(username='moon'))
-
-    print '[locations]',
-
-    loc_main = Location.create(name='Main')
-
-    print '[publications]',
-    p = Publication.create(title='The Slippery Seals',
-        comments='The first book in the SNAP booklet series',
-        keywords='snap, seals, wildlife')
-    c1 = Copy.create(item=p,
-        accession=1,
-        location=loc_main,
-        source='Stolen from the store!',
-        receipt_date=datetime.now())
-    c2 = Copy.create(item=p,
-        accession=2,
-        location=loc_main,
-        source='A gift from the valley',
-        receipt_date=datetime.now())
-    p = Publication.create(title='The Ferocious Felids',
-        comments='The second book in the SNAP booklet series',
-        keywords='snap, cats, lions, tigers, leopards, wildlife')
-    c3 = Copy.create(item=p,
-        accession=3,
-        location=loc_main,
-        source='Bought at Ascraeus Mons',
-        receipt_date=datetime.now())
-
-    print '[borrowings]',
-    e = User.get(username='europa')
-    e.borrow(c1,1)
-    e.unborrow(c1,1)
-    e.borrow(c2,2)
-    e.borrow(c3,3)
-    e.unborrow(c3,3)
-    e.borrow(c3,3)
-
-    print '...done.'
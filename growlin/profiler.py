@@ -0,0 +1,192 @@
+'''
+Request profiling.
+
+With PROFILE_DIR set, requests can be profiled with cProfile, from just
+before the view (after logging in is checked) until the response is done,
+so the view, MongoEngine, pymongo and Jinja all show up. A request is
+profiled when:
+
+ * an admin asks for it, with an "X-Profile: 1" header or "?_profile=1";
+ * it is picked at random, PROFILE_SAMPLE being the share of requests to
+   pick (default 0, none).
+
+Each profile is written to PROFILE_DIR as a pstats file ("<name>.prof",
+which snakeviz and the like can open) with a JSON file describing the
+request next to it. Only the newest PROFILE_KEEP (default 100) are kept.
+They can be browsed in the admin, under More > Profiles, which shows the
+hottest functions and the call tree.
+'''
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+from datetime import datetime
+from timeit import default_timer
+from flask import g, request
+from flask.ext.login import current_user
+from .app import app
+from .auth import Permission, RoleNeed
+
+app.config.setdefault('PROFILE_DIR', None)
+app.config.setdefault('PROFILE_SAMPLE', 0.0)
+app.config.setdefault('PROFILE_KEEP', 100)
+
+_admin = Permission(RoleNeed('admin'))
+_NAME = re.compile(r'^[\w.-]+$')
+
+def _trigger():
+    '''Returns why this request is to be profiled, if it is'''
+    if (request.headers.get('X-Profile') or request.args.get('_profile')) \
+            and _admin.can():
+        return 'requested'
+    sample = app.config['PROFILE_SAMPLE']
+    if sample and random.random() < sample:
+        return 'sampled'
+
+@app.before_request
+def _start():
+    if not app.config['PROFILE_DIR']:
+        return
+    trigger = _trigger()
+    if trigger is None:
+        return
+    g._profile = (cProfile.Profile(), trigger, default_timer())
+    g._profile[0].enable()
+
+@app.after_request
+def _status(response):
+    if getattr(g, '_profile', None) is not None:
+        g._profile_status = response.status_code
+    return response
+
+@app.teardown_request
+def _finish(exception):
+    profile = getattr(g, '_profile', None)
+    if profile is None:
+        return
+    profiler, trigger, start = profile
+    profiler.disable()
+    g._profile = None
+    try:
+        save(profiler, {
+            'method': request.method,
+            'url': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'user': getattr(current_user, 'username', None),
+            'status': getattr(g, '_profile_status', 500),
+            'duration': default_timer() - start,
+            'trigger': trigger,
+        })
+    except (IOError, OSError), e:
+        app.logger.warning('Could not save profile: %s', e)
+
+def save(profiler, info):
+    '''Writes a profile and its description, dropping the oldest ones'''
+    directory = app.config['PROFILE_DIR']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    now = datetime.now()
+    name = '%s-%s-%04d' % (now.strftime('%Y%m%d-%H%M%S-%f'),
+        re.sub(r'[^\w]+', '_', info.get('endpoint') or 'unmatched'),
+        random.randrange(10000))
+    profiler.dump_stats(os.path.join(directory, name + '.prof'))
+    info = dict(info, name=name, created=now.isoformat())
+    with open(os.path.join(directory, name + '.json'), 'w') as f:
+        json.dump(info, f)
+    _prune(directory, app.config['PROFILE_KEEP'])
+    return name
+
+def _prune(directory, keep):
+    # Names start with the time, so they sort oldest first
+    names = sorted(f[:-len('.json')] for f in os.listdir(directory)
+        if f.endswith('.json'))
+    for name in names[:max(0, len(names) - keep)]:
+        for ext in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, name + ext))
+            except OSError:
+                pass
+
+def list_profiles():
+    '''Returns the descriptions of the profiles kept, newest first'''
+    directory = app.config['PROFILE_DIR']
+    if not directory or not os.path.isdir(directory):
+        return []
+    profiles = []
+    for f in sorted(os.listdir(directory), reverse=True):
+        if f.endswith('.json'):
+            try:
+                with open(os.path.join(directory, f)) as fp:
+                    profiles.append(json.load(fp))
+            except (IOError, ValueError):
+                continue
+    return profiles
+
+def profile_path(name):
+    '''Returns the path of a profile's pstats file, or None if it is not kept'''
+    directory = app.config['PROFILE_DIR']
+    if not directory or not _NAME.match(name):
+        return None
+    path = os.path.join(directory, name + '.prof')
+    return path if os.path.exists(path) else None
+
+def _label(func):
+    filename, line, name = func
+    if filename == '~':
+        # Built in, eg. "<method 'sort' of 'list' objects>"
+        return name
+    parts = filename.split(os.sep)
+    return '%s:%d(%s)' % (os.sep.join(parts[-2:]), line, name)
+
+def hottest(stats, sort='tottime', limit=30):
+    '''
+    Returns the functions of a pstats.Stats taking the most time, by their
+    own time ("tottime") or including what they call ("cumtime"), as
+    dicts of label, calls, tottime and cumtime
+    '''
+    key = 2 if sort == 'tottime' else 3
+    rows = sorted(stats.stats.items(), key=lambda i: i[1][key], reverse=True)
+    return [{'label': _label(func), 'calls': nc, 'tottime': tt,
+            'cumtime': ct}
+        for func, (cc, nc, tt, ct, callers) in rows[:limit]]
+
+def call_tree(stats, min_share=0.01, max_depth=20):
+    '''
+    Returns the call tree of a pstats.Stats, from the functions nothing
+    called, as nested dicts of label, time (including callees, as called
+    from the parent), share of the total and children. Calls taking less
+    than min_share of the total are left out. cProfile only knows the time
+    a function spent for each caller, not for each path, so deeper down the
+    times are estimates.
+    '''
+    children = {}
+    roots = []
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            roots.append((func, ct))
+        for caller, timing in callers.items():
+            children.setdefault(caller, []).append((func, timing[3]))
+    total = sum(ct for func, ct in roots) or stats.total_tt or 1.0
+
+    def node(func, time, path):
+        item = {'label': _label(func), 'time': time, 'share': time / total,
+            'children': []}
+        if len(path) < max_depth:
+            for child, child_time in sorted(children.get(func, []),
+                    key=lambda c: c[1], reverse=True):
+                # Recursion is shown once
+                if child_time >= min_share * total and child not in path:
+                    item['children'].append(node(child, child_time,
+                        path | set([child])))
+        return item
+
+    return [node(func, ct, set([func])) for func, ct in
+        sorted(roots, key=lambda r: r[1], reverse=True)
+        if ct >= min_share * total]
+
+def load(name):
+    '''Returns a profile's pstats.Stats, or None if it is not kept'''
+    path = profile_path(name)
+    return pstats.Stats(path) if path else None
@@ -0,0 +1,96 @@
+'''
+Slow-query log and N+1 detection.
+
+Every request's database commands are watched (see util/queryshape.py):
+
+ * Commands taking at least SLOW_QUERY_MS milliseconds (default 200; None
+   turns this off) are added up by shape in SlowQuery, with the endpoint
+   and the code and template line they came from.
+ * With QUERY_DIAGNOSTICS set, every command is fingerprinted, and shapes
+   run more than QUERY_REPEAT_THRESHOLD times (default 5) in one request
+   are logged as warnings, and counted in SlowQuery as "repeated". Shapes
+   known to repeat can be listed in QUERY_REPEATS_ALLOWED. With
+   QUERY_DIAGNOSTICS set to "raise", the request fails with
+   RepeatedQueries instead, which is meant for tests.
+
+SlowQuery is written once per request, after its own commands are
+recorded, and only if there is something to write.
+'''
+from datetime import datetime
+from flask import g, request
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from .app import app
+from .models import SlowQuery
+from .util import monitoring
+from .util.queryshape import QueryWatcher, RepeatedQueries
+
+app.config.setdefault('SLOW_QUERY_MS', 200)
+app.config.setdefault('QUERY_DIAGNOSTICS', False)
+app.config.setdefault('QUERY_REPEAT_THRESHOLD', 5)
+app.config.setdefault('QUERY_REPEATS_ALLOWED', ())
+
+def _start():
+    slow = app.config['SLOW_QUERY_MS']
+    repeats = bool(app.config['QUERY_DIAGNOSTICS'])
+    if slow is None and not repeats:
+        return
+    g._query_watcher = QueryWatcher(repeats=repeats,
+        slow=slow / 1000.0 if slow is not None else None)
+    monitoring.start_recording(g._query_watcher)
+
+# First, so that the other hooks' queries are watched too
+app.before_request_funcs.setdefault(None, []).insert(0, _start)
+
+@app.after_request
+def _finish(response):
+    watcher = getattr(g, '_query_watcher', None)
+    if watcher is None:
+        return response
+    monitoring.stop_recording(watcher)
+    g._query_watcher = None
+    endpoint = request.endpoint or 'unmatched'
+    repeated = []
+    if watcher.repeats:
+        threshold = app.config['QUERY_REPEAT_THRESHOLD']
+        repeated = watcher.repeated(threshold,
+            app.config['QUERY_REPEATS_ALLOWED'])
+        for s in repeated:
+            app.logger.warning('Repeated query in %s: %s ran %d times '
+                '(%.1fms), first at %s', endpoint, s.fingerprint, s.count,
+                s.duration * 1000, s.location)
+    save(endpoint, watcher.slow.values(), repeated)
+    if repeated and app.config['QUERY_DIAGNOSTICS'] == 'raise':
+        raise RepeatedQueries(repeated, threshold)
+    return response
+
+@app.teardown_request
+def _teardown(exception):
+    watcher = getattr(g, '_query_watcher', None)
+    if watcher is not None:
+        monitoring.stop_recording(watcher)
+
+def save(endpoint, slow, repeated):
+    '''Adds slow and repeated shapes (Shape objects) to the SlowQuery log'''
+    now = datetime.now()
+    ops = {}
+    for s, counts in [(s, True) for s in slow] + [(s, False) for s in repeated]:
+        update = ops.setdefault(s.fingerprint, {
+            '$set': {'endpoint': endpoint, 'location': s.location,
+                'collection_name': s.collection, 'last_seen': now},
+            '$setOnInsert': {'first_seen': now},
+            '$inc': {},
+        })
+        if counts:
+            update['$inc'].update(count=s.count, total_time=s.duration)
+            update['$max'] = {'max_time': s.max_duration}
+        else:
+            update['$inc']['repeated'] = 1
+    if not ops:
+        return
+    try:
+        SlowQuery._get_collection().bulk_write([UpdateOne({'fingerprint': fp},
+            update, upsert=True) for fp, update in ops.items()])
+    except PyMongoError, e:
+        # The log is not worth failing the request for
+        app.logger.warning('Could not save slow queries: %s', e)
@@ -0,0 +1,100 @@
+'''
+The login roster: active users grouped by UserGroup, as shown on the
+login page.
+
+The roster is built with a single aggregation over the User collection
+(instead of dereferencing each user's group) and kept in a process-level
+cache. Saving or deleting a User or UserGroup drops the cache so that the
+next login page rebuilds it.
+'''
+from threading import Lock
+from mongoengine import signals
+from .models import User, UserGroup
+from .indexes import hot_query
+
+_roster = None
+_roster_generation = 0
+_roster_lock = Lock()
+
+# Active users, grouped by group and sorted by name within each group
+ROSTER_PIPELINE = [
+    {'$match': {'active': {'$ne': False}}},
+    {'$sort': {'name': 1}},
+    {'$project': {'group': True, 'username': True, 'name': True,
+        # False for users without one
+        'login_password': {'$ifNull': ['$password', False]}}},
+    {'$group': {
+        '_id': '$group',
+        'users': {'$push': {
+            'username': '$username',
+            'name': '$name',
+            # Replaced by whether there is one in _build_roster()
+            'password': '$login_password',
+        }},
+    }},
+]
+
+def _build_roster():
+    '''
+    Returns a list of groups (in display order), each holding the list of
+    its active users sorted by name.
+    '''
+    members = {}
+    for g in User._get_collection().aggregate(ROSTER_PIPELINE):
+        # Never send the password itself, only whether one is needed
+        members[g['_id']] = [{'username': u['username'], 'name': u['name'],
+                'has_password': bool(u.get('password'))}
+            for u in g['users']]
+
+    roster = []
+    for g in UserGroup.objects.only('name'):
+        # UserGroup ordering is by position, so the roster is too
+        users = members.get(g.id, [])
+        roster.append({
+            'id': str(g.id),
+            'name': g.name,
+            'count': len(users),
+            'users': users})
+    return roster
+
+@hot_query('login roster')
+def _roster_query():
+    return User, ROSTER_PIPELINE
+
+def get_roster():
+    '''
+    Returns the cached login roster, building it if required.
+    '''
+    global _roster
+    roster = _roster
+    if roster is None:
+        with _roster_lock:
+            if _roster is None:
+                generation = _roster_generation
+                roster = _build_roster()
+                # Don't cache a roster that was invalidated while building
+                if generation == _roster_generation:
+                    _roster = roster
+            else:
+                roster = _roster
+    return roster
+
+def get_group_members(group_id):
+    '''
+    Returns the list of users in the given group, or None if there is no
+    such group.
+    '''
+    for group in get_roster():
+        if group['id'] == group_id:
+            return group['users']
+    return None
+
+def invalidate_roster(sender=None, **kwargs):
+    '''Drops the cached roster. Connected to User/UserGroup signals.'''
+    global _roster, _roster_generation
+    _roster_generation += 1
+    _roster = None
+
+for _model in (User, UserGroup):
+    signals.post_save.connect(invalidate_roster, sender=_model)
+    signals.post_delete.connect(invalidate_roster, sender=_model)
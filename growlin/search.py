@@ -0,0 +1,138 @@
+'''
+Catalogue search.
+
+Items are searched with the MongoDB text index declared on Item, over the
+title, subtitle, keywords and search_terms. search_terms holds the names
+of authors etc. and the ISBN (see Item.get_search_terms), and is kept up
+to date whenever an item is saved, or a creator or subscription renamed.
+Results are ranked by text score, and can be filtered by item type,
+campus location and availability.
+'''
+from mongoengine import signals
+from mongoengine.queryset.visitor import Q
+from pymongo import UpdateOne
+from .models import (Item, BookItem, PeriodicalItem, Creator,
+    PeriodicalSubscription, campus_locations)
+from .accession import item_class_model
+from .indexes import hot_query
+from .util.prefetch import prefetch
+
+PAGE_SIZE = 20
+# Ranking is done by the server, so deep pages get more expensive
+MAX_PAGE = 50
+
+# Fields needed to show a result
+_RESULT_FIELDS = ('accession', 'title', 'subtitle', 'authors',
+    'campus_location', 'borrow_current')
+
+def search_queryset(text, item_class=None, campus_location=None,
+        available=None):
+    '''
+    Returns the queryset of items matching a search, best match first, or
+    None if nothing can match. Filters as search() does.
+    '''
+    model = Item if not item_class else item_class_model(item_class)
+    if model is None or not text.strip():
+        return None
+    queryset = model.objects.search_text(text)
+    if campus_location:
+        queryset = queryset.filter(campus_location=campus_location)
+    if available is not None:
+        if available:
+            queryset = queryset.filter(borrow_current__user=None)
+        else:
+            queryset = queryset.filter(borrow_current__user__ne=None)
+    return queryset.only(*_RESULT_FIELDS).order_by('$text_score')
+
+@hot_query('catalogue search')
+def _catalogue_search():
+    return search_queryset('dune')
+
+def search(text, item_class=None, campus_location=None, available=None,
+        page=1, per_page=PAGE_SIZE):
+    '''
+    Searches the catalogue. Filters by item class (eg. "book"), campus
+    location id and availability (True for items on the shelf, False for
+    borrowed ones) if given.
+
+    Returns the items on the given page (with their authors loaded), best
+    match first, and whether there are more pages.
+    '''
+    queryset = search_queryset(text, item_class, campus_location, available)
+    if queryset is None or not 1 <= page <= MAX_PAGE:
+        return [], False
+    items = list(queryset.skip((page - 1) * per_page).limit(per_page + 1))
+    more = len(items) > per_page
+    items = prefetch(items[:per_page], 'authors', only={'authors': ('name',)})
+    return items, more
+
+def search_result(item):
+    '''Returns a search result as a dict, for the JSON API'''
+    location = campus_locations.get('pk',
+        getattr(item._data.get('campus_location'), 'id', None))
+    return {
+        'id': str(item.id),
+        'accession': item.accession,
+        'item_class': item.item_class,
+        'title': item.title,
+        'subtitle': item.subtitle,
+        'authors': [a.name for a in getattr(item, 'authors', [])
+            if isinstance(a, Creator)],
+        'campus_location': location.name if location else None,
+        'available': item.borrow_current is None,
+    }
+
+def reindex(batch_size=500, progress=None):
+    '''
+    Recomputes search_terms for every item, for items saved before they
+    were kept. Each batch costs a query per referenced collection and one
+    bulk write. Returns the number of items updated.
+    '''
+    updated = 0
+    last_id = None
+    while True:
+        queryset = Item.objects.order_by('id').limit(batch_size)
+        if last_id is not None:
+            queryset = queryset.filter(id__gt=last_id)
+        items = list(queryset)
+        if not items:
+            break
+        last_id = items[-1].id
+        _reindex_items(items, 'authors', 'editors', 'illustrators',
+            'periodical_name')
+        updated += len(items)
+        if progress is not None:
+            progress(updated)
+    return updated
+
+def _reindex_items(queryset, *paths):
+    items = prefetch(queryset, *paths)
+    if items:
+        Item._get_collection().bulk_write([UpdateOne({'_id': item.id},
+                {'$set': {'search_terms': item.get_search_terms()}})
+            for item in items], ordered=False)
+
+def creator_changed(sender, document, **kwargs):
+    '''
+    Updates the items of a creator when it is renamed or deleted. Connected
+    to Creator signals.
+    '''
+    # Only saves are told whether the document was created
+    if 'created' in kwargs and (kwargs['created']
+            or 'name' not in document._get_changed_fields()):
+        return
+    # Renaming a creator is rare enough not to need an index for this
+    _reindex_items(BookItem.objects(Q(authors=document) |
+        Q(editors=document) | Q(illustrators=document)),
+        'authors', 'editors', 'illustrators')
+
+def subscription_changed(sender, document, **kwargs):
+    '''Updates the issues of a subscription. Connected to its signals.'''
+    if kwargs.get('created'):
+        return
+    _reindex_items(PeriodicalItem.objects(periodical_name=document),
+        'periodical_name')
+
+for _signal in (signals.post_save, signals.post_delete):
+    _signal.connect(creator_changed, sender=Creator)
+    _signal.connect(subscription_changed, sender=PeriodicalSubscription)
@@ -0,0 +1,207 @@
+'''
+Test data.
+
+seed() fills the database with made-up but realistically shaped data: users
+spread over groups, books and periodical issues with authors and
+subscriptions, years of borrowing history and some items currently out.
+The same parameters and random seed always give the same data (apart from
+ids), so benchmark runs at a given size can be compared.
+
+Documents are validated like any other, but written with insert_many in
+batches, so large data sets only take a minute or so.
+'''
+import random
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from .models import (UserGroup, User, UserRole, CampusLocation, Currency,
+    Publisher, PublishPlace, Creator, ItemType, Item, BookItem,
+    PeriodicalSubscription, PeriodicalItem, BorrowCurrent, BorrowPast,
+    ItemSnapshot, AccessionCounter, CirculationStat, LoanPolicy,
+    JournalConflict, item_types, get_due_date)
+from .accession import seed_counter
+
+# Named after planets and their moons, as the original test data was
+GROUP_NAMES = ('Earth', 'Mars', 'Jupiter', 'Saturn', 'Uranus', 'Neptune',
+    'Pluto')
+USER_NAMES = ('Moon', 'Phobos', 'Deimos', 'Io', 'Europa', 'Ganymede',
+    'Callisto', 'Titan', 'Enceladus', 'Tethys', 'Mimas', 'Dione', 'Rhea',
+    'Iapetus', 'Miranda', 'Ariel', 'Umbriel', 'Oberon', 'Triton', 'Charon')
+WORDS = ('slippery', 'seals', 'ferocious', 'felids', 'curious', 'case',
+    'river', 'mountain', 'secret', 'garden', 'history', 'stars', 'ocean',
+    'forest', 'journey', 'island', 'winter', 'summer', 'clock', 'dragon',
+    'lost', 'city', 'little', 'great', 'wildlife', 'snap', 'machine')
+LOCATIONS = ('Main', 'Junior', 'Reference', 'Staff room')
+
+# Collections cleared by seed(reset=True)
+MODELS = (UserGroup, User, UserRole, CampusLocation, Currency, Publisher,
+    PublishPlace, Creator, ItemType, Item, PeriodicalSubscription,
+    BorrowPast, AccessionCounter, CirculationStat, LoanPolicy,
+    JournalConflict)
+
+def _numbered(names, count):
+    '''Cycles through the names, numbering them after the first round'''
+    return [names[i % len(names)] + (' %d' % (i // len(names))
+        if i >= len(names) else '') for i in range(count)]
+
+def _insert(model, documents, batch_size):
+    '''Validates and inserts documents in batches, setting their ids'''
+    collection = model._get_collection()
+    for start in range(0, len(documents), batch_size):
+        batch = documents[start:start + batch_size]
+        for d in batch:
+            d.validate()
+        ids = collection.insert_many([d.to_mongo() for d in batch]).inserted_ids
+        for d, id in zip(batch, ids):
+            d.id = id
+    return documents
+
+def seed(users=14, groups=4, items=30, periodicals=0.2, years=1,
+        loans_per_year=12, on_loan=0.1, random_seed=0, reset=False,
+        batch_size=1000, progress=None):
+    '''
+    Adds test data:
+
+     * "users" users spread evenly over "groups" groups. The first user
+       ("Moon", password "pass") is an admin.
+     * "items" items, the given share of them periodical issues and the
+       rest books, with an author for every fifty or so.
+     * "years" years of borrowing history, with about "loans_per_year"
+       loans per user per year.
+     * the given share of the items currently out.
+
+    With reset set, all the collections involved are emptied first.
+    Calls progress(message) as it goes. Returns a dict of the numbers of
+    documents created.
+    '''
+    rng = random.Random(random_seed)
+    say = progress or (lambda message: None)
+    now = datetime.now().replace(microsecond=0)
+    if reset:
+        for model in MODELS:
+            model._get_collection().delete_many({})
+
+    say('users')
+    admin = (UserRole.objects(name='admin').first() or
+        UserRole(name='admin', permissions=[]).save())
+    group_docs = _insert(UserGroup, [UserGroup(name=name, position=i)
+        for i, name in enumerate(_numbered(GROUP_NAMES, groups))], batch_size)
+    user_docs = []
+    for i, name in enumerate(_numbered(USER_NAMES, users)):
+        user_docs.append(User(
+            username=name.lower().replace(' ', ''),
+            name=name,
+            password='pass' if i == 0 else None,
+            group=group_docs[i % len(group_docs)],
+            roles=[admin] if i == 0 else []))
+    _insert(User, user_docs, batch_size)
+
+    say('masters')
+    locations = _insert(CampusLocation, [CampusLocation(name=n)
+        for n in LOCATIONS], batch_size)
+    currency = Currency(name='Rupee', symbol='Rs').save()
+    masters = max(10, items // 50)
+    creators = _insert(Creator, [Creator(name='%s %s' % (
+            USER_NAMES[i % len(USER_NAMES)], name.capitalize()))
+        for i, name in enumerate(_numbered(WORDS, masters))], batch_size)
+    publishers = _insert(Publisher, [Publisher(name='%s Press' %
+            name.capitalize())
+        for name in _numbered(WORDS, max(5, masters // 10))], batch_size)
+    places = _insert(PublishPlace, [PublishPlace(name=n)
+        for n in ('Delhi', 'Mumbai', 'Chennai', 'London')], batch_size)
+    subscriptions = _insert(PeriodicalSubscription, [PeriodicalSubscription(
+            periodical_name='%s Monthly' % w.capitalize(), frequency='monthly')
+        for w in WORDS[:max(1, min(len(WORDS), items // 200))]], batch_size)
+    for cls, prefix in (('book', 'B'), ('periodical', 'P')):
+        ItemType.objects(name=cls).update_one(upsert=True, set__prefix=prefix)
+    item_types.invalidate()
+
+    say('items')
+    item_docs = []
+    accessions = {'B': 0, 'P': 0}
+    issue_numbers = {}
+    for i in range(items):
+        received = now - timedelta(days=rng.randint(0, 365 * max(years, 1)))
+        title = ' '.join(rng.choice(WORDS) for w in range(rng.randint(2, 5)))
+        common = dict(
+            title=title.capitalize(),
+            keywords=rng.sample(WORDS, 2),
+            campus_location=rng.choice(locations),
+            price=rng.randint(50, 2000),
+            price_currency=currency,
+            receipt_date=received,
+            source='Seeded')
+        prefix = 'P' if rng.random() < periodicals else 'B'
+        accessions[prefix] += 1
+        accession = '%s:%d' % (prefix, accessions[prefix])
+        if prefix == 'P':
+            subscription = rng.choice(subscriptions)
+            number = issue_numbers[subscription.id] = \
+                issue_numbers.get(subscription.id, 0) + 1
+            item = PeriodicalItem(accession=accession,
+                periodical_name=subscription,
+                issue_no=number,
+                issue_date=received,
+                **common)
+        else:
+            item = BookItem(accession=accession,
+                authors=rng.sample(creators, rng.randint(1, 2)),
+                publication_publisher=rng.choice(publishers),
+                publication_place=rng.choice(places),
+                publication_year=received.year - rng.randint(0, 30),
+                **common)
+        item_docs.append(item)
+    _insert(Item, item_docs, batch_size)
+    for prefix in ('B', 'P'):
+        seed_counter(prefix)
+
+    say('history')
+    past = []
+    if item_docs and user_docs:
+        for day in range(365 * years, 0, -1):
+            # Loans made that day, returned one to four weeks later
+            expected = len(user_docs) * loans_per_year / 365.0
+            loans = int(expected) + (rng.random() < expected % 1)
+            for n in range(loans):
+                user = rng.choice(user_docs)
+                item = rng.choice(item_docs)
+                borrowed = now - timedelta(days=day,
+                    minutes=rng.randint(0, 8 * 60))
+                returned = borrowed + timedelta(days=rng.randint(7, 28))
+                if returned >= now:
+                    continue
+                past.append(BorrowPast(item=item, user=user,
+                    user_group=user.group.name, borrow_date=borrowed,
+                    return_date=returned,
+                    item_snapshot=ItemSnapshot.from_item(item)))
+                item.borrow_count = (item.borrow_count or 0) + 1
+            if len(past) >= batch_size:
+                _insert(BorrowPast, past, batch_size)
+                past = []
+        _insert(BorrowPast, past, batch_size)
+
+    say('loans')
+    out = rng.sample(item_docs, int(len(item_docs) * on_loan))
+    for item in out:
+        user = rng.choice(user_docs)
+        borrowed = now - timedelta(days=rng.randint(0, 30))
+        item.borrow_current = BorrowCurrent(user=user,
+            user_group=user.group.name, borrow_date=borrowed,
+            due_date=get_due_date(user, item.item_class, borrowed))
+        item.borrow_count = (item.borrow_count or 0) + 1
+    collection = Item._get_collection()
+    for start in range(0, len(item_docs), batch_size):
+        ops = [UpdateOne({'_id': item.id}, {'$set': dict(
+                borrow_count=item.borrow_count or 0,
+                **({'borrow_current': item.borrow_current.to_mongo()}
+                    if item.borrow_current else {}))})
+            for item in item_docs[start:start + batch_size]]
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+
+    return {
+        'groups': len(group_docs),
+        'users': len(user_docs),
+        'items': len(item_docs),
+        'history': BorrowPast.objects.count(),
+        'on_loan': len(out),
+    }
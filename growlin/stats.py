@@ -0,0 +1,206 @@
+'''
+Circulation statistics.
+
+Rather than scanning the borrowing history whenever someone asks for
+numbers, CirculationStat documents hold running counts of borrowings and
+returns per day and per month, user group, item class and campus location.
+Each borrow or return bumps the day and month counts with $inc (upserting
+them as needed) in a single bulk write, and Item.borrow_count keeps the
+total for each item. Statistics pages read only these counts. A loan is
+counted under the group the user was in when borrowing it, both when
+borrowed and when returned.
+
+rebuild_stats() recomputes everything from BorrowPast and the items that
+are currently out, for a fresh start or after the counts have drifted.
+'''
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from .models import (Item, User, UserGroup, BorrowPast, CirculationStat,
+    campus_locations, item_borrowed, item_returned, item_class_name)
+
+def _periods(date):
+    '''Returns the (period, start) pairs that a date is counted in'''
+    return (('day', datetime(date.year, date.month, date.day)),
+        ('month', datetime(date.year, date.month, 1)))
+
+def _ref_id(value):
+    # Works for both DBRefs and documents, without loading anything
+    return getattr(value, 'id', None)
+
+def count_event(field, date, user_group, item_class, campus_location):
+    '''
+    Adds one to the "borrows" or "returns" count of the day and month of
+    the date, for the given group, item class and location id
+    '''
+    ops = [UpdateOne({
+            'period': period,
+            'date': start,
+            'user_group': user_group,
+            'item_class': item_class,
+            'campus_location': campus_location,
+        }, {'$inc': {field: 1}}, upsert=True)
+        for period, start in _periods(date)]
+    collection = CirculationStat._get_collection()
+    try:
+        collection.bulk_write(ops)
+    except BulkWriteError, e:
+        # Two upserts of the same new count at once: one of them fails on
+        # the unique index, and is simply done again as an update. The bulk
+        # write stops at the failed one, so carry on from there.
+        collection.bulk_write(ops[e.details['writeErrors'][0]['index']:])
+
+@item_borrowed.connect
+def record_borrow(user, item, borrow, **kwargs):
+    count_event('borrows', borrow.borrow_date, borrow.user_group,
+        item.item_class, _ref_id(item._data.get('campus_location')))
+
+@item_returned.connect
+def record_return(user, item, record, **kwargs):
+    count_event('returns', record.return_date, record.user_group,
+        item.item_class, _ref_id(item._data.get('campus_location')))
+
+def _by_day(date_field):
+    return {
+        'y': {'$year': date_field},
+        'm': {'$month': date_field},
+        'd': {'$dayOfMonth': date_field},
+    }
+
+def _past_pipeline(date_field):
+    '''Counts BorrowPast records per day of the given date field'''
+    return [
+        {'$match': {date_field: {'$ne': None}}},
+        {'$lookup': {'from': Item._get_collection_name(),
+            'localField': 'item', 'foreignField': '_id', 'as': 'item'}},
+        # Keeping records whose item has been deleted since
+        {'$unwind': {'path': '$item', 'preserveNullAndEmptyArrays': True}},
+        {'$group': {
+            '_id': dict(_by_day('$' + date_field),
+                user_group='$user_group',
+                cls='$item._cls',
+                snapshot_class='$item_snapshot.item_class',
+                campus_location='$item.campus_location'),
+            'n': {'$sum': 1}}},
+    ]
+
+def _current_pipeline():
+    '''
+    Counts the items currently out per day they were borrowed. Loans made
+    before the group was stored with them go under the user's group.
+    '''
+    return [
+        {'$match': {'borrow_current.user': {'$exists': True}}},
+        {'$lookup': {'from': User._get_collection_name(),
+            'localField': 'borrow_current.user', 'foreignField': '_id',
+            'as': 'user'}},
+        {'$unwind': '$user'},
+        {'$lookup': {'from': UserGroup._get_collection_name(),
+            'localField': 'user.group', 'foreignField': '_id',
+            'as': 'group'}},
+        {'$unwind': {'path': '$group', 'preserveNullAndEmptyArrays': True}},
+        {'$group': {
+            '_id': dict(_by_day('$borrow_current.borrow_date'),
+                user_group={'$ifNull': ['$borrow_current.user_group',
+                    '$group.name']},
+                cls='$_cls',
+                campus_location='$campus_location'),
+            'n': {'$sum': 1}}},
+    ]
+
+def rebuild_stats():
+    '''
+    Recomputes all the counts from the borrowing history and the items
+    currently out, replacing the existing ones. Counts made while this runs
+    may be lost, so run it when the library is quiet. Returns the number of
+    CirculationStat documents written.
+    '''
+    counts = {}
+    def add(field, results):
+        for r in results:
+            key = r['_id']
+            cls = key.get('cls')
+            item_class = (item_class_name(cls) if cls
+                else key.get('snapshot_class'))
+            date = datetime(key['y'], key['m'], key['d'])
+            for period, start in _periods(date):
+                doc = counts.setdefault((period, start, key.get('user_group'),
+                    item_class, key.get('campus_location')),
+                    {'borrows': 0, 'returns': 0})
+                doc[field] += r['n']
+
+    past = BorrowPast._get_collection()
+    add('borrows', past.aggregate(_past_pipeline('borrow_date')))
+    add('returns', past.aggregate(_past_pipeline('return_date')))
+    add('borrows', Item._get_collection().aggregate(_current_pipeline()))
+
+    collection = CirculationStat._get_collection()
+    collection.delete_many({})
+    if counts:
+        collection.insert_many([dict(values,
+                period=period, date=start, user_group=user_group,
+                item_class=item_class, campus_location=campus_location)
+            for (period, start, user_group, item_class, campus_location), values
+            in counts.items()])
+    _rebuild_borrow_counts()
+    return len(counts)
+
+def _rebuild_borrow_counts():
+    items = Item._get_collection()
+    items.update_many({}, {'$set': {'borrow_count': 0}})
+    ops = [UpdateOne({'_id': r['_id']}, {'$inc': {'borrow_count': r['n']}})
+        for r in BorrowPast._get_collection().aggregate([
+            {'$group': {'_id': '$item', 'n': {'$sum': 1}}}])
+        if r['_id'] is not None]
+    if ops:
+        items.bulk_write(ops, ordered=False)
+    items.update_many({'borrow_current.user': {'$exists': True}},
+        {'$inc': {'borrow_count': 1}})
+
+# Queries for the statistics pages. These only read the counts.
+
+def _month_start(months_back):
+    today = datetime.now()
+    month = today.year * 12 + today.month - 1 - months_back
+    return datetime(month // 12, month % 12 + 1, 1)
+
+def borrows_by_group(months=12):
+    '''
+    Returns the list of the last "months" month starts, and a list of
+    (user group, [borrows in each month]) pairs
+    '''
+    starts = [_month_start(i) for i in range(months - 1, -1, -1)]
+    index = dict((start, i) for i, start in enumerate(starts))
+    groups = {}
+    for r in CirculationStat._get_collection().aggregate([
+            {'$match': {'period': 'month', 'date': {'$gte': starts[0]}}},
+            {'$group': {'_id': {'group': '$user_group', 'date': '$date'},
+                'borrows': {'$sum': '$borrows'}}}]):
+        row = groups.setdefault(r['_id']['group'], [0] * months)
+        if r['_id']['date'] in index:
+            row[index[r['_id']['date']]] += r['borrows']
+    return starts, sorted(groups.items())
+
+def borrows_by(field, months=12):
+    '''
+    Returns (value, borrows) pairs for a field ("user_group", "item_class"
+    or "campus_location") over the last "months" months, busiest first.
+    Locations are given by name.
+    '''
+    results = CirculationStat._get_collection().aggregate([
+        {'$match': {'period': 'month', 'date': {'$gte': _month_start(months - 1)}}},
+        {'$group': {'_id': '$' + field, 'borrows': {'$sum': '$borrows'}}},
+        {'$sort': {'borrows': -1}}])
+    totals = []
+    for r in results:
+        value = r['_id']
+        if field == 'campus_location':
+            location = campus_locations.get('pk', value)
+            value = location.name if location else None
+        totals.append((value, r['borrows']))
+    return totals
+
+def most_borrowed(limit=10):
+    '''Returns the items borrowed most often, ever'''
+    return (Item.objects(borrow_count__gt=0).order_by('-borrow_count')
+        .only('accession', 'title', 'borrow_count').limit(limit))
@@ -1,5 +1,39 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timedelta
+import zlib
+from bson import ObjectId
 import unittest
-from models import UserGroup, User, CampusLocation, Item, BorrowPast, BorrowError, AlreadyBorrowed
+from models import UserGroup, UserRole, User, CampusLocation, Creator, Item, ItemType, BookItem, BorrowPast, BorrowError, AlreadyBorrowed, AccessionMismatch, AccessionCounter, CirculationStat, JournalConflict, LoanPolicy, SlowQuery, IdentityVersion, get_overdue_items, split_accession, item_types, get_item_types
+from auth import load_user
+from roster import get_roster, get_group_members
+from importer import import_items, load_checkpoint, ImportJob
+from export import export_register
+import stats
+import search
+import views
+import autocomplete
+import journal
+import seed
+import indexes
+import benchmark
+import loadtest
+from app import app, request_metrics
+from util.metrics import Histogram, RollingHistogram
+from util.monitoring import Command
+from util.queryshape import fingerprint, QueryWatcher, RepeatedQueries, watch_queries
+import querylog
+import migrations
+from util.prefetch import prefetch
+from util.pagination import keyset_page, iter_keyset_pages, encode_cursor, decode_cursor
+import profiler
+from admin import KeysetModelView, AdminAccessionCounter, AdminModelBookItem, AdminModelBorrowing
+from StringIO import StringIO
+from werkzeug.exceptions import BadRequest
+from accession import allocate_accession, reserve_accessions, resolve_accession, resolve_accessions
 import mongoengine as mongo
 from mongoengine.context_managers import switch_db
 
@@ -12,10 +46,10 @@ class GrowlinModelTestCase(unittest.TestCase):
         self.g2 = UserGroup(name='Jupiter').save()
 
         # Users       
-        self.u1 = User(name='Phobos', group=self.g1).save()
-        self.u2 = User(name='Deimos', group=self.g1).save()
-        self.u3 = User(name='Europa', group=self.g2).save()
-        self.u4 = User(name='Ganymede', group=self.g2).save()
+        self.u1 = User(username='phobos', name='Phobos', group=self.g1).save()
+        self.u2 = User(username='deimos', name='Deimos', group=self.g1).save()
+        self.u3 = User(username='europa', name='Europa', group=self.g2).save()
+        self.u4 = User(username='ganymede', name='Ganymede', group=self.g2).save()
 
         # Locations
         self.l1 = CampusLocation(name='Main').save()
@@ -26,7 +60,18 @@ class GrowlinModelTestCase(unittest.TestCase):
         self.i3 = Item(title='This thing', campus_location=self.l1, accession='3').save()
         self.i4 = Item(title='That thing', campus_location=self.l1, accession='4').save()
 
+    def client(self, user):
+        '''Returns a test client logged in as a user'''
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+        return client
+
     def tearDown(self):
+        AccessionCounter.objects().delete()
+        CirculationStat.objects().delete()
+        JournalConflict.objects().delete()
         BorrowPast.objects().delete()
         Item.objects().delete()
         CampusLocation.objects().delete()
@@ -82,6 +127,33 @@ class BorrowTestCase(GrowlinModelTestCase):
         self.u1.borrow(self.i2, '2')
         assert(self.u1.get_current_borrowings().count() == 2)
 
+    def test_past_borrow_snapshot(self):
+        self.u1.borrow(self.i1, '1')
+        p = self.u1.unborrow(self.i1, '1')
+        assert(p.item_snapshot.title == self.i1.title)
+        assert(p.item_snapshot.accession == '1')
+        # The record still makes sense when the item is gone
+        self.i1.delete()
+        p = BorrowPast.objects.get(id=p.id)
+        assert(p.get_snapshot().title == 'Nothing')
+
+    def test_deleted_item_without_snapshot(self):
+        self.u1.borrow(self.i1, '1')
+        p = self.u1.unborrow(self.i1, '1')
+        # Recorded before snapshots were kept, and the item since deleted
+        BorrowPast._get_collection().update_one({'_id': p.id},
+            {'$unset': {'item_snapshot': True}})
+        Item._get_collection().delete_one({'_id': self.i1.id})
+        p = BorrowPast.objects.get(id=p.id)
+        assert(p.get_snapshot().title == 'Deleted item')
+        # As the history loads them
+        prefetch([p], 'item', 'item.authors')
+        assert(p.get_snapshot().title == 'Deleted item')
+        assert(unicode(p).startswith('Deleted item by'))
+        assert(migrations.backfill_item_snapshots() == (1, 1))
+        p.reload()
+        assert(p.item_snapshot.title == 'Deleted item')
+
     def test_past_borrow_lists(self):
         assert(self.u1.get_past_borrowings().count() == 0)
         self.u1.borrow(self.i1, '1')
@@ -90,5 +162,1015 @@ class BorrowTestCase(GrowlinModelTestCase):
         assert(self.u1.get_past_borrowings().count() == 1)
         assert(self.u1.get_past_borrowings()[0].item.title == self.i1.title)
 
+class ConcurrentBorrowTestCase(GrowlinModelTestCase):
+    '''
+    Hammers a single item from many threads at once. Each thread works on
+    its own copy of the item, as separate kiosks would.
+    '''
+    threads = 16
+    # Methods of a pymongo Collection that send a command
+    COMMANDS = ('find', 'find_one', 'find_one_and_update', 'find_and_modify',
+        'update', 'update_one', 'update_many', 'insert', 'insert_one',
+        'insert_many', 'save', 'bulk_write', 'count', 'aggregate')
+
+    def _race(self, action):
+        start = threading.Event()
+        results = []
+        lock = threading.Lock()
+        def worker(n):
+            user = User(username='racer%d' % n, name='Racer %d' % n,
+                group=self.g1).save()
+            item = Item.objects.get(id=self.i1.id)
+            start.wait()
+            try:
+                action(user, item)
+                outcome = 'ok'
+            except BorrowError, e:
+                outcome = e
+            with lock:
+                results.append(outcome)
+        workers = [threading.Thread(target=worker, args=(n,))
+            for n in range(self.threads)]
+        for w in workers: w.start()
+        start.set()
+        for w in workers: w.join()
+        return results
+
+    def _item_commands(self, action):
+        '''Returns the commands that action() sends to the Item collection'''
+        collection = Item._get_collection()
+        commands = []
+        COMMANDS = self.COMMANDS
+        class Counting(object):
+            def __getattr__(self, name):
+                if name in COMMANDS:
+                    commands.append(name)
+                return getattr(collection, name)
+        Item._get_collection = classmethod(lambda cls: Counting())
+        try:
+            action()
+        finally:
+            del Item._get_collection
+        return commands
+
+    def test_one_command_each(self):
+        # Checking and changing the loan is a single findAndModify, where
+        # reading the item and then saving it took two
+        item = Item.objects.get(id=self.i1.id)
+        # As read by another kiosk before the borrow
+        other = Item.objects.get(id=self.i1.id)
+        assert(self._item_commands(lambda: self.u1.borrow(item, '1')) ==
+            ['find_one_and_update'])
+        lost = lambda: self.assertRaises(AlreadyBorrowed, self.u2.borrow,
+            other, '1')
+        assert(self._item_commands(lost) == ['find_one_and_update'])
+        assert(self._item_commands(lambda: self.u1.unborrow(item, '1')) ==
+            ['find_one_and_update'])
+
+    def test_one_borrower_wins(self):
+        results = self._race(lambda user, item: user.borrow(item, '1'))
+        winners = [r for r in results if r == 'ok']
+        losers = [r for r in results if r != 'ok']
+        assert(len(winners) == 1)
+        assert(all(isinstance(r, AlreadyBorrowed) for r in losers))
+        assert(Item.objects.get(id=self.i1.id).borrow_current is not None)
+
+    def test_one_return_wins(self):
+        self.u1.borrow(self.i1, '1')
+        results = self._race(lambda user, item: self.u1.unborrow(item, '1'))
+        winners = [r for r in results if r == 'ok']
+        assert(len(winners) == 1)
+        assert(BorrowPast.objects(item=self.i1).count() == 1)
+        assert(Item.objects.get(id=self.i1.id).borrow_current is None)
+
+    def test_accession_mismatch(self):
+        with self.assertRaises(AccessionMismatch):
+            self.u1.borrow(self.i1, '2')
+        assert(Item.objects.get(id=self.i1.id).borrow_current is None)
+
+class AccessionAllocatorTestCase(GrowlinModelTestCase):
+
+    def test_allocate_after_existing(self):
+        # Counter is seeded from the existing register (accessions 1-4)
+        assert(allocate_accession() == '5')
+        assert(allocate_accession() == '6')
+
+    def test_reserve_block(self):
+        assert(reserve_accessions(3) == ['5', '6', '7'])
+        assert(allocate_accession() == '8')
+
+    def test_prefixes_are_separate(self):
+        assert(allocate_accession('P') == 'P:1')
+        assert(allocate_accession() == '5')
+        assert(allocate_accession('P') == 'P:2')
+
+    def test_read_only_in_admin(self):
+        view = AdminAccessionCounter(AccessionCounter,
+            endpoint='test_counters')
+        assert(not (view.can_create or view.can_edit or view.can_delete))
+
+class AccessionLookupTestCase(GrowlinModelTestCase):
+
+    def test_split_accession(self):
+        assert(split_accession('B:0042') == ('b', '42'))
+        assert(split_accession('42') == ('', '42'))
+
+    def test_resolve(self):
+        b = BookItem(title='Prefixed', campus_location=self.l1, accession='B:42').save()
+        assert(resolve_accession('1') == self.i1)
+        assert(resolve_accession('B:42') == b)
+        assert(resolve_accession('b-042') == b)
+        assert(resolve_accession('B42') == b)
+        assert(resolve_accession('42', item_type='book') == b)
+        assert(resolve_accession('1', item_type='book') is None)
+        assert(resolve_accession('99') is None)
+
+    def test_resolve_many(self):
+        b = BookItem(title='Prefixed', campus_location=self.l1, accession='B:42').save()
+        found = resolve_accessions(['1', 'b-042', '42', '99'])
+        assert(found == {'1': self.i1, 'b-042': b, '42': b, '99': None})
+        assert(resolve_accessions(['42'], item_type='book') == {'42': b})
+
+    def test_borrow_without_prefix(self):
+        b = BookItem(title='Prefixed', campus_location=self.l1, accession='B:42').save()
+        self.u1.borrow(b, '42')
+        try:
+            self.u1.unborrow(b, 'P:42')
+        except AccessionMismatch: pass
+        assert(b.borrow_current is not None)
+        self.u1.unborrow(b, 'b42')
+        assert(b.borrow_current is None)
+
+class PrefetchTestCase(GrowlinModelTestCase):
+
+    def test_prefetch_past_items(self):
+        self.u1.borrow(self.i1, '1')
+        self.u1.borrow(self.i2, '2')
+        self.u1.unborrow(self.i1, '1')
+        self.u1.unborrow(self.i2, '2')
+        records = self.u1.get_past_borrowings().prefetch('item', 'user')
+        assert(len(records) == 2)
+        for r in records:
+            # Already loaded, so reading them needs no more queries
+            assert(isinstance(r._data['item'], Item))
+            assert(isinstance(r._data['user'], User))
+        assert(records[0].item.title == self.i2.title)
+
+class RosterTestCase(GrowlinModelTestCase):
+
+    def test_roster(self):
+        self.u1.password = 'secret'
+        self.u1.save()
+        User(username='inactive', name='Aaron', group=self.g1,
+            active=False).save()
+        self.g2.position = 1
+        self.g2.save()
+        roster = get_roster()
+        assert([g['name'] for g in roster] == ['Mars', 'Jupiter'])
+        mars = roster[0]
+        assert(mars['count'] == 2)
+        assert([(u['name'], u['has_password']) for u in mars['users']] ==
+            [('Deimos', False), ('Phobos', True)])
+        assert(get_roster() is roster)
+
+    def test_invalidated(self):
+        roster = get_roster()
+        self.u4.name = 'Callisto'
+        self.u4.save()
+        assert(get_roster() is not roster)
+        names = [u['name'] for u in get_group_members(str(self.g2.id))]
+        assert(names == ['Callisto', 'Europa'])
+
+        self.u4.delete()
+        assert(len(get_group_members(str(self.g2.id))) == 1)
+        self.g2.name = 'Saturn'
+        self.g2.save()
+        assert(get_roster()[1]['name'] == 'Saturn')
+        self.g2.delete()
+        assert(get_group_members(str(self.g2.id)) is None)
+
+    def test_group_members(self):
+        client = app.test_client()
+        response = client.get('/login/groups/%s/' % self.g1.id)
+        assert(response.status_code == 200)
+        users = json.loads(response.get_data())['users']
+        assert([u['username'] for u in users] == ['deimos', 'phobos'])
+        assert(all(set(u) == set(['username', 'name', 'has_password'])
+            for u in users))
+        assert(client.get('/login/groups/%s/' % ObjectId()).status_code
+            == 404)
+
+class IndexesTestCase(GrowlinModelTestCase):
+
+    def test_declared(self):
+        names = []
+        for name, f in indexes.hot_queries():
+            assert indexes.declared_index(f()) is not None, name
+            names.append(name)
+        assert('login roster' in names and 'history page' in names)
+        assert(indexes.declared_index(User.objects(email='x')) is None)
+        assert(indexes.declared_index((User,
+            [{'$match': {'email': 'x'}}, {'$sort': {'email': 1}}])) is None)
+
+    def test_ensure(self):
+        models = indexes.ensure_all_indexes()
+        # Subclasses share their base class's collection
+        assert(User in models and Item in models and BookItem not in models)
+
+    def test_stages(self):
+        explained = {'queryPlanner': {'winningPlan': {'stage': 'FETCH',
+            'inputStage': {'stage': 'IXSCAN'}}}}
+        assert(indexes.scan_stages(explained) == ['FETCH', 'IXSCAN'])
+        explained = {'stages': [{'$cursor': {'queryPlanner': {
+            'winningPlan': {'stage': 'COLLSCAN'}}}}]}
+        assert(indexes.scan_stages(explained) == ['COLLSCAN'])
+
+class HistoryPaginationTestCase(GrowlinModelTestCase):
+
+    def setUp(self):
+        super(HistoryPaginationTestCase, self).setUp()
+        # All returned at the same moment, so only the ids tell them apart
+        returned = datetime(2016, 1, 1, 10, 30, 15, 123000)
+        self.records = [BorrowPast(item=self.i1, user=self.u1,
+                user_group='Mars', borrow_date=returned - timedelta(days=1),
+                return_date=returned).save() for n in range(11)]
+        BorrowPast(item=self.i2, user=self.u2, user_group='Mars',
+            borrow_date=returned, return_date=returned).save()
+
+    def test_same_return_date(self):
+        seen = []
+        after = None
+        while True:
+            rows, after = keyset_page(self.u1.get_past_borrowings(),
+                'return_date', after, per_page=4)
+            assert(len(rows) <= 4)
+            seen.extend(r.id for r in rows)
+            if after is None:
+                break
+            value, id = decode_cursor(after)
+            assert(value == self.records[0].return_date)
+        assert(seen == sorted((r.id for r in self.records), reverse=True))
+        pages = list(iter_keyset_pages(self.u1.get_past_borrowings(),
+            'return_date', per_page=4))
+        assert([len(p) for p in pages] == [4, 4, 3])
+
+    def test_bad_cursor(self):
+        client = self.client(self.u1)
+        for after in ('nonsense', encode_cursor('x', self.u1.id)[:-4]):
+            response = client.get('/shelf/history/?after=%s' % after)
+            assert(response.status_code == 400)
+        response = client.get('/shelf/history.json?after=%s' % encode_cursor(
+            self.records[5].return_date, self.records[5].id))
+        assert(response.status_code == 200)
+        assert(len(json.loads(response.get_data())['records']) == 5)
+
+    def test_csv(self):
+        # Several pages, the last one not full
+        views.HISTORY_CSV_PAGE_SIZE = 4
+        try:
+            response = self.client(self.u1).get('/shelf/history.csv')
+            lines = response.get_data().splitlines()
+        finally:
+            views.HISTORY_CSV_PAGE_SIZE = 500
+        assert(lines[0] == 'accession,title,author,borrow_date,return_date')
+        assert(len(lines) - 1 == BorrowPast.objects(user=self.u1).count())
+
+class IdentityCacheTestCase(GrowlinModelTestCase):
+
+    def tearDown(self):
+        IdentityVersion.objects().delete()
+        super(IdentityCacheTestCase, self).tearDown()
+
+    def test_cached_until_saved(self):
+        userid = str(self.u1.id)
+        users = User._get_collection()
+        user = load_user(userid)
+        # Changed behind its back, so only seen once the cache is not used
+        users.update_one({'_id': self.u1.id}, {'$set': {'name': 'Deimos'}})
+        cached = load_user(userid)
+        assert(cached.name == user.name and cached.group == self.g1)
+        assert(isinstance(cached._data['group'], UserGroup))
+        assert(cached is not user)
+
+        self.u1.name = 'Phobos I'
+        self.u1.save()
+        user = load_user(userid)
+        assert(user.name == 'Phobos I')
+        # Every request gets a copy of its own
+        user.name = 'Changed'
+        user.roles.append(UserRole(name='x'))
+        assert(load_user(userid).name == 'Phobos I')
+        assert(load_user(userid).roles == [])
+
+        # Changing a group outdates every cached user
+        users.update_one({'_id': self.u1.id}, {'$set': {'name': 'Deimos'}})
+        self.g2.save()
+        assert(load_user(userid).name == 'Deimos')
+
+    def test_changed_by_another_process(self):
+        userid = str(self.u1.id)
+        load_user(userid)
+        User._get_collection().update_one({'_id': self.u1.id},
+            {'$set': {'name': 'Deimos'}})
+        # As another process's invalidate_user() would
+        IdentityVersion._get_collection().update_one({'_id': userid},
+            {'$inc': {'version': 1}}, upsert=True)
+        assert(load_user(userid).name == 'Deimos')
+
+class MetadataRegistryTestCase(GrowlinModelTestCase):
+
+    def tearDown(self):
+        ItemType.objects().delete()
+        super(MetadataRegistryTestCase, self).tearDown()
+
+    def test_reload_on_save(self):
+        ItemType(name='book', prefix='B').save()
+        assert(get_item_types() == ['book'])
+        assert(item_types.get('prefix', 'B').name == 'book')
+        assert(item_types.get('prefix', 'P') is None)
+
+        ItemType(name='periodical', prefix='P').save()
+        assert(item_types.get('prefix', 'P').name == 'periodical')
+        ItemType.objects(name='book').first().delete()
+        assert(get_item_types() == ['periodical'])
+
+class ImporterTestCase(GrowlinModelTestCase):
+
+    def tearDown(self):
+        Creator.objects().delete()
+        super(ImporterTestCase, self).tearDown()
+
+    def test_import_csv(self):
+        data = StringIO('\n'.join([
+            'accession,title,authors,publication_year',
+            '10,Dune,Frank Herbert,1965',
+            ',Dune Messiah,Frank Herbert,1969',
+            ',The Hobbit,J. R. R. Tolkien;Christopher Tolkien,',
+            '11,,Nobody,',
+            ',Bad year,,MCMLXV',
+        ]))
+        result = import_items(data, default_location='Main', batch_size=2)
+        assert(result.imported == 3)
+        assert([p for p, m in result.errors] == [5, 6])
+        assert(Creator.objects.count() == 4)
+        # Only the books written count
+        uses = dict((c.name, c.uses) for c in Creator.objects)
+        assert(uses == {'Frank Herbert': 2, 'J. R. R. Tolkien': 1,
+            'Christopher Tolkien': 1, 'Nobody': 0})
+
+        book = BookItem.objects.get(title='Dune Messiah')
+        assert(book.accession == '11')
+        assert(book.authors[0].name == 'Frank Herbert')
+        assert(book.campus_location == self.l1)
+        assert(book.accession_key == '11')
+
+    def test_resume_interrupted_write(self):
+        data = 'title\nA\nB\nC\n'
+        directory = tempfile.mkdtemp()
+        checkpoint = os.path.join(directory, 'checkpoint')
+        collection = BookItem._get_collection()
+        uses = self.l1.reload().uses
+        class Interrupted(object):
+            # Only the first book is written
+            def __getattr__(self, name):
+                return getattr(collection, name)
+            def insert_many(self, documents, ordered=True):
+                collection.insert_one(documents[0])
+                raise IOError('Interrupted')
+        BookItem._get_collection = classmethod(lambda cls: Interrupted())
+        try:
+            with self.assertRaises(IOError):
+                import_items(StringIO(data), checkpoint=checkpoint,
+                    default_location='Main')
+        finally:
+            del BookItem._get_collection
+        try:
+            # By position: rows 2 to 4
+            pending = load_checkpoint(checkpoint).pending
+            reserved = dict((title, pending[p][1])
+                for title, p in zip('ABC', sorted(pending)))
+            result = import_items(StringIO(data), checkpoint=checkpoint,
+                default_location='Main')
+        finally:
+            shutil.rmtree(directory)
+        assert(result.imported == 3)
+        assert(result.pending == {})
+        # Counted once each, including the one written before the interruption
+        assert(self.l1.reload().uses == uses + 3)
+        for title in 'ABC':
+            book = BookItem.objects.get(title=title)
+            assert(book.accession == reserved[title])
+
+    def test_job(self):
+        directory = tempfile.mkdtemp()
+        try:
+            job = ImportJob.create(directory, StringIO('title\nA\nB\n'),
+                'books.csv', default_location='Main')
+            assert(not job.finished)
+            job.run()
+            job = ImportJob.get(directory, job.name)
+            assert(job.finished and not job.running and not job.failure)
+            assert(job.result().imported == 2)
+            assert(not job.start())
+            assert([j.name for j in ImportJob.all(directory)] == [job.name])
+            with self.assertRaises(KeyError):
+                ImportJob.get(directory, '../' + job.name)
+        finally:
+            shutil.rmtree(directory)
+
+class ExportTestCase(GrowlinModelTestCase):
+
+    def tearDown(self):
+        Creator.objects().delete()
+        super(ExportTestCase, self).tearDown()
+
+    def test_export(self):
+        author = Creator(name='Frank Herbert').save()
+        BookItem(title='Dune', campus_location=self.l1, accession='5',
+            authors=[author]).save()
+        lines = ''.join(export_register('jsonl', batch_size=2)).splitlines()
+        assert(len(lines) == 5)
+        row = json.loads(lines[-1])
+        assert(row['authors'] == ['Frank Herbert'])
+        assert(row['campus_location'] == 'Main')
+        assert(row['item_class'] == 'book')
+
+        data = zlib.decompress(''.join(export_register('csv', gzip=True)),
+            16 + zlib.MAX_WBITS)
+        assert(data.splitlines()[0].startswith('accession,item_class,title'))
+        assert(len(data.splitlines()) == 6)
+
+class StatsTestCase(GrowlinModelTestCase):
+
+    def circulate(self):
+        self.u1.borrow(self.i1, '1')
+        self.u1.unborrow(self.i1, '1')
+        self.u3.borrow(self.i1, '1')
+        self.u3.borrow(self.i2, '2')
+
+    def test_counted_on_borrow(self):
+        self.circulate()
+        month = CirculationStat.objects.get(period='month', user_group='Jupiter')
+        assert(month.borrows == 2)
+        assert(month.campus_location == self.l1)
+        assert(CirculationStat.objects(period='day').count() == 2)
+        assert(stats.borrows_by('user_group') == [('Jupiter', 2), ('Mars', 1)])
+        assert([i.borrow_count for i in stats.most_borrowed()] == [2, 1])
+
+    def needs_lookup(self):
+        version = Item._get_db().command('buildinfo')['versionArray']
+        if version < [3, 2]:
+            self.skipTest('Needs a server with $lookup (MongoDB 3.2+)')
+
+    def counts(self):
+        return sorted((s.period, s.date, s.user_group, s.borrows, s.returns)
+            for s in CirculationStat.objects)
+
+    def test_rebuild(self):
+        self.needs_lookup()
+        self.circulate()
+        before = self.counts()
+        Item.objects.update(borrow_count=0)
+        assert(stats.rebuild_stats() == 4)
+        assert(self.counts() == before)
+        assert([i.borrow_count for i in stats.most_borrowed()] == [2, 1])
+
+    def test_rebuild_after_group_change(self):
+        self.needs_lookup()
+        self.u1.borrow(self.i1, '1')
+        self.u3.borrow(self.i2, '2')
+        # Both move groups with their loans still out
+        User.objects(id=self.u1.id).update(set__group=self.g2)
+        User.objects(id=self.u3.id).update(set__group=self.g1)
+        self.u1.reload()
+        self.u1.unborrow(self.i1, '1')
+        before = self.counts()
+        assert(stats.borrows_by('user_group') == [('Jupiter', 1), ('Mars', 1)])
+        month = CirculationStat.objects.get(period='month', user_group='Mars')
+        assert((month.borrows, month.returns) == (1, 1))
+        stats.rebuild_stats()
+        assert(self.counts() == before)
+
+class LoanPolicyTestCase(GrowlinModelTestCase):
+
+    def tearDown(self):
+        LoanPolicy.objects().delete()
+        super(LoanPolicyTestCase, self).tearDown()
+
+    def test_due_date(self):
+        LoanPolicy(loan_days=7).save()
+        LoanPolicy(user_group=self.g2, loan_days=21, longterm_days=60).save()
+        self.u1.borrow(self.i1, '1')
+        self.u3.borrow(self.i2, '2')
+        self.u3.borrow(self.i3, '3', longterm=True)
+        for item, days in ((self.i1, 7), (self.i2, 21), (self.i3, 60)):
+            b = item.borrow_current
+            assert((b.due_date - b.borrow_date).days == days)
+
+    def test_overdue(self):
+        self.u1.borrow(self.i1, '1')
+        self.u3.borrow(self.i2, '2')
+        Item.objects(id=self.i2.id).update(
+            set__borrow_current__due_date=datetime.now() - timedelta(1))
+        overdue = get_overdue_items().prefetch('borrow_current.user',
+            'borrow_current.user.group')
+        assert([i.title for i in overdue] == [self.i2.title])
+        assert(overdue[0].borrow_current._data['user'].group.name == 'Jupiter')
+
+class SearchTermsTestCase(GrowlinModelTestCase):
+
+    def tearDown(self):
+        Creator.objects().delete()
+        super(SearchTermsTestCase, self).tearDown()
+
+    def test_kept_up_to_date(self):
+        author = Creator(name='Frank Herbert').save()
+        book = BookItem(title='Dune', campus_location=self.l1, accession='5',
+            authors=[author], isbn='978-0-441-17271-9').save()
+        assert(book.search_terms ==
+            ['Frank Herbert', '978-0-441-17271-9', '9780441172719'])
+
+        author.name = 'F. Herbert'
+        author.save()
+        book.reload()
+        assert(book.search_terms[0] == 'F. Herbert')
+
+    def test_reindexed_on_rename_only(self):
+        author = Creator(name='Frank Herbert').save()
+        book = BookItem(title='Dune', campus_location=self.l1, accession='5',
+            authors=[author]).save()
+        BookItem.objects(id=book.id).update(search_terms=['stale'])
+        author.uses = 5
+        author.save()
+        assert(book.reload().search_terms == ['stale'])
+        author.name = 'F. Herbert'
+        author.save()
+        assert(book.reload().search_terms == ['F. Herbert'])
+
+class SearchTestCase(GrowlinModelTestCase):
+
+    def test_ranked_query(self):
+        queryset = search.search_queryset('dune', 'book',
+            campus_location=self.l1.id, available=True)
+        assert(queryset._document is BookItem)
+        assert(queryset._query == {'$text': {'$search': 'dune'},
+            '_cls': 'Item.BookItem', 'campus_location': self.l1.id, 'borrow_current.user': None})
+        # Best match first, with the score fetched to sort on
+        assert(queryset._ordering ==
+            [('_text_score', {'$meta': 'textScore'})])
+        assert(queryset._cursor_args['projection']['_text_score'] ==
+            {'$meta': 'textScore'})
+        assert(search.search_queryset(' ', 'book') is None)
+        assert(search.search_queryset('dune', 'scroll') is None)
+        assert(search.search('dune', page=search.MAX_PAGE + 1) == ([], False))
+
+    def test_bad_location(self):
+        with app.test_request_context('/search/?q=dune&location=nowhere'):
+            with self.assertRaises(BadRequest):
+                views._search_request()
+
+class AutocompleteTestCase(GrowlinModelTestCase):
+
+    def tearDown(self):
+        Creator.objects().delete()
+        super(AutocompleteTestCase, self).tearDown()
+
+    def test_lookup(self):
+        herbert = Creator(name='Frank Herbert').save()
+        Creator(name='Brian Herbert').save()
+        herb = Creator(name='Herb').save()
+        BookItem(title='Dune', campus_location=self.l1, accession='5',
+            authors=[herbert]).save()
+        assert(herbert.reload().uses == 1)
+
+        names = lambda term: [c.name for c in autocomplete.lookup(Creator, term)]
+        # Prefix matches in name key order, whatever their use
+        assert(names('HERB') == ['Herb', 'Brian Herbert', 'Frank Herbert'])
+        # Only the exact matches are ranked by use
+        other = Creator(name='Herb.').save()
+        BookItem(title='Dune Messiah', campus_location=self.l1, accession='6',
+            authors=[other]).save()
+        assert([c.id for c in autocomplete.lookup(Creator, 'herb')][:2] ==
+            [other.id, herb.id])
+        assert(names('fra') == ['Frank Herbert'])
+        assert(names('rank') == [])
+
+        Creator.objects.update(uses=0)
+        autocomplete.rebuild(Creator)
+        assert(names('herbert') == ['Frank Herbert', 'Brian Herbert'])
+
+    def test_lookup_pages(self):
+        for n in range(12):
+            Creator(name='Author %02d' % n, uses=n % 4).save()
+        Creator(name='Auth').save()
+        pages = [[c.name for c in autocomplete.lookup(Creator, 'auth',
+            offset, 5)] for offset in (0, 5, 10)]
+        found = sum(pages, [])
+        # Every match once, the exact one first and then in name order
+        assert(len(found) == len(set(found)) == 13)
+        assert(found[0] == 'Auth')
+        assert(found[1:] == sorted(found[1:]))
+
+class KeysetModelViewTestCase(GrowlinModelTestCase):
+
+    def test_pages(self):
+        for n, title in enumerate(['Something', 'Alpha', 'Zeta', 'Alpha', 'Beta']):
+            Item(title=title, campus_location=self.l1,
+                accession=str(10 + n)).save()
+        view = KeysetModelView(Item, endpoint='test_keyset')
+        for column, desc in ((None, False), ('title', False), ('title', True),
+                ('accession', True)):
+            expected = list(Item.objects.order_by(
+                ('-' if desc else '') + (column or 'id'),
+                ('-' if desc else '') + 'id'))
+            # Forwards, backwards, then straight to the last page
+            for pages in ([0, 1, 2, 3], [3, 2, 1, 0], [0, 4], [4]):
+                for page in pages:
+                    count, rows = view.get_list(page, column, desc, None, [],
+                        page_size=2)
+                    assert(count == 9)
+                    assert(rows == expected[page * 2:page * 2 + 2])
+
+    def test_no_filters(self):
+        # Flask-Admin passes None for the filters of such views
+        view = KeysetModelView(Item, endpoint='test_keyset_plain')
+        assert(not view.column_filters)
+        count, rows = view.get_list(0, None, False, None, None, page_size=3)
+        assert(count == 4)
+        assert(rows == list(Item.objects.order_by('id')[:3]))
+
+class AdminListPrefetchTestCase(GrowlinModelTestCase):
+
+    def test_list_references(self):
+        author = Creator(name='Ursula').save()
+        BookItem(title='Earthsea', authors=[author], campus_location=self.l1,
+            accession='10').save()
+        count, rows = AdminModelBookItem(BookItem,
+            endpoint='test_books').get_list(0, None, False, None, [])
+        # Already loaded, so showing them needs no more queries
+        assert(isinstance(rows[0]._data['authors'][0], Creator))
+        assert(isinstance(rows[0]._data['campus_location'], CampusLocation))
+        assert(rows[0].authors[0].name == 'Ursula')
+
+        self.u1.borrow(self.i1, '1')
+        self.u1.unborrow(self.i1, '1')
+        count, rows = AdminModelBorrowing(BorrowPast,
+            endpoint='test_borrowings').get_list(0, None, False, None, [])
+        assert(isinstance(rows[0]._data['user'], User))
+        assert(isinstance(rows[0].user._data['group'], UserGroup))
+        # Has a snapshot, so the item is not needed
+        assert(not isinstance(rows[0]._data['item'], Item))
+        Creator.objects().delete()
+
+class BorrowManyTestCase(GrowlinModelTestCase):
+
+    def test_borrow_return_many(self):
+        self.u2.borrow(self.i2)
+        errors = self.u1.borrow_many([self.i1, self.i2, self.i3])
+        assert(errors[0] is None and errors[2] is None)
+        assert(isinstance(errors[1], AlreadyBorrowed))
+        for i in (self.i1, self.i3):
+            i.reload()
+            assert(i.borrow_current.user == self.u1)
+            assert(i.borrow_count == 1)
+
+        # Taken by someone else since it was read
+        Item.objects(id=self.i4.id).update(set__borrow_current__user=self.u2)
+        errors = self.u1.borrow_many([self.i4])
+        assert(isinstance(errors[0], AlreadyBorrowed))
+
+        results = self.u1.unborrow_many([self.i1, self.i2, self.i3])
+        assert(isinstance(results[0], BorrowPast))
+        assert(isinstance(results[1], BorrowError))
+        assert(results[2].item_snapshot.title == self.i3.title)
+        assert(BorrowPast.objects(user=self.u1).count() == 2)
+        assert(Item.objects(borrow_current__user=self.u1).count() == 0)
+
+    def test_return_race(self):
+        self.u1.borrow_many([self.i1, self.i2])
+        # Ended by a concurrent unborrow() that has not saved its record yet
+        Item._get_collection().update_one({'_id': self.i1.id},
+            {'$unset': {'borrow_current': True}})
+        results = self.u1.unborrow_many([self.i1, self.i2])
+        assert(isinstance(results[0], BorrowError))
+        assert(isinstance(results[1], BorrowPast))
+        assert(BorrowPast.objects(user=self.u1).count() == 1)
+        assert(BorrowPast.objects(item=self.i1).count() == 0)
+        assert(self.i2.reload().last_return == results[1].id)
+
+    def test_api(self):
+        client = self.client(self.u1)
+        post = lambda data, **kwargs: client.post('/api/circulation',
+            data=json.dumps(data), content_type='application/json', **kwargs)
+        response = client.post('/api/circulation',
+            data={'action': 'borrow', 'accessions': '1'})
+        assert(response.status_code == 400)
+        response = post({'action': 'borrow',
+            'accessions': ['1'] * (views.API_BATCH_SIZE + 1)})
+        assert(response.status_code == 400)
+
+        response = post({'action': 'borrow', 'accessions': ['1', '2', '1', '9']})
+        assert(response.status_code == 200)
+        results = json.loads(response.get_data())['results']
+        assert([r['ok'] for r in results] == [True, True, False, False])
+        assert(results[2]['error'] == 'Listed more than once')
+        assert(results[3]['error'] == 'No such item')
+        assert(Item.objects(borrow_current__user=self.u1).count() == 2)
+
+        results = json.loads(post({'action': 'return',
+            'accessions': ['2', '3']}).get_data())['results']
+        assert([r['ok'] for r in results] == [True, False])
+        assert(BorrowPast.objects(user=self.u1).count() == 1)
+
+class JournalTestCase(GrowlinModelTestCase):
+
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(JournalTestCase, self).tearDown()
+
+    def entry(self, action, user, item, minute):
+        return {'action': action, 'user': str(user.id), 'item': str(item.id),
+            'date': '2016-01-01T10:%02d:00.000000' % minute}
+
+    def test_replay(self):
+        j = journal.Journal(self.path)
+        j.append([self.entry('borrow', self.u1, self.i1, 0),
+            self.entry('borrow', self.u1, self.i2, 1),
+            self.entry('return', self.u1, self.i1, 2)])
+        assert(j.pending_loan(self.i2.id) == str(self.u1.id))
+        assert(j.pending_loan(self.i1.id) is False)
+        # Nothing is written to the database until the journal is flushed
+        assert(Item.objects(borrow_current__user=self.u1).count() == 0)
+        assert(j.flush() == 3)
+        assert(j.pending() == [])
+        self.i2.reload()
+        assert(self.i2.borrow_current.borrow_date == datetime(2016, 1, 1, 10, 1))
+        assert(BorrowPast.objects(item=self.i1).count() == 1)
+
+        # Replaying entries already applied changes nothing
+        j.append([self.entry('borrow', self.u2, self.i3, 3)])
+        j._file.close()
+        os.remove(self.path + '.applied')
+        with open(self.path, 'a') as f:
+            f.write('{"half a li')
+        j = journal.Journal(self.path)
+        assert(len(j.pending()) == 1)
+        assert(j.flush() == 1)
+        assert(BorrowPast.objects(item=self.i1).count() == 1)
+        assert(Item.objects(borrow_current__user__in=[self.u1, self.u2]).count() == 2)
+        assert(JournalConflict.objects.count() == 0)
+        j._file.close()
+
+    def test_replay_borrow_and_return(self):
+        j = journal.Journal(self.path)
+        j.append([self.entry('borrow', self.u1, self.i1, 0),
+            self.entry('return', self.u1, self.i1, 1)])
+        with open(self.path) as f:
+            written = f.read()
+        assert(j.flush() == 2)
+        j._file.close()
+        # As if the process died after applying the batch, before saving
+        # its position or emptying the journal
+        with open(self.path, 'w') as f:
+            f.write(written)
+        os.remove(self.path + '.applied')
+        j = journal.Journal(self.path)
+        assert(j.flush() == 2)
+        self.i1.reload()
+        assert(self.i1.borrow_current is None)
+        assert(self.i1.borrow_count == 1)
+        assert(BorrowPast.objects(item=self.i1).count() == 1)
+        j._file.close()
+
+    def test_bad_entry(self):
+        j = journal.Journal(self.path)
+        bad = self.entry('borrow', self.u1, self.i1, 0)
+        bad['date'] = 'yesterday'
+        j.append([bad, self.entry('borrow', self.u1, self.i2, 1)])
+        # Recorded as a conflict, without holding up the next entry
+        assert(j.flush() == 2)
+        assert(JournalConflict.objects.get().error.startswith(
+            'Could not be applied'))
+        self.i2.reload()
+        assert(self.i2.borrow_current is not None)
+        j._file.close()
+
+    def test_slots(self):
+        first = journal.open_journal(self.path, slots=2)
+        second = journal.open_journal(self.path, slots=2)
+        assert(first.path == self.path and second.path == self.path + '.1')
+        assert(journal.open_journal(self.path, slots=2) is None)
+        first._file.close()
+        second._file.close()
+
+    def test_conflict(self):
+        self.u2.borrow(self.i1)
+        j = journal.Journal(self.path)
+        # Checked against the database, then against the journal
+        errors = j.append([self.entry('borrow', self.u1, self.i1, 0),
+            self.entry('borrow', self.u1, self.i2, 0),
+            self.entry('borrow', self.u3, self.i2, 0)],
+            [journal._borrow_check(self.u1, self.i1),
+            journal._borrow_check(self.u1, self.i2),
+            journal._borrow_check(self.u3, self.i2)])
+        assert(isinstance(errors[0], AlreadyBorrowed))
+        assert(errors[1] is None)
+        assert(isinstance(errors[2], AlreadyBorrowed))
+
+        # Borrowed at another desk before the journal got to it
+        self.u3.borrow(self.i2)
+        assert(j.flush() == 1)
+        conflict = JournalConflict.objects.get()
+        assert(conflict.item == self.i2 and conflict.user == self.u1)
+        assert(not conflict.resolved)
+        j._file.close()
+
+class SeedTestCase(GrowlinModelTestCase):
+
+    def tearDown(self):
+        for model in seed.MODELS:
+            model.objects().delete()
+
+    def test_seed(self):
+        counts = seed.seed(users=30, groups=3, items=100, years=1, reset=True)
+        assert(counts['users'] == User.objects.count() == 30)
+        assert(Item.objects.count() == 100)
+        assert(Item.objects(borrow_current__user__in=list(User.objects)).count()
+            == counts['on_loan'] == 10)
+        assert(counts['history'] > 0)
+        assert(User.objects.get(username='moon').password == 'pass')
+        # Counters carry on after the seeded accessions
+        assert(allocate_accession('B') == 'B:%d' % (BookItem.objects.count() + 1))
+
+    def test_compare(self):
+        def results(p50, queries):
+            return {'sizes': {'small': {'benchmarks': {'borrow': {
+                'p50_ms': p50, 'p99_ms': p50, 'queries': queries}}}}}
+        rows = benchmark.compare(results(2.0, 3), results(2.1, 3))
+        assert(not any(r[5] for r in rows))
+        rows = benchmark.compare(results(4.0, 4), results(2.0, 3))
+        assert([r[2] for r in rows if r[5]] == ['p50_ms', 'queries'])
+
+class LoadTestTestCase(GrowlinModelTestCase):
+
+    def tearDown(self):
+        for model in seed.MODELS:
+            model.objects().delete()
+
+    def test_replay(self):
+        counts = seed.seed(users=4, groups=2, items=20, years=1, reset=True)
+        trace = loadtest.synthetic_trace(sessions=4, loans=2, admin_share=0)
+        report = loadtest.run(trace, concurrency=2).summary()
+        assert(report['actions']['borrow'] == {'ok': 8, 'failed': 0})
+        assert(report['actions']['return'] == {'ok': 8, 'failed': 0})
+        assert(report['routes']['POST /shelf/<borrowid>/return/']['requests']
+            == 8)
+        assert(report['errors'] == 0)
+        # Everything borrowed was returned
+        assert(BorrowPast.objects.count() == counts['history'] + 8)
+        assert(Item.objects(borrow_current__exists=True).count()
+            == counts['on_loan'])
+
+class RequestMetricsTestCase(GrowlinModelTestCase):
+
+    def test_histogram(self):
+        h = Histogram((1, 2, 4))
+        for value in (0.5, 1.5, 1.5, 3, 10):
+            h.observe(value)
+        assert(h.counts == [1, 2, 1, 1])
+        assert(h.quantile(0.5) == 1.75)
+        assert(h.quantile(1) == 4)
+        r = RollingHistogram((1, 2), window=10, slices=5)
+        r.observe(1, now=0)
+        r.observe(1, now=9)
+        assert(r.snapshot(now=9).count == 2)
+        assert(r.snapshot(now=11).count == 1)
+
+    def test_requests(self):
+        client = app.test_client()
+        app.debug = True
+        try:
+            response = client.get('/login/')
+        finally:
+            app.debug = False
+        assert('render;dur=' in response.headers['Server-Timing'])
+        assert('view;dur=' in response.headers['Server-Timing'])
+        row = [r for r in request_metrics.summary()
+            if r['endpoint'] == 'login'][0]
+        assert(row['requests'] >= 1 and row['render_ms'] > 0)
+        # The view renders the template, within the whole request
+        assert(row['render_ms'] <= row['view_ms'] <= row['mean_ms'])
+        assert(client.get('/metrics').status_code == 403)
+        local = {'REMOTE_ADDR': '127.0.0.1'}
+        text = client.get('/metrics', environ_base=local).get_data()
+        assert('growlin_request_duration_seconds_count{endpoint="login"}'
+            in text)
+        assert('growlin_request_view_duration_seconds_count{endpoint="login"}'
+            in text)
+
+        app.config['METRICS_TOKEN'] = 'secret'
+        try:
+            # Behind a proxy every request is local, so only the token counts
+            assert(client.get('/metrics',
+                environ_base=local).status_code == 403)
+            assert(client.get('/metrics', environ_base=local,
+                headers={'Authorization': 'Bearer wrong'}).status_code == 403)
+            assert(client.get('/metrics', environ_base=local,
+                headers={'Authorization': 'Bearer secret'}).status_code == 200)
+        finally:
+            app.config['METRICS_TOKEN'] = None
+
+class QueryLogTestCase(GrowlinModelTestCase):
+
+    def tearDown(self):
+        SlowQuery.objects().delete()
+        super(QueryLogTestCase, self).tearDown()
+
+    def find(self, query, duration=0.001):
+        return Command('find', 'testdb', 'user',
+            {'find': 'user', 'filter': query}, duration, False)
+
+    def test_fingerprint(self):
+        assert(fingerprint(self.find({'_id': 1})) ==
+            fingerprint(self.find({'_id': 2})) == 'find user {"_id": "?"}')
+        assert(fingerprint(self.find({'$or': [{'a': 1}, {'b': {'$in': [1, 2]}}]}))
+            == 'find user {"$or": [{"a": "?"},{"b": {"$in": "?"}}]}')
+
+    def test_repeats(self):
+        watcher = QueryWatcher(slow=0.1)
+        for i in range(4):
+            watcher.record(self.find({'_id': i}))
+        watcher.record(self.find({'name': 'x'}, duration=0.5))
+        repeated = watcher.repeated(3)
+        assert([s.count for s in repeated] == [4])
+        assert(repeated[0].location.startswith('tests.py:'))
+        assert(watcher.slow.keys() == ['find user {"name": "?"}'])
+        try:
+            with watch_queries(threshold=3) as watcher:
+                for i in range(4):
+                    watcher.record(self.find({'_id': i}))
+            assert(False)
+        except RepeatedQueries, e:
+            assert(e.shapes[0].count == 4)
+
+        querylog.save('user_shelf', watcher.slow.values(), repeated)
+        querylog.save('user_shelf', [], repeated)
+        logged = SlowQuery.objects.get(fingerprint='find user {"_id": "?"}')
+        assert(logged.repeated == 2 and logged.count == 0)
+
+    def test_admin_list(self):
+        # With a real server, fails if rows load their references one by one
+        for n in range(5):
+            BookItem(title='Book %d' % n, campus_location=self.l1,
+                authors=[Creator(name='Author %d' % n).save()],
+                accession='B%d' % n).save()
+        with watch_queries(threshold=2):
+            count, rows = AdminModelBookItem(BookItem,
+                endpoint='test_books_n1').get_list(0, None, False, None, [])
+            names = [a.name for r in rows for a in r.authors]
+        assert(len(names) == 5)
+        Creator.objects().delete()
+
+class ProfilerTestCase(GrowlinModelTestCase):
+
+    def setUp(self):
+        super(ProfilerTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        app.config.update(PROFILE_DIR=self.dir, PROFILE_SAMPLE=0.0,
+            PROFILE_KEEP=2)
+
+    def tearDown(self):
+        app.config.update(PROFILE_DIR=None, PROFILE_SAMPLE=0.0,
+            PROFILE_KEEP=100)
+        shutil.rmtree(self.dir)
+        super(ProfilerTestCase, self).tearDown()
+
+    def test_profile(self):
+        client = app.test_client()
+        # Only admins may ask for a profile
+        client.get('/login/?_profile=1')
+        assert(profiler.list_profiles() == [])
+
+        app.config['PROFILE_SAMPLE'] = 1.0
+        for i in range(3):
+            client.get('/login/')
+        profiles = profiler.list_profiles()
+        assert(len(profiles) == 2)
+        assert(profiles[0]['endpoint'] == 'login')
+        assert(profiles[0]['trigger'] == 'sampled')
+        stats = profiler.load(profiles[0]['name'])
+        assert(profiler.hottest(stats, limit=5))
+        tree = profiler.call_tree(stats)
+        # The view is called through the dispatch wrappers
+        labels = lambda nodes: sum([[n['label']] + labels(n['children'])
+            for n in nodes], [])
+        assert(any('login' in label for label in labels(tree[0]['children'])))
+        assert(profiler.load('../' + profiles[0]['name']) is None)
+
 if __name__ == '__main__':
     unittest.main()
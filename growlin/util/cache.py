@@ -0,0 +1,39 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+class LRUCache(object):
+    '''
+    A small thread-safe cache holding at most "maxsize" entries. The least
+    recently used entries are dropped first, and every entry expires "ttl"
+    seconds after it was set.
+    '''
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time():
+                return default
+            # Put it back at the "recently used" end
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time() + self.ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
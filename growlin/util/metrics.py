@@ -0,0 +1,316 @@
+'''
+Per-request metrics.
+
+RequestMetrics is a Flask extension measuring every request: how long it
+took, how long its view function took, how many database commands it ran
+and how long they took (through monitoring.py), and how long its
+templates took to render. The measurements go into histograms by
+endpoint, kept two ways:
+
+ * since the process started, exported at /metrics in the Prometheus text
+   format (a scraper works out rates and recent percentiles from these);
+ * over a rolling window of the last few minutes, for the admin page.
+
+In debug mode responses also get a Server-Timing header, which browsers
+show with the request in their developer tools. Each process keeps its
+own metrics.
+
+View time includes the templates rendered by the view, and template time
+includes any queries run from inside templates (eg. to dereference), which
+are counted as database time as well. The rest of the request's time is
+spent in the before and after request hooks (eg. loading the user).
+
+/metrics is only served to the addresses in METRICS_ALLOW. Behind a proxy
+(as on OpenShift) every request comes from the proxy's address, which is
+usually allowed, so there set METRICS_TOKEN as well: requests then also
+need an "Authorization: Bearer <token>" header, which Prometheus sends
+when given the token as its bearer_token.
+'''
+import hmac
+import threading
+from bisect import bisect_left
+from collections import deque
+from timeit import default_timer
+from flask import g, request, abort, Response, has_request_context
+from jinja2 import Template
+from . import monitoring
+
+# Histogram buckets (upper bounds) for durations, in seconds, and for the
+# number of database commands
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMANDS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+# The measures kept for each endpoint: name, buckets and description
+MEASURES = (
+    ('request_duration_seconds', SECONDS, 'Time taken by requests'),
+    ('request_view_duration_seconds', SECONDS,
+        'Time spent in the view function per request'),
+    ('request_db_duration_seconds', SECONDS,
+        'Time spent on database commands per request'),
+    ('request_db_commands', COMMANDS, 'Database commands run per request'),
+    ('request_render_duration_seconds', SECONDS,
+        'Time spent rendering templates per request'),
+)
+
+class Histogram(object):
+    '''Counts of values falling into buckets, with their sum'''
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # The last count is for values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def add(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.sum += other.sum
+        self.count += other.count
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        '''
+        Estimates the q-th quantile (0 to 1), assuming values are spread
+        evenly within each bucket
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(self.buckets + (None,), self.counts):
+            if n and seen + n >= rank:
+                if bound is None:
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            if bound is not None:
+                lower = bound
+        return lower
+
+class RollingHistogram(object):
+    '''
+    A histogram of the values seen over the last "window" seconds, kept
+    in slices so that old values can be dropped a slice at a time
+    '''
+    def __init__(self, buckets, window=600, slices=10):
+        self.buckets = buckets
+        self.slice_length = float(window) / slices
+        self._slices = deque(maxlen=slices)
+
+    def _current(self, now):
+        number = int(now // self.slice_length)
+        if not self._slices or self._slices[-1][0] != number:
+            self._slices.append((number, Histogram(self.buckets)))
+        return self._slices[-1][1]
+
+    def observe(self, value, now=None):
+        self._current(default_timer() if now is None else now).observe(value)
+
+    def snapshot(self, now=None):
+        '''Returns a Histogram of the values in the window'''
+        now = default_timer() if now is None else now
+        oldest = int(now // self.slice_length) - self._slices.maxlen + 1
+        total = Histogram(self.buckets)
+        for number, histogram in self._slices:
+            if number >= oldest:
+                total.add(histogram)
+        return total
+
+class _Endpoint(object):
+    def __init__(self, window):
+        self.total = dict((name, Histogram(buckets))
+            for name, buckets, help in MEASURES)
+        self.recent = dict((name, RollingHistogram(buckets, window))
+            for name, buckets, help in MEASURES)
+        self.statuses = {}
+
+class _TimedTemplate(Template):
+    # Adds the time taken to the request's render time. Templates
+    # included or extended are rendered as part of this call.
+    def render(self, *args, **kwargs):
+        start = default_timer()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            state = getattr(g, '_request_metrics', None) \
+                if has_request_context() else None
+            if state is not None:
+                state['render'] += default_timer() - start
+
+class RequestMetrics(object):
+    '''
+    Measures the requests handled by an app. The metrics are served at
+    METRICS_URL (default "/metrics") to the addresses in METRICS_ALLOW
+    (default: this machine only), with the bearer token METRICS_TOKEN if
+    that is set.
+    '''
+    def __init__(self, app=None, window=600):
+        self.window = window
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_URL', '/metrics')
+        app.config.setdefault('METRICS_ALLOW', ('127.0.0.1', '::1'))
+        app.config.setdefault('METRICS_TOKEN', None)
+        # First, so that the time taken by the other hooks counts too
+        app.before_request_funcs.setdefault(None, []).insert(0, self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+        app.jinja_env.template_class = _TimedTemplate
+        dispatch = app.dispatch_request
+        def dispatch_request():
+            # Times the view function itself, without the request hooks
+            start = default_timer()
+            try:
+                return dispatch()
+            finally:
+                state = getattr(g, '_request_metrics', None)
+                if state is not None:
+                    state['view'] += default_timer() - start
+        app.dispatch_request = dispatch_request
+        app.add_url_rule(app.config['METRICS_URL'], 'metrics', self._export)
+        self.app = app
+
+    def _start(self):
+        g._request_metrics = state = {
+            'start': default_timer(),
+            'commands': monitoring.CommandRecorder(),
+            'view': 0.0,
+            'render': 0.0,
+        }
+        monitoring.start_recording(state['commands'])
+
+    def _finish(self, response):
+        state = getattr(g, '_request_metrics', None)
+        if state is None:
+            return response
+        monitoring.stop_recording(state['commands'])
+        total = default_timer() - state['start']
+        self.record(request.endpoint or 'unmatched', response.status_code,
+            total, state['commands'], state['render'], state['view'])
+        g._request_metrics = None
+        if self.app.debug:
+            response.headers['Server-Timing'] = (
+                'db;dur=%.1f;desc="%d commands", render;dur=%.1f, '
+                'view;dur=%.1f, total;dur=%.1f' % (
+                    state['commands'].duration * 1000,
+                    state['commands'].count, state['render'] * 1000,
+                    state['view'] * 1000, total * 1000))
+        return response
+
+    def _teardown(self, exception):
+        # Requests failing with an exception never reach _finish
+        state = getattr(g, '_request_metrics', None)
+        if state is not None:
+            monitoring.stop_recording(state['commands'])
+            self.record(request.endpoint or 'unmatched', 500,
+                default_timer() - state['start'], state['commands'],
+                state['render'], state['view'])
+            g._request_metrics = None
+
+    def record(self, endpoint, status, duration, commands, render, view):
+        '''Adds a request's measurements to the histograms'''
+        values = {
+            'request_duration_seconds': duration,
+            'request_view_duration_seconds': view,
+            'request_db_duration_seconds': commands.duration,
+            'request_db_commands': commands.count,
+            'request_render_duration_seconds': render,
+        }
+        now = default_timer()
+        with self._lock:
+            e = self._endpoints.get(endpoint)
+            if e is None:
+                e = self._endpoints[endpoint] = _Endpoint(self.window)
+            for name, value in values.items():
+                e.total[name].observe(value)
+                e.recent[name].observe(value, now)
+            e.statuses[status] = e.statuses.get(status, 0) + 1
+
+    def summary(self):
+        '''
+        Returns the rolling window's figures for each endpoint that had
+        requests in it, slowest overall first. Times are in milliseconds.
+        '''
+        rows = []
+        with self._lock:
+            for endpoint, e in self._endpoints.items():
+                h = dict((name, r.snapshot())
+                    for name, r in e.recent.items())
+                duration = h['request_duration_seconds']
+                if not duration.count:
+                    continue
+                rows.append({
+                    'endpoint': endpoint,
+                    'requests': duration.count,
+                    'total_ms': duration.sum * 1000,
+                    'mean_ms': duration.mean() * 1000,
+                    'p50_ms': duration.quantile(0.5) * 1000,
+                    'p90_ms': duration.quantile(0.9) * 1000,
+                    'p99_ms': duration.quantile(0.99) * 1000,
+                    'view_ms':
+                        h['request_view_duration_seconds'].mean() * 1000,
+                    'db_ms': h['request_db_duration_seconds'].mean() * 1000,
+                    'commands': h['request_db_commands'].mean(),
+                    'p90_commands': h['request_db_commands'].quantile(0.9),
+                    'render_ms':
+                        h['request_render_duration_seconds'].mean() * 1000,
+                })
+        rows.sort(key=lambda r: r['total_ms'], reverse=True)
+        return rows
+
+    def prometheus(self):
+        '''Returns the metrics since startup in the Prometheus text format'''
+        lines = []
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            lines.append('# HELP growlin_requests_total Requests handled')
+            lines.append('# TYPE growlin_requests_total counter')
+            for endpoint, e in endpoints:
+                for status, n in sorted(e.statuses.items()):
+                    lines.append('growlin_requests_total{endpoint="%s",'
+                        'status="%d"} %d' % (_label(endpoint), status, n))
+            for name, buckets, help in MEASURES:
+                metric = 'growlin_' + name
+                lines.append('# HELP %s %s' % (metric, help))
+                lines.append('# TYPE %s histogram' % metric)
+                for endpoint, e in endpoints:
+                    h = e.total[name]
+                    label = 'endpoint="%s"' % _label(endpoint)
+                    cumulative = 0
+                    for bound, n in zip(h.buckets + ('+Inf',), h.counts):
+                        cumulative += n
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (metric,
+                            label, bound, cumulative))
+                    lines.append('%s_sum{%s} %r' % (metric, label, h.sum))
+                    lines.append('%s_count{%s} %d' % (metric, label, h.count))
+        return '\n'.join(lines) + '\n'
+
+    def _export(self):
+        if request.remote_addr not in self.app.config['METRICS_ALLOW']:
+            abort(403)
+        token = self.app.config['METRICS_TOKEN']
+        if token and not hmac.compare_digest(
+                _utf8(request.headers.get('Authorization', '')),
+                _utf8('Bearer ' + token)):
+            abort(403)
+        return Response(self.prometheus(),
+            mimetype='text/plain; version=0.0.4')
+
+def _utf8(value):
+    # compare_digest only takes two byte strings (or two ASCII unicode ones)
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
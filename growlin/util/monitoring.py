@@ -0,0 +1,113 @@
+'''
+Counting and timing the commands sent to MongoDB.
+
+install() registers a pymongo CommandListener, which has to happen before
+the client is created (pymongo only gives listeners to clients created
+afterwards). The listener passes each finished command on to the
+CommandRecorders active in the thread that ran it, if any, so threads
+and requests are measured separately, and nothing is kept while nobody
+is recording.
+
+    with record_commands() as recorder:
+        user.get_current_borrowings().prefetch('authors')
+    print recorder.count, recorder.duration
+'''
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from pymongo import monitoring
+
+# A finished command: its name (eg. "find"), database and collection, the
+# command document itself, how long it took in seconds, and whether it
+# failed
+Command = namedtuple('Command',
+    'name database collection document duration failed')
+
+_local = threading.local()
+_installed = False
+_install_lock = threading.Lock()
+
+def _recorders():
+    recorders = getattr(_local, 'recorders', None)
+    if recorders is None:
+        recorders = _local.recorders = []
+        _local.started = {}
+    return recorders
+
+def _collection(name, document):
+    if name == 'getMore':
+        return document.get('collection')
+    value = document.get(name)
+    return value if isinstance(value, basestring) else None
+
+class CommandRecorder(object):
+    '''Collects the commands finished in a thread while it is active'''
+    def __init__(self):
+        self.commands = []
+
+    def record(self, command):
+        self.commands.append(command)
+
+    @property
+    def count(self):
+        return len(self.commands)
+
+    @property
+    def duration(self):
+        return sum(c.duration for c in self.commands)
+
+class _Listener(monitoring.CommandListener):
+    def started(self, event):
+        if _recorders():
+            _local.started[event.request_id] = event
+
+    def _finished(self, event, failed):
+        started = _local.started.pop(event.request_id, None) \
+            if _recorders() else None
+        if started is None:
+            return
+        command = Command(event.command_name, started.database_name,
+            _collection(event.command_name, started.command),
+            started.command, event.duration_micros / 1e6, failed)
+        for recorder in list(_local.recorders):
+            recorder.record(command)
+
+    def succeeded(self, event):
+        self._finished(event, False)
+
+    def failed(self, event):
+        self._finished(event, True)
+
+def install():
+    '''Registers the command listener. Safe to call more than once.'''
+    global _installed
+    with _install_lock:
+        if not _installed:
+            monitoring.register(_Listener())
+            _installed = True
+
+def start_recording(recorder):
+    '''
+    Starts recording the commands run in the current thread in a
+    CommandRecorder, until stop_recording() is called with it
+    '''
+    _recorders().append(recorder)
+
+def stop_recording(recorder):
+    recorders = _recorders()
+    if recorder in recorders:
+        recorders.remove(recorder)
+
+@contextmanager
+def record_commands(recorder=None):
+    '''
+    Records the commands run in the current thread inside the "with" block,
+    in the given CommandRecorder or a new one, which is returned
+    '''
+    if recorder is None:
+        recorder = CommandRecorder()
+    start_recording(recorder)
+    try:
+        yield recorder
+    finally:
+        stop_recording(recorder)
@@ -0,0 +1,76 @@
+'''
+Keyset pagination.
+
+Rather than skipping over the rows of earlier pages, each page starts
+where the previous one ended, using a range query on an indexed sort key.
+Pages cost the same however deep they are. The position is handed to the
+client as an opaque cursor token.
+
+Querysets are sorted newest first on (field, id); the id breaks ties
+between rows with the same value. There should be an index that ends in
+(-field, -id) for this.
+'''
+import base64
+import json
+from datetime import datetime
+from bson import ObjectId
+from mongoengine.queryset.visitor import Q
+
+_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def encode_cursor(value, id):
+    '''Returns an opaque token for a position in a keyset-paginated list'''
+    if isinstance(value, datetime):
+        value = {'d': value.strftime(_DATE_FORMAT)}
+    return base64.urlsafe_b64encode(json.dumps([value, str(id)]))
+
+def decode_cursor(token):
+    '''
+    Returns the (value, id) pair encoded in a cursor token. Raises
+    ValueError if the token is not valid.
+    '''
+    try:
+        value, id = json.loads(base64.urlsafe_b64decode(str(token)))
+        if isinstance(value, dict):
+            value = datetime.strptime(value['d'], _DATE_FORMAT)
+        return value, ObjectId(id)
+    except Exception, e:
+        raise ValueError('Invalid cursor: %s' % e)
+
+def keyset_queryset(queryset, field, after=None):
+    '''
+    Returns the queryset sorted by (field, id) newest first, starting after
+    the position in the "after" cursor token
+    '''
+    if after:
+        value, id = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(**{'%s__lt' % field: value}) |
+            Q(**{field: value, 'id__lt': id}))
+    return queryset.order_by('-%s' % field, '-id')
+
+def keyset_page(queryset, field, after=None, per_page=20):
+    '''
+    Returns one page of the queryset, sorted by (field, id) newest first and
+    starting after the position in the "after" cursor token, along with the
+    cursor for the next page (None if this is the last page).
+    '''
+    rows = list(keyset_queryset(queryset, field, after).limit(per_page + 1))
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1][field], rows[-1].id)
+    return rows, next_cursor
+
+def iter_keyset_pages(queryset, field, per_page=500):
+    '''
+    Yields the whole queryset one page (list) at a time, so that only one
+    page is held in memory.
+    '''
+    after = None
+    while True:
+        rows, after = keyset_page(queryset, field, after, per_page)
+        if rows:
+            yield rows
+        if after is None:
+            break
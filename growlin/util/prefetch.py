@@ -0,0 +1,98 @@
+'''
+Batched loading of referenced documents.
+
+Reading a ReferenceField on each document of a queryset costs one query
+per document (and one per list of references). prefetch() first collects
+the referenced ids of all the documents, then fetches each referenced
+collection with a single $in query and puts the results back in place.
+The number of queries depends only on the paths asked for, not on the
+number of documents.
+'''
+from bson import DBRef
+from flask.ext.mongoengine import BaseQuerySet
+from mongoengine import Document, EmbeddedDocument, ReferenceField, ListField
+
+def reference_field(field):
+    '''
+    Returns the ReferenceField for a reference (or list of references)
+    field, and whether it is a list. Returns (None, False) for other fields.
+    '''
+    if isinstance(field, ReferenceField):
+        return field, False
+    if isinstance(field, ListField) and isinstance(field.field, ReferenceField):
+        return field.field, True
+    return None, False
+
+def _follow(documents, name):
+    '''Returns the documents (or embedded documents) held in a field'''
+    found = []
+    for doc in documents:
+        if name not in doc._fields:
+            continue
+        value = doc._data.get(name)
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        found.extend(v for v in value
+            if isinstance(v, (Document, EmbeddedDocument)))
+    return found
+
+def _load(documents, name, only=None):
+    '''Loads the references held in one field of the given documents'''
+    wanted = {}
+    holders = []
+    for doc in documents:
+        field, is_list = reference_field(doc._fields.get(name))
+        if field is None:
+            continue
+        value = doc._data.get(name)
+        refs = (value or []) if is_list else [value]
+        ids = [r.id for r in refs if isinstance(r, DBRef)]
+        if ids:
+            wanted.setdefault(field.document_type, set()).update(ids)
+            holders.append((doc, field.document_type, is_list))
+
+    loaded = {}
+    for model, ids in wanted.items():
+        queryset = model.objects(id__in=list(ids))
+        if only:
+            queryset = queryset.only(*only)
+        loaded[model] = dict((d.id, d) for d in queryset)
+
+    # Swap the DBRefs for documents, without marking anything as changed.
+    # References to missing documents are left as they were.
+    for doc, model, is_list in holders:
+        found = loaded[model]
+        value = doc._data.get(name)
+        if is_list:
+            doc._data[name] = [found.get(r.id, r) if isinstance(r, DBRef) else r
+                for r in value]
+        elif value.id in found:
+            doc._data[name] = found[value.id]
+
+def prefetch(documents, *paths, **kwargs):
+    '''
+    Loads the references along each of the given paths (eg. "authors",
+    "item.authors" or "borrow_current.user") for all of the documents, with
+    one query per referenced collection and path.
+
+    The optional "only" keyword argument maps paths to the fields to load
+    for them, eg. only={'user': ('name', 'group')}.
+
+    Returns the documents as a list.
+    '''
+    only = kwargs.pop('only', {})
+    documents = list(documents)
+    for path in paths:
+        names = path.split('.')
+        level = documents
+        for i, name in enumerate(names):
+            # Parent references are loaded first, if not done already
+            _load(level, name, only.get('.'.join(names[:i + 1])))
+            level = _follow(level, name)
+    return documents
+
+class PrefetchQuerySet(BaseQuerySet):
+    '''QuerySet with a prefetch() method. See prefetch() above.'''
+
+    def prefetch(self, *paths, **kwargs):
+        return prefetch(self, *paths, **kwargs)
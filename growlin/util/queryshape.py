@@ -0,0 +1,175 @@
+'''
+Query shapes.
+
+fingerprint() reduces a MongoDB command to its shape: what it does, to
+which collection, and the structure of its filter with the values left
+out, so that every "find a user by id" looks the same:
+
+    find user {"_id": "?"}
+
+A QueryWatcher (a monitoring.CommandRecorder) counts the commands of each
+shape, notes where in the code and templates each shape was first run,
+and reports the shapes run more than a given number of times. A shape
+repeated within one request is what an N+1 pattern (eg. dereferencing in
+a loop) looks like. Tests can use watch_queries() to fail on them:
+
+    with watch_queries(threshold=3):
+        list(user.get_current_borrowings())
+'''
+import json
+import os
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
+from .monitoring import CommandRecorder, record_commands
+
+# Where each command keeps its filter, if it has one
+_FILTERS = {
+    'find': 'filter',
+    'count': 'query',
+    'distinct': 'query',
+    'findAndModify': 'query',
+}
+# Commands that only carry on with an earlier one
+_IGNORED = ('getMore', 'killCursors')
+
+_PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_UTIL = os.path.dirname(os.path.abspath(__file__))
+
+def shape(value):
+    '''Replaces the values in a query with "?", keeping its structure'''
+    if isinstance(value, dict):
+        return OrderedDict((k, shape(value[k])) for k in sorted(value))
+    if isinstance(value, (list, tuple)) and value and all(
+            isinstance(v, dict) for v in value):
+        # eg. $or, or an aggregation pipeline
+        return [shape(v) for v in value]
+    return '?'
+
+def fingerprint(command):
+    '''
+    Returns the shape of a monitoring.Command as a string, or None for
+    commands that only fetch more of an earlier one's results
+    '''
+    if command.name in _IGNORED:
+        return None
+    document = command.document
+    if command.name in _FILTERS:
+        query = shape(document.get(_FILTERS[command.name]) or {})
+    elif command.name in ('update', 'delete'):
+        key = 'updates' if command.name == 'update' else 'deletes'
+        query = [shape(op.get('q') or {}) for op in document.get(key, [])[:1]]
+    elif command.name == 'aggregate':
+        query = shape(document.get('pipeline') or [])
+    else:
+        query = None
+    parts = [command.name, command.collection or '']
+    if query is not None:
+        parts.append(json.dumps(query, separators=(',', ': ')))
+    return ' '.join(parts).strip()
+
+def _source(filename):
+    return os.path.relpath(filename, _PACKAGE)
+
+def find_location():
+    '''
+    Describes where the running command came from: the innermost line of
+    this app's own code outside util/, and the template line, if any, eg.
+    "views.py:30 (user_shelf), user/shelf.htm:12"
+    '''
+    code = template = None
+    frame = sys._getframe(1)
+    while frame is not None and not (code and template):
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if template is None and '__jinja_template__' in frame.f_globals:
+            t = frame.f_globals['__jinja_template__']
+            template = '%s:%d' % (t.name or t.filename,
+                t.get_corresponding_lineno(frame.f_lineno))
+        elif (code is None and filename.startswith(_PACKAGE)
+                and not filename.startswith(_UTIL)):
+            code = '%s:%d (%s)' % (_source(filename), frame.f_lineno,
+                frame.f_code.co_name)
+        frame = frame.f_back
+    return ', '.join(l for l in (code, template) if l) or None
+
+class Shape(object):
+    '''The commands of one shape that a QueryWatcher saw'''
+    def __init__(self, fingerprint, collection, location=None):
+        self.fingerprint = fingerprint
+        self.collection = collection
+        self.location = location
+        self.count = 0
+        self.duration = 0.0
+        self.max_duration = 0.0
+
+    def add(self, command):
+        self.count += 1
+        self.duration += command.duration
+        self.max_duration = max(self.max_duration, command.duration)
+
+    def __repr__(self):
+        return '<Shape %s: %d, at %s>' % (self.fingerprint, self.count,
+            self.location)
+
+class QueryWatcher(CommandRecorder):
+    '''
+    Groups the commands recorded by shape. With "repeats" set, every
+    command is fingerprinted (and the first of each shape located); with
+    "slow" set to a number of seconds, commands taking at least that long
+    are, and are also kept in "slow".
+    '''
+    def __init__(self, repeats=True, slow=None):
+        super(QueryWatcher, self).__init__()
+        self.repeats = repeats
+        self.slow_threshold = slow
+        self.shapes = OrderedDict()
+        self.slow = OrderedDict()
+
+    def record(self, command):
+        super(QueryWatcher, self).record(command)
+        slow = (self.slow_threshold is not None
+            and command.duration >= self.slow_threshold)
+        if not (self.repeats or slow):
+            return
+        fp = fingerprint(command)
+        if fp is None:
+            return
+        if self.repeats:
+            s = self.shapes.get(fp)
+            if s is None:
+                s = self.shapes[fp] = Shape(fp, command.collection,
+                    find_location())
+            s.add(command)
+        if slow:
+            s = self.slow.get(fp)
+            if s is None:
+                s = self.slow[fp] = Shape(fp, command.collection,
+                    find_location())
+            s.add(command)
+
+    def repeated(self, threshold, allowed=()):
+        '''Returns the shapes run more than "threshold" times, bar those allowed'''
+        return [s for s in self.shapes.values()
+            if s.count > threshold and s.fingerprint not in allowed]
+
+class RepeatedQueries(Exception):
+    '''Raised when the same shape of query was run too many times'''
+    def __init__(self, shapes, threshold):
+        self.shapes = shapes
+        Exception.__init__(self, 'Queries repeated more than %d times: %s' % (
+            threshold, '; '.join('%s x%d at %s' % (s.fingerprint, s.count,
+                s.location) for s in shapes)))
+
+@contextmanager
+def watch_queries(threshold=None, allowed=()):
+    '''
+    Watches the queries run in the "with" block, in this thread. With a
+    threshold, raises RepeatedQueries at the end if any shape not allowed
+    was run more often than that.
+    '''
+    with record_commands(QueryWatcher()) as watcher:
+        yield watcher
+    if threshold is not None:
+        repeated = watcher.repeated(threshold, allowed)
+        if repeated:
+            raise RepeatedQueries(repeated, threshold)
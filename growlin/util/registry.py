@@ -0,0 +1,63 @@
+'''
+In-memory copies of small, rarely changing collections (item types,
+locations and the like).
+
+A Registry loads its whole collection with one query the first time it is
+used, and indexes the documents by "pk" and the fields asked for. Saving
+or deleting a document of the collection (in this process) bumps its
+version through the mongoengine signals, and the next lookup reloads it.
+Changes made by other processes are picked up once the copy is "max_age"
+seconds old.
+'''
+from threading import Lock
+from time import time
+from mongoengine import signals
+
+class Registry(object):
+
+    def __init__(self, model, indexes=('name',), max_age=300):
+        self.model = model
+        self.indexes = ('pk',) + tuple(indexes)
+        self.max_age = max_age
+        self._version = 0
+        # (version, load time, documents, {index: {value: document}})
+        self._loaded = None
+        self._lock = Lock()
+        signals.post_save.connect(self.invalidate, sender=model)
+        signals.post_delete.connect(self.invalidate, sender=model)
+
+    def invalidate(self, sender=None, **kwargs):
+        '''Outdates the loaded copy. Connected to the model's signals.'''
+        self._version += 1
+
+    def _load(self):
+        loaded = self._loaded
+        if (loaded is not None and loaded[0] == self._version
+                and loaded[1] + self.max_age > time()):
+            return loaded
+        with self._lock:
+            if self._loaded is not loaded:
+                # Another thread reloaded it meanwhile
+                return self._loaded
+            # Taken before the query, so that a change made meanwhile
+            # causes another reload
+            version = self._version
+            documents = list(self.model.objects)
+            lookups = dict((index, dict((getattr(d, index), d)
+                for d in documents)) for index in self.indexes)
+            self._loaded = (version, time(), documents, lookups)
+            return self._loaded
+
+    def all(self):
+        '''Returns the list of documents, in the model's default order'''
+        return self._load()[2]
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def get(self, index, value, default=None):
+        '''
+        Returns the document whose "index" field (eg. "name") has the given
+        value, or the default if there is none
+        '''
+        return self._load()[3][index].get(value, default)
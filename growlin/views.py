@@ -1,9 +1,20 @@
-from flask import Flask, render_template, redirect, abort, flash, request, url_for, current_app, session
+import csv
+from StringIO import StringIO
+from datetime import datetime
+from bson import ObjectId
+from flask import Flask, render_template, redirect, abort, flash, request, url_for, current_app, session, jsonify, Response, stream_with_context
 from .app import app
 from .auth import current_user, login_required
 from .models import *
 from .forms import *
+from .accession import resolve_accession, resolve_accessions
+from .search import search, search_result
+from .util.pagination import (keyset_page, keyset_queryset, iter_keyset_pages,
+    encode_cursor)
+from .util.prefetch import prefetch
 from .admin import admin_permission
+from .indexes import hot_query
+from . import journal
 
 @app.route('/')
 def home():
@@ -19,21 +30,131 @@ def user(username):
 @app.route('/shelf/')
 @login_required
 def user_shelf():
-    records = current_user.get_current_borrowings()
-    item_types = ItemType.objects
+    records = current_user.get_current_borrowings().prefetch('authors')
     return render_template('user/shelf.htm',
         records=records,
-        item_types=item_types,
+        item_types=item_types.all(),
         admin_permission=admin_permission)
 
+HISTORY_PAGE_SIZE = 20
+# Rows read at a time for the CSV download
+HISTORY_CSV_PAGE_SIZE = 500
+
+def _history_page():
+    '''
+    Returns the page of the current user's history asked for in the
+    request (through the "after" cursor), and the cursor for the next one
+    '''
+    try:
+        records, next_cursor = keyset_page(current_user.get_past_borrowings(),
+            'return_date', request.args.get('after'), HISTORY_PAGE_SIZE)
+    except ValueError:
+        abort(400)
+    return _with_snapshots(records), next_cursor
+
+@hot_query('history page')
+def _history_page_query():
+    return keyset_queryset(User(id=ObjectId()).get_past_borrowings(),
+        'return_date', encode_cursor(datetime.now(), ObjectId()))
+
+def _with_snapshots(records):
+    '''
+    Makes sure all the records can give an item snapshot. Only records
+    from before snapshots were kept need their items loaded.
+    '''
+    prefetch([r for r in records if r.item_snapshot is None],
+        'item', 'item.authors')
+    return records
+
+def _history_record(r):
+    item = r.get_snapshot()
+    return {
+        'accession': item.accession,
+        'title': item.title,
+        'author': item.author,
+        'borrow_date': r.borrow_date.isoformat(),
+        'return_date': r.return_date.isoformat(),
+    }
+
 @app.route('/shelf/history/')
 @login_required
 def user_history():
-    records = current_user.get_past_borrowings()
+    records, next_cursor = _history_page()
     return render_template('shelf/history.htm',
         records=records,
+        next_cursor=next_cursor,
+        admin_permission=admin_permission)
+
+@app.route('/shelf/history.json')
+@login_required
+def user_history_json():
+    records, next_cursor = _history_page()
+    return jsonify(
+        records=[_history_record(r) for r in records],
+        next=next_cursor)
+
+@app.route('/shelf/history.csv')
+@login_required
+def user_history_csv():
+    # Stream the whole history one page at a time, so it never has to
+    # be held in memory
+    def generate(user):
+        fields = ('accession', 'title', 'author', 'borrow_date', 'return_date')
+        buf = StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(fields)
+        for page in iter_keyset_pages(user.get_past_borrowings(), 'return_date',
+                HISTORY_CSV_PAGE_SIZE):
+            for r in _with_snapshots(page):
+                record = _history_record(r)
+                writer.writerow([unicode(record[f] or '').encode('utf-8') for f in fields])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+    return Response(stream_with_context(generate(current_user._get_current_object())),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=history.csv'})
+
+def _search_request():
+    '''Runs the search given in the request arguments'''
+    args = request.args
+    available = {'1': True, '0': False}.get(args.get('available'))
+    try:
+        page = int(args.get('page', 1))
+    except ValueError:
+        abort(400)
+    location = args.get('location') or None
+    if location is not None and not ObjectId.is_valid(location):
+        abort(400)
+    items, more = search(args.get('q', ''),
+        item_class=args.get('type') or None,
+        campus_location=location,
+        available=available,
+        page=page)
+    return items, page, more
+
+@app.route('/search/')
+@login_required
+def user_search():
+    items, page, more = _search_request()
+    return render_template('user/search.htm',
+        items=items,
+        page=page,
+        more=more,
+        item_types=item_types.all(),
+        campus_locations=campus_locations.all(),
         admin_permission=admin_permission)
 
+@app.route('/search.json')
+@login_required
+def user_search_json():
+    items, page, more = _search_request()
+    return jsonify(
+        results=[search_result(i) for i in items],
+        page=page,
+        more=more)
+
 @app.route('/shelf/borrow/', methods=['GET', 'POST'])
 def user_borrow():
     cform = AccessionItemForm()
@@ -50,7 +171,7 @@ def user_borrow():
                 error='This book does not exist. Please check the number and try again.',
                 form = form)
         try:
-            current_user.borrow(item, acc)
+            journal.borrow(current_user._get_current_object(), item, acc)
             flash('"%s" has been added to your shelf.' % item.title)
             return redirect(url_for('user_shelf'))
         except BorrowError, e:
@@ -64,33 +185,11 @@ def user_borrow():
         a = form.accession.data
         i = form.item_type.data
 
-        # Check for item type exists
-        try:
-            itype = ItemType.objects.get(name=i)
-        except Item.DoesNotExist:
-            return render_template('user/borrow.htm',
-                error='Invalid item type',
-                form = form)
-        # Check for item exists
-        item = None
-        try:
-            item = Item.objects.get(accession=a)
-        except Item.DoesNotExist:
-            if itype:
-                a = '%s:%s' % (itype.prefix, a)
-                try:
-                    item = Item.objects.get(accession=a)
-                except Item.DoesNotExist:
-                    pass
+        # Look up the item (of the selected type) in one go
+        item = resolve_accession(a, item_type=i)
         if item is None:
             return render_template('user/borrow.htm',
-                error='This %s does not exist. Please check the number and try again.' % i,
-                form = form)
-
-        # Check for wrong item type
-        if item.item_class != i:
-            return render_template('user/borrow.htm',
-                error='This %s does not exist. Please check the item type and try again.' % i,
+                error='This %s does not exist. Please check the number and item type and try again.' % i,
                 form = form)
 
         # Check for already borrowed
@@ -107,7 +206,7 @@ def user_borrow():
             #Not borrowed so it's okay
             # Show confirmation form
             cform.item = item.id
-            cform.accession = a
+            cform.accession = item.accession
             return render_template('user/borrow.htm',
                 form=cform, item=item)
     else:
@@ -127,20 +226,11 @@ def user_return(borrowid):
     if form.validate_on_submit():
         a = form.accession.data
         try:
-            current_user.unborrow(item, a)
+            journal.unborrow(current_user._get_current_object(), item, a)
             flash('"%(title)s" has been successfully returned' % {
                 'title': item.title})
-        except AccessionMismatch, e:
-            try:
-                itype = ItemType.objects.get(name=item.item_class)
-                a = '%s:%s' % (itype.prefix, a)
-                current_user.unborrow(item, a)
-                flash('"%(title)s" has been successfully returned' % {
-                    'title': item.title})
-            except ItemType.DoesNotExist, f:
-                flash(e.message)
-            except BorrowError, e:
-                flash(e.message)
+        except BorrowError, e:
+            flash(e.message)
     else:
         if item.borrow_current.user.id == current_user.id:
             msg = 'Please enter the accession number for "%(title)s"' % {
@@ -158,3 +248,81 @@ def user_return(borrowid):
 @app.route('/api/ok')
 def api_ok():
     return "{status: 'OK'}"
+
+# Most a scanner station may send at once
+API_BATCH_SIZE = 50
+
+def _api_error(message):
+    response = jsonify(error=message)
+    response.status_code = 400
+    return response
+
+@app.route('/api/circulation', methods=['POST'])
+@login_required
+def api_circulation():
+    '''
+    Borrows or returns a stack of items for the current user, eg. from a
+    barcode scanner station. Takes a JSON object:
+
+        {"action": "borrow" or "return",
+         "accessions": ["B:42", ...],
+         "item_type": "book" (optional),
+         "longterm": false (optional)}
+
+    and gives a result for each accession, in the same order. All the
+    items are looked up with one query, and changed with one bulk write
+    (see User.borrow_many and unborrow_many) or recorded in the circulation
+    journal, if there is one.
+    '''
+    # Only JSON is accepted, which a form on another site cannot send
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return _api_error('Expected a JSON object')
+    action = data.get('action')
+    accessions = data.get('accessions')
+    if action not in ('borrow', 'return'):
+        return _api_error('"action" must be "borrow" or "return"')
+    if (not isinstance(accessions, list) or not accessions
+            or not all(isinstance(a, basestring) and a for a in accessions)):
+        return _api_error('"accessions" must be a list of accessions')
+    if len(accessions) > API_BATCH_SIZE:
+        return _api_error('At most %d accessions at once' % API_BATCH_SIZE)
+
+    found = resolve_accessions(accessions, data.get('item_type') or None)
+    results = []
+    items = []
+    seen = set()
+    for a in accessions:
+        item = found[a]
+        result = {'accession': a, 'ok': False}
+        if item is None:
+            result['error'] = 'No such item'
+        elif item.id in seen:
+            result['error'] = 'Listed more than once'
+        else:
+            seen.add(item.id)
+            items.append((result, item))
+        results.append(result)
+
+    user = current_user._get_current_object()
+    if action == 'borrow':
+        outcomes = journal.borrow_many(user, [i for r, i in items],
+            longterm=bool(data.get('longterm')))
+    else:
+        outcomes = journal.unborrow_many(user, prefetch([i for r, i in items],
+            'authors', only={'authors': ('name',)}))
+    for (result, item), outcome in zip(items, outcomes):
+        result['item'] = {
+            'id': str(item.id),
+            'accession': item.accession,
+            'title': item.title,
+        }
+        if isinstance(outcome, BorrowError):
+            result['error'] = outcome.message
+        else:
+            result['ok'] = True
+            due_date = (action == 'borrow' and item.borrow_current
+                and item.borrow_current.due_date)
+            if due_date:
+                result['due_date'] = due_date.isoformat()
+    return jsonify(results=results)
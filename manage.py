@@ -0,0 +1,9 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'flask-admin-material'))
+
+from growlin.commands import main
+
+if __name__ == '__main__':
+    sys.exit(main())